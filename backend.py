@@ -1,186 +1,39 @@
-import sys
 import json
 import asyncio
+import os
 import websockets
-import threading
-import numpy as np
-import cv2
-from ctypes import *
-from MvImport.MvCameraControl_class import *
-
-class CameraManager:
-    def __init__(self):
-        self.cam = None
-        self.device_list = []
-        self.streaming = False
-        self.current_device_index = -1
-        self.frame_convert_param = None
-        self.buf_cache = None
-        self.loop = None
-        
-    def set_event_loop(self, loop):
-        self.loop = loop
-
-    def enum_devices(self):
-        self.device_list = []
-        deviceList = MV_CC_DEVICE_INFO_LIST()
-        tlayerType = MV_GIGE_DEVICE | MV_USB_DEVICE
-        ret = MvCamera.MV_CC_EnumDevices(tlayerType, deviceList)
-        if ret != 0:
-            return []
-
-        for i in range(deviceList.nDeviceNum):
-            device_ptr = deviceList.pDeviceInfo[i]
-            mvcc_dev_info = cast(device_ptr, POINTER(MV_CC_DEVICE_INFO)).contents
-            
-            device_info = {
-                "index": i,
-                "ptr": device_ptr,
-                "type": "GigE" if mvcc_dev_info.nTLayerType == MV_GIGE_DEVICE else "USB"
-            }
-
-            if mvcc_dev_info.nTLayerType == MV_GIGE_DEVICE:
-                model_name = "".join([chr(c) for c in mvcc_dev_info.SpecialInfo.stGigEInfo.chModelName if c != 0])
-                ip = mvcc_dev_info.SpecialInfo.stGigEInfo.nCurrentIp
-                device_info.update({
-                    "model": model_name,
-                    "ip": f"{(ip>>24)&0xFF}.{(ip>>16)&0xFF}.{(ip>>8)&0xFF}.{ip&0xFF}"
-                })
-            else:
-                model_name = "".join([chr(c) for c in mvcc_dev_info.SpecialInfo.stUsb3VInfo.chModelName if c != 0])
-                serial = "".join([chr(c) for c in mvcc_dev_info.SpecialInfo.stUsb3VInfo.chSerialNumber if c != 0])
-                device_info.update({
-                    "model": model_name,
-                    "serial": serial
-                })
-            
-            self.device_list.append(device_info)
-        
-        return self.device_list
-
-    def open_camera(self, index):
-        if index < 0 or index >= len(self.device_list):
-            raise ValueError("Invalid device index")
-            
-        self.current_device_index = index
-        device_info = self.device_list[index]
-        st_device_info = cast(device_info['ptr'], POINTER(MV_CC_DEVICE_INFO)).contents
-        
-        self.cam = MvCamera()
-        ret = self.cam.MV_CC_CreateHandle(st_device_info)
-        if ret != 0:
-            raise Exception(f"Create handle failed: {ret}")
-            
-        ret = self.cam.MV_CC_OpenDevice(MV_ACCESS_Exclusive, 0)
-        if ret != 0:
-            raise Exception(f"Open device failed: {ret}")
-            
-        # Configure default settings
-        self.cam.MV_CC_SetEnumValue("TriggerMode", MV_TRIGGER_MODE_OFF)
-        self.cam.MV_CC_SetEnumValue("AcquisitionMode", MV_ACQ_MODE_CONTINUOUS)
-        return True
-
-    def start_stream(self, websocket):
-        self.streaming = True
-        stOutFrame = MV_FRAME_OUT()
-        
-        ret = self.cam.MV_CC_StartGrabbing()
-        if ret != 0:
-            raise Exception(f"Start grabbing failed: {ret}")
-
-        while self.streaming:
-            ret = self.cam.MV_CC_GetImageBuffer(stOutFrame, 1000)
-            if ret == 0:
-                try:
-                    frame_info = stOutFrame.stFrameInfo
-                    print(f"Received frame: {frame_info.nWidth}x{frame_info.nHeight}. Pixel Type: {frame_info.enPixelType}")
-
-                    # Use SDK to convert directly to JPEG buffer
-                    stParam = MV_SAVE_IMAGE_PARAM_EX()
-                    stParam.enImageType = MV_Image_Jpeg
-                    stParam.enPixelType = frame_info.enPixelType
-                    stParam.nWidth = frame_info.nWidth
-                    stParam.nHeight = frame_info.nHeight
-                    stParam.nDataLen = frame_info.nFrameLen
-                    stParam.pData = cast(stOutFrame.pBufAddr, POINTER(c_ubyte))
-                    stParam.nJpgQuality = 80  # Adjust quality as needed
-
-                    # Allocate buffer for JPEG
-                    jpeg_buffer_size = frame_info.nWidth * frame_info.nHeight * 3 + 2048
-                    stParam.pImageBuffer = (c_ubyte * jpeg_buffer_size)()
-                    stParam.nBufferSize = jpeg_buffer_size
-
-                    # Perform conversion to JPEG
-                    ret = self.cam.MV_CC_SaveImageEx2(stParam)
-                    if ret != 0:
-                        raise Exception(f"JPEG conversion failed: 0x{self.To_hex_str(ret)}")
-
-                    # Extract JPEG data
-                    jpeg_data = bytes(stParam.pImageBuffer[:stParam.nImageLen])
-
-                    # Send through WebSocket
-                    asyncio.run_coroutine_threadsafe(
-                        self.send_frame(websocket, jpeg_data),
-                        self.loop
-                    )
-                finally:
-                    self.cam.MV_CC_FreeImageBuffer(stOutFrame)
-                        
-    async def send_frame(self, websocket, data):
-        try:
-            await websocket.send(data)
-        except Exception as e:
-            print(f"Error sending frame: {str(e)}")
-
-    def convert_to_jpeg(self, frame_out):
-        frame_info = frame_out.stFrameInfo
-        convert_param = MV_CC_PIXEL_CONVERT_PARAM()
-        convert_param.nWidth = frame_info.nWidth
-        convert_param.nHeight = frame_info.nHeight
-        convert_param.pSrcData = frame_out.pBufAddr
-        convert_param.nSrcDataLen = frame_info.nFrameLen
-        convert_param.enSrcPixelType = frame_info.enPixelType
-        convert_param.enDstPixelType = PixelType_Gvsp_RGB8_Packed
-        
-        buffer_size = frame_info.nWidth * frame_info.nHeight * 3
-        convert_param.pDstBuffer = (c_ubyte * buffer_size)()
-        convert_param.nDstBufferSize = buffer_size
-        
-        ret = self.cam.MV_CC_ConvertPixelType(convert_param)
-        if ret != 0:
-            raise Exception("Pixel conversion failed")
-        rgb_data = np.frombuffer(convert_param.pDstBuffer, dtype=np.uint8)
-        rgb_data = rgb_data.reshape((frame_info.nHeight, frame_info.nWidth, 3))
-        _, jpeg_buffer = cv2.imencode('.jpg', rgb_data)
-        return jpeg_buffer.tobytes()
-
-    def stop_stream(self):
-        print("Stop Streaming")
-        self.streaming = False
-        self.cam.MV_CC_StopGrabbing()
-
-    def close_camera(self):
-        if self.cam:
-            print("Camera closed")
-            self.stop_stream()
-            self.cam.MV_CC_CloseDevice()
-            self.cam.MV_CC_DestroyHandle()
-            self.cam = None
+from camera_backend import create_camera
+from camera_stream import CameraStream
+from frame_envelope import negotiate as negotiate_envelope
+from rate_control import controller_from_command
+from event_recorder import (
+    POST_TRIGGER_SECONDS, PRE_TRIGGER_BUDGET, PRE_TRIGGER_SECONDS, PreTriggerRecorder,
+    check_budget)
+from metrics import metrics_port, serve_metrics
+
+# Camera SDK to stream from: hikvision, ids or synthetic
+CAMERA_BACKEND = os.environ.get("CAMERA_BACKEND", "hikvision")
+JPEG_QUALITY = 80
+METRICS_PORT = metrics_port(9109)
 
 class WebSocketServer:
-    def __init__(self):
-        self.cam_manager = CameraManager()
+    def __init__(self, backend=CAMERA_BACKEND, camera_options=None, stream_options=None):
+        self.camera = create_camera(backend, **(camera_options or {}))
+        self.stream_options = {"quality": JPEG_QUALITY, **(stream_options or {})}
+        self.stream = None
         self.active_connections = set()
+        # Held around stream start, stop and restarts, so a restart cannot
+        # bring back a stream stopped meanwhile
+        self.stream_lock = asyncio.Lock()
 
     async def handler(self, websocket):
         self.active_connections.add(websocket)
         try:
-            # Pass the main event loop to camera manager
-            self.cam_manager.set_event_loop(asyncio.get_running_loop())
             async for message in websocket:
                 await self.handle_message(websocket, message)
         finally:
             self.active_connections.remove(websocket)
+            await self.leave_stream(websocket)
 
     async def handle_message(self, websocket, message):
         try:
@@ -188,7 +41,7 @@ class WebSocketServer:
             command = msg.get('command')
             
             if command == 'get_devices':
-                devices = self.cam_manager.enum_devices()
+                devices = self.camera.list_devices()
                 response = {
                     "message": f"Found {len(devices)} devices",
                     "devices": [{"index": d["index"], "type": d["type"], "model": d["model"], "serial": d["serial"]} for d in devices]
@@ -196,27 +49,138 @@ class WebSocketServer:
                 await websocket.send(json.dumps(response))
                 
             elif command == 'start_stream':
-                index = msg.get('index', 0)
-                if index >= len(self.cam_manager.device_list):
-                    raise ValueError("Invalid device index")
-                
-                self.cam_manager.open_camera(index)
-                threading.Thread(
-                    target=self.cam_manager.start_stream,
-                    args=(websocket,),
-                    daemon=True
-                ).start()
-                await websocket.send(json.dumps({"status": "streaming_started"}))
+                async with self.stream_lock:
+                    if self.stream is None:
+                        if not self.camera.is_open:
+                            self.camera.open(msg.get('index', 0))
+                        # Frames go through a latest-frame slot and bounded
+                        # per-client queues: a slow client only drops frames,
+                        # pending frames never pile up in memory
+                        self.stream = CameraStream(
+                            self.camera, asyncio.get_running_loop(), **self.stream_options)
+                        self.stream.start()
+                    envelope = negotiate_envelope(msg.get('envelope'))
+                    controller = controller_from_command(msg)
+                    self.stream.subscribe(websocket, envelope is not None, controller)
+                response = {"status": "streaming_started"}
+                if envelope:
+                    response["envelope"] = envelope
+                if controller is not None:
+                    response["adaptive"] = True
+                await websocket.send(json.dumps(response))
                 
             elif command == 'stop_stream':
-                self.cam_manager.stop_stream()
-                # self.cam_manager.close_camera()
+                print("Stop Streaming")
+                # Other viewers keep the stream running
+                await self.leave_stream(websocket)
+                # self.camera.close()
                 await websocket.send(json.dumps({"status": "streaming_stopped"}))
+
+            elif command == 'get_status':
+                await websocket.send(json.dumps(self.status()))
+
+            elif command == 'set_roi':
+                roi = None
+                if msg.get('width') and msg.get('height'):
+                    roi = (int(msg.get('x', 0)), int(msg.get('y', 0)),
+                           int(msg['width']), int(msg['height']))
+                async with self.stream_lock:
+                    if self.stream is not None:
+                        # The restart joins the pipeline threads, off the event loop
+                        applied = await asyncio.to_thread(self.stream.set_roi, roi)
+                    else:
+                        applied = self.camera.set_roi(roi)
+                await websocket.send(json.dumps({"roi": applied}))
+
+            elif command == 'set_trigger':
+                args = (msg.get('mode', 'off'), msg.get('source'), msg.get('activation'))
+                async with self.stream_lock:
+                    if self.stream is not None:
+                        applied = await asyncio.to_thread(self.stream.set_trigger, *args)
+                    else:
+                        applied = self.camera.set_trigger(*args)
+                await websocket.send(json.dumps({"trigger": applied}))
+
+            elif command == 'trigger':
+                self.camera.trigger()
+                await websocket.send(json.dumps({"status": "triggered"}))
+
+            elif command == 'arm_recorder':
+                # Keep the last frames in a pre-trigger ring of budget_mb MB
+                budget = int(msg['budget_mb'] * 1024 * 1024) if msg.get('budget_mb') else PRE_TRIGGER_BUDGET
+                check_budget(budget, self.camera.get_parameter('Width'),
+                             self.camera.get_parameter('Height'),
+                             self.camera.get_parameter('PixelFormat'))
+                await self.close_recorder()
+                self.camera.raw_recorder = PreTriggerRecorder(
+                    budget, name=self.camera.serial or self.camera.name)
+                await websocket.send(json.dumps({"recorder": self.camera.raw_recorder.stats()}))
+
+            elif command == 'save_event':
+                if self.camera.raw_recorder is None:
+                    raise RuntimeError("Recorder not armed")
+                loop = asyncio.get_running_loop()
+
+                def on_saved(info):
+                    asyncio.run_coroutine_threadsafe(
+                        websocket.send(json.dumps({"event_saved": info})), loop)
+
+                event = self.camera.raw_recorder.save_event(
+                    msg.get('pre', PRE_TRIGGER_SECONDS), msg.get('post', POST_TRIGGER_SECONDS),
+                    on_saved)
+                await websocket.send(json.dumps({"event": event}))
+
+            elif command == 'disarm_recorder':
+                await self.close_recorder()
+                await websocket.send(json.dumps({"status": "recorder_disarmed"}))
+
+            elif command == 'get_stats':
+                await websocket.send(json.dumps(
+                    {"streaming": self.stream is not None, "cameras": self.stream_stats()}))
                 
         except Exception as e:
             error_msg = {"error": str(e)}
             await websocket.send(json.dumps(error_msg))
 
+    async def leave_stream(self, websocket):
+        """
+        Unsubscribes `websocket` and stops acquisition once no viewer is left
+        """
+        async with self.stream_lock:
+            if self.stream is None:
+                return
+            self.stream.unsubscribe(websocket)
+            if self.stream.subscriber_count() == 0:
+                stream, self.stream = self.stream, None
+                # Joins the grab and encoder threads, off the event loop
+                await asyncio.to_thread(stream.stop)
+
+    async def close_recorder(self):
+        recorder = self.camera.raw_recorder
+        if recorder is not None:
+            self.camera.raw_recorder = None
+            # Waits for the event being written, off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, recorder.close)
+
+    def status(self):
+        if self.stream is None:
+            return {"streaming": False, "frames_sent": 0, "frames_dropped": 0}
+        # Totals since the stream started, viewers that left included
+        sent, dropped = self.stream.broadcaster.totals()
+        return {
+            "streaming": True,
+            "frames_sent": sent,
+            "frames_dropped": dropped + self.camera.stats()["dropped"],
+        }
+
+    def stream_stats(self):
+        """
+        Returns {camera id: CameraStream.stats()} for the running stream
+        """
+        if self.stream is None:
+            return {}
+        return {self.camera.serial or self.camera.name: self.stream.stats()}
+
 # async def main():
 #     server = WebSocketServer()
 #     async with websockets.serve(server.handler, "localhost", 8765):
@@ -226,6 +190,7 @@ class WebSocketServer:
 if __name__ == "__main__":
     async def main():
         server = WebSocketServer()
+        await serve_metrics(server.stream_stats, port=METRICS_PORT)
         async with websockets.serve(server.handler, "localhost", 8765):
             print("WebSocket server started on ws://localhost:8765")
             await asyncio.Future()
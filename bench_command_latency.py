@@ -0,0 +1,121 @@
+"""
+Measures websocket command round-trip time while frames are streaming.
+
+A fake producer thread publishes JPEG-sized payloads into a LatestFrameSlot
+with an occasional stall (like a slow SDK wait), the server forwards them to
+the client and answers `ping` commands in between. With a blocking handoff
+the pings wait for the producer; with the slot they stay in the low ms.
+
+Usage: python bench_command_latency.py [--fps 60] [--pings 200]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+
+import websockets
+
+from streaming import LatestFrameSlot
+
+FRAME_SIZE = 400 * 1024
+
+
+class FakeStreamServer:
+    def __init__(self, fps, stall_every, stall_ms):
+        self.fps = fps
+        self.stall_every = stall_every
+        self.stall_ms = stall_ms
+        self.streaming = False
+        self.frame_slot = None
+
+    async def handler(self, websocket):
+        async for message in websocket:
+            data = json.loads(message)
+            command = data.get("command")
+            if command == "start_stream":
+                self.streaming = True
+                self.frame_slot = LatestFrameSlot(asyncio.get_running_loop())
+                threading.Thread(target=self.frame_producer, daemon=True).start()
+                asyncio.create_task(self.frame_consumer(websocket))
+                await websocket.send(json.dumps({"message": "Stream started"}))
+            elif command == "stop_stream":
+                self.streaming = False
+                self.frame_slot.close()
+                await websocket.send(json.dumps({"message": "Stream stopped"}))
+            elif command == "ping":
+                await websocket.send(json.dumps({"pong": data.get("t")}))
+
+    def frame_producer(self):
+        payload = os.urandom(FRAME_SIZE)
+        interval = 1.0 / self.fps
+        count = 0
+        while self.streaming:
+            count += 1
+            if self.stall_every and count % self.stall_every == 0:
+                time.sleep(self.stall_ms / 1000)
+            else:
+                time.sleep(interval)
+            self.frame_slot.publish(payload)
+
+    async def frame_consumer(self, websocket):
+        frame_slot = self.frame_slot
+        while self.streaming:
+            frame = await frame_slot.get()
+            if frame is None:
+                break
+            await websocket.send(frame)
+
+
+async def run(args):
+    server = FakeStreamServer(args.fps, args.stall_every, args.stall_ms)
+    async with websockets.serve(server.handler, "localhost", 0, compression=None) as ws_server:
+        port = ws_server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://localhost:{port}", compression=None,
+                                      max_size=None) as client:
+            await client.send(json.dumps({"command": "start_stream"}))
+            frames = 0
+            round_trips = []
+            pending = None
+            deadline = time.perf_counter() + args.timeout
+            while len(round_trips) < args.pings and time.perf_counter() < deadline:
+                if pending is None:
+                    pending = time.perf_counter()
+                    await client.send(json.dumps({"command": "ping", "t": pending}))
+                message = await client.recv()
+                if isinstance(message, bytes):
+                    frames += 1
+                    continue
+                data = json.loads(message)
+                if "pong" in data:
+                    round_trips.append((time.perf_counter() - data["pong"]) * 1000)
+                    pending = None
+                    await asyncio.sleep(args.interval / 1000)
+            await client.send(json.dumps({"command": "stop_stream"}))
+            while isinstance(await client.recv(), bytes):
+                pass
+
+    round_trips.sort()
+    print(f"frames received: {frames}")
+    print(f"pings: {len(round_trips)}")
+    if round_trips:
+        print(f"rtt p50: {statistics.median(round_trips):.2f} ms")
+        print(f"rtt p95: {round_trips[int(len(round_trips) * 0.95) - 1]:.2f} ms")
+        print(f"rtt max: {round_trips[-1]:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--pings", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=5, help="ms between pings")
+    parser.add_argument("--stall-every", type=int, default=30, help="stall every N frames")
+    parser.add_argument("--stall-ms", type=float, default=250)
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares JPEG encoders on synthetic BGR frames at typical sensor sizes.
+
+  opencv            cv2.imencode(...).tobytes(), the old per-frame path
+  opencv-view       JpegEncoder's OpenCV fallback (no tobytes copy)
+  turbojpeg         TurboJPEG.encode() returning fresh bytes
+  turbojpeg-reuse   JpegEncoder with preallocated output buffers
+
+TurboJPEG rows are skipped when libturbojpeg cannot be loaded (set
+TURBOJPEG_LIB to its path).
+
+Usage: python bench_jpeg.py [--frames 100] [--quality 75]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from jpeg_encoder import JpegEncoder, load_turbojpeg, TURBOJPEG_LIB, TJSAMP_420
+
+SENSOR_SIZES = [(1280, 1024), (1936, 1096), (2448, 2048), (4096, 3000)]
+
+
+def synthetic_frame(width, height, seed=0):
+    """
+    Smooth gradient with some noise, compresses roughly like a real scene
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = (x + y) / 2
+    frame[..., 1] = x
+    frame[..., 2] = y
+    noise = rng.integers(0, 16, size=frame.shape, dtype=np.uint8)
+    return cv2.add(frame, noise)
+
+
+def measure(encode, frame, count):
+    encode(frame)  # warm-up
+    timings = []
+    size = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        data = encode(frame)
+        timings.append((time.perf_counter() - started) * 1000)
+        size = len(data)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95) - 1], size
+
+
+def encoders(quality, turbojpeg):
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    yield "opencv", lambda frame: cv2.imencode('.jpg', frame, params)[1].tobytes()
+    yield "opencv-view", JpegEncoder(quality, use_turbojpeg=False).encode
+    if turbojpeg is None:
+        return
+    yield "turbojpeg", lambda frame: turbojpeg.encode(
+        frame, quality=quality, jpeg_subsample=TJSAMP_420)
+    yield "turbojpeg-reuse", JpegEncoder(quality).encode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--quality", type=int, default=75)
+    args = parser.parse_args()
+
+    turbojpeg = load_turbojpeg(TURBOJPEG_LIB)
+    if turbojpeg is None:
+        print("libturbojpeg not found, skipping TurboJPEG encoders")
+
+    print(f"{'size':>10} {'encoder':>16} {'p50 ms':>8} {'p95 ms':>8} {'fps':>7} {'KiB':>7}")
+    for width, height in SENSOR_SIZES:
+        frame = synthetic_frame(width, height)
+        for name, encode in encoders(args.quality, turbojpeg):
+            p50, p95, size = measure(encode, frame, args.frames)
+            print(f"{width:>5}x{height:<4} {name:>16} {p50:8.2f} {p95:8.2f} "
+                  f"{1000 / p50:7.1f} {size / 1024:7.0f}")
+
+
+if __name__ == "__main__":
+    main()
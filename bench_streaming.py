@@ -0,0 +1,265 @@
+"""
+End-to-end latency and throughput of the websocket servers.
+
+Each server runs in-process on the synthetic camera backend, N local
+websocket clients subscribe to its stream with the frame envelope, whose
+header carries the frame id and the host time the frame was grabbed at, so
+the client side measures capture-to-receive latency and sees every frame id
+it missed. One run is made per combination of server, camera resolution,
+JPEG quality, camera count and client count; the report holds latency
+percentiles, delivered fps per client and in total, the share of sensor
+frames a client never received, process CPU and per-stage pipeline time.
+
+With --cameras N the server streams N simulated cameras at once, each to
+its own set of clients, to show how throughput scales with cameras. Only
+the config server manages several cameras.
+
+Results are printed as a table and written as JSON, so runs before and
+after a change can be diffed.
+
+Usage: python bench_streaming.py [--servers config resize hikvision]
+       [--resolutions 1280x1024 1936x1096] [--qualities 75] [--clients 1 4]
+       [--cameras 1 4] [--duration 5] [--output bench_streaming.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import time
+
+import websockets
+
+from frame_envelope import HEADER_SIZE, unpack_header
+
+# Servers that stream several cameras at once
+MULTI_CAMERA_SERVERS = {"config"}
+# Server name -> (module, simulated SDK the real camera behind it uses)
+SERVERS = {
+    "config": ("config_websocket", "ids"),
+    "resize": ("ids_socket_resize", "ids"),
+    "hikvision": ("backend", "mvs"),
+}
+
+
+def parse_resolution(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class BenchClient:
+    """
+    Websocket viewer recording the latency of every frame received in the
+    measurement window
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.websocket = None
+        self.frames = 0
+        self.bytes = 0
+        self.latencies_ms = []
+        self.first_frame_id = None
+        self.last_frame_id = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.url, compression=None, max_size=None)
+
+    async def command(self, command, **fields):
+        """Sends a command and returns its JSON reply, skipping frames"""
+        await self.websocket.send(json.dumps({"command": command, **fields}))
+        while True:
+            message = await self.websocket.recv()
+            if not isinstance(message, bytes):
+                return json.loads(message)
+
+    async def receive(self, measure_from, measure_until):
+        while True:
+            remaining = measure_until - time.perf_counter()
+            if remaining <= 0:
+                return
+            try:
+                message = await asyncio.wait_for(self.websocket.recv(), remaining)
+            except asyncio.TimeoutError:
+                return
+            received_ns = time.time_ns()
+            if not isinstance(message, bytes) or time.perf_counter() < measure_from:
+                continue
+            header = unpack_header(message)
+            if self.first_frame_id is None:
+                self.first_frame_id = header.frame_id
+            self.last_frame_id = header.frame_id
+            self.frames += 1
+            self.bytes += len(message) - HEADER_SIZE
+            self.latencies_ms.append((received_ns - header.host_timestamp) / 1e6)
+
+    @property
+    def missed(self):
+        # Sensor frames between the first and last one received that never
+        # arrived, whether the camera, the pipeline or the queue dropped them
+        if self.first_frame_id is None:
+            return 0
+        return self.last_frame_id - self.first_frame_id + 1 - self.frames
+
+    async def close(self):
+        await self.websocket.close()
+
+
+async def run_case(server_name, width, height, quality, clients, cameras, args):
+    module_name, sdk = SERVERS[server_name]
+    module = importlib.import_module(module_name)
+    server = module.WebSocketServer(
+        backend="synthetic",
+        camera_options={"width": width, "height": height, "fps": args.fps,
+                        "seed": args.seed, "sdk": sdk, "device_count": cameras},
+        stream_options={"quality": quality})
+
+    async with websockets.serve(server.handler, "localhost", 0, compression=None,
+                                max_size=None) as ws_server:
+        port = ws_server.sockets[0].getsockname()[1]
+        # `clients` viewers per camera
+        viewers = [BenchClient(f"ws://localhost:{port}") for _ in range(clients * cameras)]
+        for number, viewer in enumerate(viewers):
+            await viewer.connect()
+            reply = await viewer.command("start_stream", index=number // clients, envelope=True)
+            if "error" in reply:
+                raise RuntimeError(f"{server_name}: {reply['error']}")
+            if "envelope" not in reply:
+                raise RuntimeError(f"{server_name} did not accept the frame envelope")
+
+        measure_from = time.perf_counter() + args.warmup
+        measure_until = measure_from + args.duration
+        receiving = asyncio.gather(*(viewer.receive(measure_from, measure_until)
+                                     for viewer in viewers))
+        await asyncio.sleep(args.warmup)
+        cpu_before = time.process_time()
+        await receiving
+        cpu_seconds = time.process_time() - cpu_before
+        camera_stats = list(server.stream_stats().values())
+        if len(camera_stats) != cameras:
+            raise RuntimeError(f"{server_name} streamed {len(camera_stats)} of {cameras} cameras")
+        stream_stats = camera_stats[0]
+
+        for viewer in viewers:
+            await viewer.command("stop_stream")
+            await viewer.close()
+        # The Hikvision server keeps its camera open between streams
+        camera = getattr(server, "camera", None)
+        if camera is not None:
+            camera.close()
+
+    latencies = sorted(latency for viewer in viewers for latency in viewer.latencies_ms)
+    received = sum(viewer.frames for viewer in viewers)
+    expected = received + sum(viewer.missed for viewer in viewers)
+    pipelines = [stats["pipeline"] for stats in camera_stats]
+    return {
+        "server": server_name,
+        "width": width,
+        "height": height,
+        "quality": quality,
+        "cameras": cameras,
+        "clients": clients,
+        "frames": received,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+        "fps_per_client": received / len(viewers) / args.duration,
+        "fps_total": received / args.duration,
+        "published_fps_per_camera": [
+            pipeline["published_fps"] for pipeline in pipelines],
+        "drop_rate": 1 - received / expected if expected else 0.0,
+        "kib_per_frame": sum(v.bytes for v in viewers) / received / 1024 if received else 0.0,
+        # Clients run in the same process, their share is included
+        "process_cpu_percent": cpu_seconds / args.duration * 100,
+        # Averaged over cameras, latencies of the first camera
+        "stages": {
+            stage: {
+                key: sum(pipeline[stage][key] for pipeline in pipelines) / cameras
+                for key in ("ms_per_frame", "cpu_ms_per_frame", "utilization")
+            } for stage in ("acquire", "encode")
+        },
+        "stage_latency_ms": stream_stats["stages"],
+        "client_stage_latency_ms": [
+            subscriber["stages"] for subscriber in stream_stats["stream"]["subscribers"]],
+        "sent": sum(stats["stream"]["sent"] for stats in camera_stats),
+        "dropped": sum(stats["stream"]["dropped"] for stats in camera_stats),
+    }
+
+
+def print_result(result):
+    latency, stages = result["latency_ms"], result["stages"]
+    print(f"{result['server']:>9} {result['width']:>5}x{result['height']:<5} "
+          f"q{result['quality']:<3} {result['cameras']:>2} cam {result['clients']:>2} clients | "
+          f"p50 {latency['p50']:6.1f} p95 {latency['p95']:6.1f} p99 {latency['p99']:6.1f} ms | "
+          f"{result['fps_per_client']:6.1f} fps/client {result['fps_total']:6.1f} total  drop {result['drop_rate'] * 100:5.1f}% | "
+          f"cpu {result['process_cpu_percent']:5.0f}% | "
+          f"acquire {stages['acquire']['cpu_ms_per_frame']:.1f} "
+          f"encode {stages['encode']['cpu_ms_per_frame']:.1f} cpu ms/frame")
+
+
+async def run(args):
+    results = []
+    for server_name in args.servers:
+        for width, height in args.resolutions:
+            for quality in args.qualities:
+                for cameras in args.cameras:
+                    if cameras > 1 and server_name not in MULTI_CAMERA_SERVERS:
+                        continue
+                    for clients in args.clients:
+                        result = await run_case(
+                            server_name, width, height, quality, clients, cameras, args)
+                        print_result(result)
+                        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", nargs="+", choices=sorted(SERVERS),
+                        default=["config", "resize", "hikvision"])
+    parser.add_argument("--resolutions", nargs="+", type=parse_resolution,
+                        default=[(1280, 1024), (1936, 1096)], help="WIDTHxHEIGHT")
+    parser.add_argument("--qualities", nargs="+", type=int, default=[75])
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 4],
+                        help="clients per camera")
+    parser.add_argument("--cameras", nargs="+", type=int, default=[1],
+                        help="simulated cameras streamed at once")
+    parser.add_argument("--fps", type=float, default=30, help="simulated sensor frame rate")
+    parser.add_argument("--duration", type=float, default=5, help="seconds measured per run")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds skipped per run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_streaming.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "fps": args.fps,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+import importlib
+import threading
+import time
+from collections import deque, namedtuple
+
+from stage_timing import StageTimers
+
+# Backend name -> (module, class). Modules are imported on first use so a
+# machine without one of the vendor SDKs can still run the others
+BACKENDS = {
+    "ids": ("ids_backend", "IdsCamera"),
+    "hikvision": ("hikvision_backend", "HikvisionCamera"),
+    "synthetic": ("synthetic_backend", "SyntheticCamera"),
+}
+
+# Parameters the configuration commands report by default
+COMMON_PARAMETERS = [
+    "ExposureTime", "Gain", "AcquisitionFrameRate",
+    "Width", "Height", "PixelFormat", "Gamma", "BlackLevel",
+]
+
+# Parameters that change the payload size, writable only while stopped
+# (TLParamsLocked on GenICam transport layers)
+LOCKED_PARAMETERS = {
+    "Width", "Height", "OffsetX", "OffsetY", "PixelFormat",
+    "BinningHorizontal", "BinningVertical", "DecimationHorizontal", "DecimationVertical",
+}
+# Order in which set_parameters applies a batch: whatever changes the range
+# of another parameter goes before it (pixel format and binning limit the
+# size, the size limits the offsets, auto modes must be off before their
+# value is written, the exposure limits the frame rate). Parameters not
+# listed follow in the order given.
+PARAMETER_ORDER = [
+    "PixelFormat",
+    "BinningHorizontal", "BinningVertical", "DecimationHorizontal", "DecimationVertical",
+    "Width", "Height", "OffsetX", "OffsetY",
+    "ExposureAuto", "ExposureTime", "AcquisitionFrameRateEnable", "AcquisitionFrameRate",
+    "GainAuto", "Gain",
+]
+
+# Parameters whose range follows other settings (the frame rate limit
+# follows the exposure time, offsets follow the size, ...). Their range is
+# re-read on every snapshot, the rest is described once per camera.
+VOLATILE_RANGES = {
+    "AcquisitionFrameRate", "ExposureTime", "Width", "Height", "OffsetX", "OffsetY",
+}
+
+# Static description of a parameter. `type` is float, int, enum, bool or
+# command; `access` one of rw, ro, wo, na; `entries` the enum values.
+ParameterDescriptor = namedtuple(
+    "ParameterDescriptor", "name type minimum maximum increment unit access entries")
+
+# Acquisition modes for set_trigger. "hardware" waits for a pulse on an I/O
+# line (e.g. from the welding controller), "software" for `trigger()`
+TRIGGER_MODES = ("off", "software", "hardware")
+DEFAULT_TRIGGER_LINE = "Line0"
+DEFAULT_TRIGGER_ACTIVATION = "RisingEdge"
+# Software triggers without a frame after this long are given up on
+TRIGGER_TIMEOUT = 5.0
+
+# Camera frame counter and device clock of a grabbed frame
+FrameInfo = namedtuple("FrameInfo", "frame_id device_timestamp")
+
+
+def order_parameters(names):
+    """
+    Sorts parameter names by PARAMETER_ORDER, keeping the given order for
+    the rest
+    """
+    rank = {name: index for index, name in enumerate(PARAMETER_ORDER)}
+    return sorted(names, key=lambda name: rank.get(name, len(rank)))
+
+
+class GrabTimeout(Exception):
+    """
+    No frame arrived within the requested timeout
+    """
+
+
+class AcquisitionStats:
+    """
+    Frame, timeout and drop counters of one camera. `dropped` counts frames
+    the camera or transport layer produced but that never reached `grab`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.frames = 0
+            self.timeouts = 0
+            self.errors = 0
+            self.dropped = 0
+            self.started_at = time.perf_counter()
+
+    def record_frame(self):
+        with self._lock:
+            self.frames += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started_at
+            return {
+                "frames": self.frames,
+                "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "dropped": self.dropped,
+            }
+
+
+class CameraBackend:
+    """
+    Acquisition interface shared by every camera SDK.
+
+    Lifecycle: `open(index)` -> `start(...)` -> `grab()` ... -> `stop()` ->
+    `close()`. `start` may be called again after `stop`.
+
+    `grab` returns a BGR8 frame written into a preallocated ring of
+    `slots` arrays; it stays valid until the ring wraps around to it, so a
+    consumer holding up to N frames at a time needs at least N + 1 slots.
+    Timeouts raise GrabTimeout. After each grab `last_frame_info` holds the
+    FrameInfo of the returned frame (read it on the grabbing thread).
+    Backends time the wait for a buffer and the conversion to BGR into
+    `stage_timers`.
+
+    Parameters use GenICam feature names (ExposureTime, Gain, Width, ...).
+    `parameter_snapshot` reports values and ranges from descriptors that
+    are read from the node map once per camera and then cached.
+
+    `set_trigger` switches between free-running and triggered acquisition;
+    in software trigger mode `trigger()` fires a frame and the time until it
+    is grabbed is recorded as the "trigger_to_frame" stage.
+
+    `set_roi` restricts acquisition to a region of the sensor. Backends that
+    can program OffsetX/OffsetY/Width/Height override `_set_sensor_roi`;
+    otherwise frames are cropped in software after conversion.
+
+    With a `raw_recorder` attached, every frame is also copied to it before
+    conversion, at full sensor ROI and never cropped.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.model = None
+        self.serial = None
+        self.target_size = None
+        self.acquisition_stats = AcquisitionStats()
+        self.stage_timers = StageTimers()
+        self.last_frame_info = None
+        self.roi = None             # Applied (x, y, width, height), None for full frame
+        self.software_roi = None    # Same, when it is cropped on the host
+        self.trigger_mode = "off"
+        self._pending_triggers = deque()
+        # PreTriggerRecorder fed with every raw frame, see event_recorder
+        self.raw_recorder = None
+        self._descriptors = {}      # Name -> ParameterDescriptor, None if absent
+
+    def list_devices(self):
+        """
+        Returns one dict per attached device with at least index, model,
+        serial and type
+        """
+        raise NotImplementedError
+
+    def open(self, index=0):
+        raise NotImplementedError
+
+    def start(self, target_size=None, slots=3):
+        """
+        Starts acquisition. `target_size` (width, height) lets the backend
+        reduce resolution on the camera; frames can still be larger than it.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    @property
+    def is_open(self):
+        raise NotImplementedError
+
+    @property
+    def is_running(self):
+        raise NotImplementedError
+
+    def grab(self, timeout_ms=1000):
+        raise NotImplementedError
+
+    def set_trigger(self, mode, source=None, activation=None):
+        """
+        Selects free-running ("off"), "software" or "hardware" triggered
+        acquisition. Hardware triggers come from `source` (default Line0) on
+        `activation` (default RisingEdge). Only while stopped. Returns the
+        applied settings as a dict.
+        """
+        if mode not in TRIGGER_MODES:
+            raise ValueError(f"Unknown trigger mode: {mode}")
+        if not self.is_open:
+            raise RuntimeError("Camera not open")
+        if self.is_running:
+            raise RuntimeError("Stop acquisition before changing the trigger mode")
+        if mode == "hardware":
+            source = source or DEFAULT_TRIGGER_LINE
+            activation = activation or DEFAULT_TRIGGER_ACTIVATION
+        else:
+            source = "Software" if mode == "software" else None
+            activation = None
+        self._apply_trigger(mode, source, activation)
+        self.trigger_mode = mode
+        self._pending_triggers.clear()
+        applied = {"mode": mode}
+        if source is not None:
+            applied["source"] = source
+        if activation is not None:
+            applied["activation"] = activation
+        return applied
+
+    def _apply_trigger(self, mode, source, activation):
+        """
+        Programs TriggerMode/TriggerSource/TriggerActivation on the camera
+        """
+        raise NotImplementedError("Trigger not supported")
+
+    def trigger(self):
+        """
+        Fires a software trigger
+        """
+        if self.trigger_mode != "software":
+            raise RuntimeError("Camera is not in software trigger mode")
+        if not self.is_running:
+            raise RuntimeError("Acquisition not running")
+        self._pending_triggers.append(time.perf_counter())
+        self._send_software_trigger()
+
+    def _send_software_trigger(self):
+        raise NotImplementedError
+
+    def _record_trigger_latency(self):
+        """
+        Matches a grabbed frame to the oldest pending software trigger.
+        Call from `grab` after every frame.
+        """
+        now = time.perf_counter()
+        pending = self._pending_triggers
+        # A trigger the camera ignored (e.g. while still exposing) never
+        # gets a frame, do not let it shift every later match
+        while pending and now - pending[0] > TRIGGER_TIMEOUT:
+            pending.popleft()
+        if pending:
+            self.stage_timers.record("trigger_to_frame", now - pending.popleft())
+
+    def _record_raw(self, raw, width, height, pixel_format, frame_info):
+        """
+        Hands an unconverted frame (flat uint8 view of the SDK buffer) to
+        the raw recorder, if one is attached. Call from `grab` before the
+        buffer is released.
+        """
+        recorder = self.raw_recorder
+        if recorder is None:
+            return
+        try:
+            recorder.push(raw, width, height, pixel_format, frame_info)
+        except Exception as e:
+            # Recording must never stop the stream, a failing recorder is
+            # detached instead
+            print(f"Raw recording error, recorder detached: {str(e)}")
+            self.raw_recorder = None
+
+    def set_roi(self, roi):
+        """
+        Restricts acquisition to roi = (x, y, width, height) in sensor pixels,
+        or back to the full sensor for None. Only while stopped. A sensor ROI
+        is aligned to the camera's increments, so the applied region can be
+        slightly smaller; it is returned as a dict with x, y, width, height
+        and mode ("sensor", "software" or "full").
+        """
+        if not self.is_open:
+            raise RuntimeError("Camera not open")
+        if self.is_running:
+            raise RuntimeError("Stop acquisition before changing the ROI")
+        self.software_roi = None
+        if roi is None:
+            self._reset_sensor_roi()
+            self.roi = None
+            return {"mode": "full"}
+        try:
+            applied = self._set_sensor_roi(*roi)
+            mode = "sensor"
+        except Exception as e:
+            print(f"Sensor ROI not available, cropping in software: {str(e)}")
+            self._reset_sensor_roi()
+            applied = self.software_roi = tuple(roi)
+            mode = "software"
+        self.roi = applied
+        x, y, width, height = applied
+        return {"x": x, "y": y, "width": width, "height": height, "mode": mode}
+
+    def _set_sensor_roi(self, x, y, width, height):
+        """
+        Programs the ROI on the camera and returns the applied
+        (x, y, width, height). Raises when the camera cannot do it.
+        """
+        raise NotImplementedError("Sensor ROI not supported")
+
+    def _reset_sensor_roi(self):
+        pass
+
+    def _crop(self, frame):
+        """
+        Applies the software ROI to a grabbed frame
+        """
+        if self.software_roi is None:
+            return frame
+        x, y, width, height = self.software_roi
+        frame = frame[y:y + height, x:x + width]
+        self.height, self.width = frame.shape[:2]
+        return frame
+
+    def get_parameter(self, name):
+        """
+        Returns the current value, raises KeyError for unknown parameters
+        """
+        raise NotImplementedError
+
+    def get_parameter_range(self, name):
+        """
+        Returns (minimum, maximum), raises KeyError for parameters without one
+        """
+        raise NotImplementedError
+
+    def set_parameter(self, name, value):
+        """
+        Sets a parameter, clamping numbers to the valid range. Returns True
+        on success.
+        """
+        try:
+            self._write_parameter(name, value)
+            return True
+        except Exception as e:
+            print(f"Error setting {name}: {str(e)}")
+            return False
+
+    def _write_parameter(self, name, value):
+        """
+        Writes one parameter, clamping numbers to the valid range. Raises on
+        failure.
+        """
+        raise NotImplementedError
+
+    def set_parameters(self, values):
+        """
+        Applies {name: value} in dependency order (see PARAMETER_ORDER) and
+        returns {name: {"ok", "value"[, "error"]}}. Values are read back
+        after the whole batch, so they show the clamped and rounded result
+        and any later parameter pulling an earlier one down.
+
+        When the size changes the offsets are moved to their minimum first,
+        so the new size fits, and set again afterwards: to the requested
+        value or, if none was given, back to where they were.
+        """
+        requested = list(values)
+        values = dict(values)
+        errors = {}
+        if "Width" in values or "Height" in values:
+            for name in ("OffsetX", "OffsetY"):
+                if name in values:
+                    continue
+                try:
+                    values[name] = self.get_parameter(name)
+                except Exception:
+                    continue
+            for name in ("OffsetX", "OffsetY"):
+                if name in values:
+                    try:
+                        self._write_parameter(name, 0)
+                    except Exception as e:
+                        errors[name] = str(e)
+        for name in order_parameters(values):
+            try:
+                self._write_parameter(name, values[name])
+                errors.pop(name, None)
+            except Exception as e:
+                errors[name] = str(e)
+        results = {}
+        for name in requested:
+            result = {"ok": name not in errors}
+            try:
+                result["value"] = self.get_parameter(name)
+            except Exception:
+                result["value"] = None
+            if name in errors:
+                result["error"] = errors[name]
+            results[name] = result
+        return results
+
+    def describe_parameter(self, name):
+        """
+        Reads the ParameterDescriptor of `name` from the camera, raises
+        KeyError for unknown parameters
+        """
+        raise NotImplementedError
+
+    def clear_parameter_cache(self):
+        """
+        Forgets the cached descriptors, call when another device is opened
+        """
+        self._descriptors.clear()
+
+    def parameter_descriptors(self, names=COMMON_PARAMETERS):
+        """
+        Returns {name: ParameterDescriptor} for the parameters the camera
+        has, describing each one only the first time it is asked for
+        """
+        descriptors = {}
+        for name in names:
+            if name not in self._descriptors:
+                try:
+                    self._descriptors[name] = self.describe_parameter(name)
+                except KeyError:
+                    self._descriptors[name] = None
+            if self._descriptors[name] is not None:
+                descriptors[name] = self._descriptors[name]
+        return descriptors
+
+    def parameter_snapshot(self, names=COMMON_PARAMETERS):
+        """
+        Returns {name: {type, value, min, max, inc, unit, writable, entries}}
+        in one pass. Only values and the ranges in VOLATILE_RANGES are read
+        from the camera, everything else comes from the descriptor cache.
+        A value that cannot be read is reported as None with an "error".
+        """
+        snapshot = {}
+        for name, descriptor in self.parameter_descriptors(names).items():
+            entry = {"type": descriptor.type, "unit": descriptor.unit}
+            minimum, maximum = descriptor.minimum, descriptor.maximum
+            try:
+                entry["value"] = self.get_parameter(name)
+                if name in VOLATILE_RANGES and minimum is not None:
+                    minimum, maximum = self.get_parameter_range(name)
+            except Exception as e:
+                entry["value"] = None
+                entry["error"] = str(e)
+            if minimum is not None:
+                entry.update(min=minimum, max=maximum, inc=descriptor.increment)
+            if descriptor.entries is not None:
+                entry["entries"] = list(descriptor.entries)
+            entry["writable"] = (descriptor.access in ("rw", "wo")
+                                 and not (self.is_running and name in LOCKED_PARAMETERS))
+            snapshot[name] = entry
+        return snapshot
+
+    def get_parameters(self, names=COMMON_PARAMETERS):
+        values = {}
+        for name in names:
+            try:
+                values[name] = self.get_parameter(name)
+            except Exception:
+                continue
+        return values
+
+    def get_parameter_ranges(self, names=COMMON_PARAMETERS):
+        ranges = {}
+        for name in names:
+            try:
+                ranges[name] = self.get_parameter_range(name)
+            except Exception:
+                continue
+        return ranges
+
+    def stats(self):
+        stats = self.acquisition_stats.snapshot()
+        stats.update(backend=self.name, width=self.width, height=self.height)
+        return stats
+
+
+def backend_class(name):
+    try:
+        module_name, class_name = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown camera backend: {name}") from None
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_camera(name, **options):
+    """
+    Creates an unopened camera of the named backend
+    """
+    return backend_class(name)(**options)
+
+
+def open_camera(name, index=0, **options):
+    camera = create_camera(name, **options)
+    camera.open(index)
+    return camera
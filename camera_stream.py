@@ -0,0 +1,203 @@
+import time
+
+import cv2
+from camera_backend import LOCKED_PARAMETERS
+from encoder_pool import EncoderPool, ENCODER_WORKERS
+from frame_envelope import FLAG_DISCONTINUITY, FLAG_RESIZED, HEADER_SIZE, pack_header
+from jpeg_encoder import JpegEncoder, JPEG_QUALITY
+from rate_control import RATE_LEVELS, level_quality, level_size
+from stage_timing import StageTimers
+from streaming import FrameBroadcaster, SUBSCRIBER_QUEUE
+
+
+class CameraStream:
+    """
+    JPEG stream of one CameraBackend shared by any number of websockets.
+
+    Frames are grabbed on one thread, resized to `target_size` if needed and
+    JPEG-encoded on an EncoderPool, then fanned out by a FrameBroadcaster.
+    Opening and closing the camera is left to the caller.
+
+    Every JPEG is encoded behind a frame_envelope header (frame id, device
+    and host timestamps, size, flags and `stream_id`, which tells the
+    cameras of a multi-camera server apart). Subscribers that negotiated the
+    envelope get header and JPEG, the others only the JPEG bytes.
+
+    Each frame is encoded once per rate_control level that some subscriber
+    is at (level 0, the full stream, unless every client is adapted down).
+
+    Resize and encode times go into `stage_timers`; `stats()["stages"]`
+    reports them together with the camera's buffer wait and conversion.
+    Queue dwell and send time are kept per client by the broadcaster.
+    """
+
+    def __init__(self, camera, loop, target_size=None, quality=JPEG_QUALITY,
+                 timeout_ms=1000, workers=ENCODER_WORKERS, max_queue=SUBSCRIBER_QUEUE,
+                 stream_id=0):
+        self.camera = camera
+        self.target_size = target_size
+        self.stream_id = stream_id
+        self.timeout_ms = timeout_ms
+        self.stage_timers = StageTimers()
+        self._workers = workers
+        self._last_frame_id = None
+        # One encoder per level, so each output ring is sized for its level
+        ring_size = JpegEncoder.ring_size(workers, max_queue)
+        self.jpeg_encoders = [JpegEncoder(level_quality(level, quality), ring_size)
+                              for level in range(len(RATE_LEVELS))]
+        self.jpeg_encoder = self.jpeg_encoders[0]
+        self.broadcaster = FrameBroadcaster(loop, max_queue, HEADER_SIZE)
+        self.encoder_pool = None
+        # Set by stop(), a reconfigure finishing afterwards must not restart
+        self._stopped = False
+
+    @property
+    def frame_width(self):
+        return self.target_size[0] if self.target_size else self.camera.width
+
+    @property
+    def frame_height(self):
+        return self.target_size[1] if self.target_size else self.camera.height
+
+    def start(self):
+        # Enough ring slots for every frame the encoder pool may hold
+        self._last_frame_id = None
+        self.camera.start(self.target_size, EncoderPool.ring_slots(self._workers))
+        self.encoder_pool = EncoderPool(
+            self.grab_frame, self.encode_frame, self.broadcaster.publish, self._workers)
+        self.encoder_pool.start()
+
+    def grab_frame(self):
+        """
+        Grabs the next frame together with the fields of its envelope header
+        """
+        frame = self.camera.grab(self.timeout_ms)
+        host_timestamp = time.time_ns()
+        frame_id, device_timestamp = self.camera.last_frame_info or (0, 0)
+        flags = 0
+        if self._last_frame_id is not None and frame_id != self._last_frame_id + 1:
+            flags |= FLAG_DISCONTINUITY
+        self._last_frame_id = frame_id
+        return frame, (frame_id, device_timestamp, host_timestamp, flags)
+
+    def encode_frame(self, grabbed):
+        """
+        Resizes (if requested) and JPEG-encodes a frame returned by grab_frame
+        for every level in use. Returns {level: header and JPEG}, memoryviews
+        that stay valid for a few frames.
+        """
+        np_image, (frame_id, device_timestamp, host_timestamp, flags) = grabbed
+        started = time.perf_counter()
+        # Resize image if target_size is specified and not already reached
+        if self.target_size is not None and np_image.shape[1::-1] != self.target_size:
+            np_image = cv2.resize(np_image, self.target_size, interpolation=cv2.INTER_AREA)
+            flags |= FLAG_RESIZED
+            resized = time.perf_counter()
+            self.stage_timers.record("resize", resized - started)
+            started = resized
+        variants = {}
+        for level in sorted(self.broadcaster.levels):
+            image, level_flags = np_image, flags
+            size = level_size(level, np_image.shape[1], np_image.shape[0])
+            if size != np_image.shape[1::-1]:
+                image = cv2.resize(np_image, size, interpolation=cv2.INTER_AREA)
+                level_flags |= FLAG_RESIZED
+                resized = time.perf_counter()
+                self.stage_timers.record("resize", resized - started)
+                started = resized
+            payload = self.jpeg_encoders[level].encode(image, HEADER_SIZE)
+            encoded = time.perf_counter()
+            self.stage_timers.record("encode", encoded - started)
+            started = encoded
+            height, width = image.shape[:2]
+            pack_header(payload, frame_id, device_timestamp, host_timestamp, width, height,
+                        level_flags, stream_id=self.stream_id)
+            variants[level] = payload
+        return variants
+
+    def reconfigure(self, change):
+        """
+        Calls `change()` with acquisition stopped, for settings the camera
+        only accepts while idle, then resumes streaming. Subscribers stay
+        connected. Returns what `change` returns. Acquisition stays off if
+        the stream was stopped meanwhile.
+        """
+        running = self.encoder_pool is not None
+        if running:
+            self.encoder_pool.stop()
+            self.camera.stop()
+            self.encoder_pool.join()
+            self.encoder_pool = None
+        try:
+            return change()
+        finally:
+            if running and not self._stopped:
+                self.start()
+
+    def set_roi(self, roi):
+        """
+        Moves the camera to a new ROI (see CameraBackend.set_roi) without
+        dropping subscribers
+        """
+        return self.reconfigure(lambda: self.camera.set_roi(roi))
+
+    def set_trigger(self, mode, source=None, activation=None):
+        """
+        Switches the camera's trigger mode (see CameraBackend.set_trigger)
+        without dropping subscribers. While triggered, the stream only
+        carries the frames of triggers.
+        """
+        return self.reconfigure(lambda: self.camera.set_trigger(mode, source, activation))
+
+    def set_parameters(self, values):
+        """
+        Applies a batch of parameters (see CameraBackend.set_parameters)
+        with at most one restart: those in LOCKED_PARAMETERS are written
+        together in a single reconfigure, the rest live afterwards, so
+        ranges that follow the new size are already in place
+        """
+        locked = {name: value for name, value in values.items() if name in LOCKED_PARAMETERS}
+        live = {name: value for name, value in values.items() if name not in LOCKED_PARAMETERS}
+        results = {}
+        if locked:
+            results.update(self.reconfigure(lambda: self.camera.set_parameters(locked)))
+        if live:
+            results.update(self.camera.set_parameters(live))
+        return {name: results[name] for name in values}
+
+    def subscribe(self, websocket, envelope=False, controller=None):
+        self.broadcaster.subscribe(websocket, envelope, controller)
+
+    def unsubscribe(self, websocket):
+        self.broadcaster.unsubscribe(websocket)
+
+    def is_subscribed(self, websocket):
+        return self.broadcaster.is_subscribed(websocket)
+
+    def subscriber_count(self):
+        return self.broadcaster.subscriber_count()
+
+    def stop(self):
+        """
+        Stops encoding and acquisition and drops every subscriber. Blocks
+        until the pipeline threads have exited.
+        """
+        self._stopped = True
+        if self.encoder_pool is not None:
+            self.encoder_pool.stop()
+        self.broadcaster.close()
+        self.camera.stop()
+        if self.encoder_pool is not None:
+            self.encoder_pool.join()
+
+    def stats(self):
+        stats = {
+            "camera": self.camera.stats(),
+            "stream": self.broadcaster.stats(),
+            "stages": {**self.camera.stage_timers.snapshot(), **self.stage_timers.snapshot()},
+        }
+        if self.encoder_pool is not None:
+            stats["pipeline"] = self.encoder_pool.stats()
+        if self.camera.raw_recorder is not None:
+            stats["recorder"] = self.camera.raw_recorder.stats()
+        return stats
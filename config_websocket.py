@@ -1,269 +1,73 @@
 import asyncio
 import json
+import os
 import websockets
-from threading import Thread
-from queue import Queue
-import cv2
-from ids_peak import ids_peak
-from ids_peak_ipl import ids_peak_ipl
-from ids_peak import ids_peak_ipl_extension
-from turbojpeg import TurboJPEG, TJPF_BGR
+from camera_backend import LOCKED_PARAMETERS, create_camera
+from camera_stream import CameraStream
+from frame_envelope import negotiate as negotiate_envelope
+from rate_control import controller_from_command
+from event_recorder import (
+    POST_TRIGGER_SECONDS, PRE_TRIGGER_BUDGET, PRE_TRIGGER_SECONDS, PreTriggerRecorder,
+    check_budget)
+from metrics import serve_metrics
+from parameter_watch import PARAMETER_NOTIFY_RATE, ParameterWatcher
 
 # Constants
-TARGET_PIXEL_FORMAT = ids_peak_ipl.PixelFormatName_BGRa8
+CAMERA_BACKEND = os.environ.get("CAMERA_BACKEND", "ids")  # ids, hikvision or synthetic
+WEBSOCKET_PORT = int(os.environ.get("WEBSOCKET_PORT", "8765"))
 JPEG_QUALITY = 75          # Reduced JPEG quality for faster encoding
 BUFFER_TIMEOUT = 1000      # Reduced wait time (in ms) for a finished buffer
-
-class Camera:
-    def __init__(self, device_manager, device_index=0):
-        self.device_manager = device_manager
-        self.device_index = device_index
-        self._device = None
-        self._datastream = None
-        self._acquisition_running = False
-        self.target_fps = 20000
-        self.max_fps = 0
-        self.target_gain = 1
-        self.max_gain = 1
-        self._node_map = None
-        self.image_width = None
-        self.image_height = None
-        self.target_size = None
-        self.killed = False
-        self._get_device()
-        self.jpeg_encoder = TurboJPEG(r"C:\libjpeg-turbo-gcc64\bin\libturbojpeg.dll")
-        if self._device:
-            self._setup_device_and_datastream()
-
-    def __del__(self):
-        self.close()
-
-    def _get_device(self):
-        self.device_manager.Update()
-        if self.device_manager.Devices().empty():
-            raise RuntimeError("No devices found")
-        if self.device_index >= len(self.device_manager.Devices()):
-            raise IndexError("Invalid device index")
-        self._device = self.device_manager.Devices()[self.device_index].OpenDevice(ids_peak.DeviceAccessType_Control)
-        self._node_map = self._device.RemoteDevice().NodeMaps()[0]
-        self.max_gain = self._node_map.FindNode("Gain").Maximum()
-        self._node_map.FindNode("UserSetSelector").SetCurrentEntry("Default")
-        self._node_map.FindNode("UserSetLoad").Execute()
-        self._node_map.FindNode("UserSetLoad").WaitUntilDone()
-
-    def _setup_device_and_datastream(self):
-        self._datastream = self._device.DataStreams()[0].OpenDataStream()
-        self._find_and_set_remote_device_enumeration("GainAuto", "Off")
-        self._find_and_set_remote_device_enumeration("ExposureAuto", "Off")
-        payload_size = self._node_map.FindNode("PayloadSize").Value()
-        max_buffer = self._datastream.NumBuffersAnnouncedMinRequired() * 5
-        for idx in range(max_buffer):
-            buffer = self._datastream.AllocAndAnnounceBuffer(payload_size)
-            self._datastream.QueueBuffer(buffer)
-
-    def close(self):
-        self.stop_acquisition()
-        if self._datastream:
-            try:
-                self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
-                for buffer in self._datastream.AnnouncedBuffers():
-                    self._datastream.RevokeBuffer(buffer)
-            except Exception as e:
-                print(f"Exception (close): {str(e)}")
-            finally:
-                self._datastream = None
-
-    def connect(self, device_index):
-        if self.device is not None:
-            self.disconnect()
-        devices = self.device_manager.Devices()
-        if device_index >= len(devices):
-            raise ValueError("Invalid device index")
-        self.device = devices[device_index].OpenDevice(ids_peak.DeviceAccessType_Control)
-        self.node_map = self.device.RemoteDevice().NodeMaps()[0]
-        print(f"Connected to {self.device.ModelName()}")
-
-    def _find_and_set_remote_device_enumeration(self, name: str, value: str):
-        entries = self._node_map.FindNode(name).Entries()
-        available_entries = [entry.SymbolicValue() for entry in entries if entry.IsAvailable()]
-        if value in available_entries:
-            self._node_map.FindNode(name).SetCurrentEntry(value)
-
-    def set_remote_device_value(self, name: str, value: any):
-        try:
-            self._node_map.FindNode(name).SetValue(value)
-        except ids_peak.Exception:
-            print(f"Could not set value for {name}!")
-
-    def start_acquisition(self):
-        if self._device is None or self._acquisition_running:
-            return False
-        try:
-            self.max_fps = self._node_map.FindNode("AcquisitionFrameRate").Maximum()
-            self.target_fps = self.max_fps
-            self.set_remote_device_value("AcquisitionFrameRate", self.target_fps)
-        except ids_peak.Exception:
-            pass
-        try:
-            self._node_map.FindNode("TLParamsLocked").SetValue(1)
-            self.image_width = self._node_map.FindNode("Width").Value()
-            self.image_height = self._node_map.FindNode("Height").Value()
-            input_pixel_format = ids_peak_ipl.PixelFormat(
-                self._node_map.FindNode("PixelFormat").CurrentEntry().Value())
-            self._image_converter = ids_peak_ipl.ImageConverter()
-            self._image_converter.PreAllocateConversion(
-                input_pixel_format, TARGET_PIXEL_FORMAT,
-                self.image_width, self.image_height)
-            self._datastream.StartAcquisition()
-            self._node_map.FindNode("AcquisitionStart").Execute()
-            self._node_map.FindNode("AcquisitionStart").WaitUntilDone()
-            self._acquisition_running = True
-            return True
-        except Exception as e:
-            print(f"Exception (start acquisition): {str(e)}")
-            return False
-
-    def stop_acquisition(self):
-        if not self._acquisition_running:
-            return
-        try:
-            self._node_map.FindNode("AcquisitionStop").Execute()
-            self._datastream.KillWait()
-            self._datastream.StopAcquisition(ids_peak.AcquisitionStopMode_Default)
-            self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
-            self._acquisition_running = False
-            self._node_map.FindNode("TLParamsLocked").SetValue(0)
-        except Exception as e:
-            print(f"Exception (stop acquisition): {str(e)}")
-
-    # def get_jpeg_frame(self):
-    #     buffer = None
-    #     try:
-    #         buffer = self._datastream.WaitForFinishedBuffer(BUFFER_TIMEOUT)
-    #         image = ids_peak_ipl_extension.BufferToImage(buffer)
-    #         converted_image = image.ConvertTo(ids_peak_ipl.PixelFormatName_BGR8)
-    #         np_image = converted_image.get_numpy_3D()
-    #         if self.target_size:
-    #             np_image = cv2.resize(np_image, self.target_size)
-    #         success, jpeg_buffer = cv2.imencode('.jpg', np_image, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
-    #         return jpeg_buffer.tobytes() if success else None
-    #     except Exception as e:
-    #         print(f"Error capturing frame: {str(e)}")
-    #         raise
-    #     finally:
-    #         if buffer:
-    #             self._datastream.QueueBuffer(buffer)
-    
-    def get_jpeg_frame(self):
-        buffer = None
-        try:
-            buffer = self._datastream.WaitForFinishedBuffer(BUFFER_TIMEOUT)
-            image = ids_peak_ipl_extension.BufferToImage(buffer)
-            converted_image = image.ConvertTo(ids_peak_ipl.PixelFormatName_BGR8)
-            np_image = converted_image.get_numpy_3D()
-            if self.target_size:
-                np_image = cv2.resize(np_image, self.target_size)
-            # Use TurboJPEG for faster encoding
-            jpeg_bytes = self.jpeg_encoder.encode(np_image, quality=JPEG_QUALITY)
-            return jpeg_bytes
-        except Exception as e:
-            print(f"Error capturing frame: {str(e)}")
-            raise
-        finally:
-            if buffer:
-                self._datastream.QueueBuffer(buffer)
-
-
-    def get_all_max(self):
-        max_values = {}
-        target_parameters = [
-            "ExposureTime", "Gain", "AcquisitionFrameRate",
-            "Width", "Height", "Gamma", "BlackLevel"
-        ]
-        for param in target_parameters:
-            try:
-                node = self._node_map.FindNode(param)
-                if isinstance(node, (ids_peak.FloatNode, ids_peak.IntegerNode)):
-                    max_values[param] = node.Maximum()
-            except:
-                continue
-        return max_values
-
-    def get_all_min(self):
-        min_values = {}
-        target_parameters = [
-            "ExposureTime", "Gain", "AcquisitionFrameRate",
-            "Width", "Height", "Gamma", "BlackLevel"
-        ]
-        for param in target_parameters:
-            try:
-                node = self._node_map.FindNode(param)
-                if isinstance(node, (ids_peak.FloatNode, ids_peak.IntegerNode)):
-                    min_values[param] = node.Minimum()
-            except:
-                continue
-        return min_values
-
-    def get_all_current(self):
-        current_values = {}
-        target_parameters = [
-            "ExposureTime", "Gain", "AcquisitionFrameRate",
-            "Width", "Height", "PixelFormat", "BalanceWhiteAuto",
-            "Gamma", "BlackLevel", "ReverseX", "ReverseY"
-        ]
-        for param in target_parameters:
-            try:
-                node = self._node_map.FindNode(param)
-                if isinstance(node, ids_peak.EnumerationNode):
-                    current_entry = node.CurrentEntry()
-                    current_values[param] = current_entry.SymbolicValue()
-                elif isinstance(node, ids_peak.BooleanNode):
-                    current_values[param] = bool(node.Value())
-                elif isinstance(node, (ids_peak.IntegerNode, ids_peak.FloatNode)):
-                    current_values[param] = node.Value()
-            except:
-                continue
-        return current_values
-
-    def set_parameter(self, name: str, value):
-        try:
-            node = self._node_map.FindNode(name)
-            if isinstance(node, ids_peak.FloatNode):
-                value = float(value)
-                min_val = node.Minimum()
-                max_val = node.Maximum()
-                inc = node.Inc() if hasattr(node, 'Inc') and node.Inc() > 0 else None
-                if inc:
-                    value = round(value / inc) * inc
-                value = max(min(value, max_val), min_val)
-                node.SetValue(value)
-            elif isinstance(node, ids_peak.IntegerNode):
-                value = int(value)
-                value = max(min(value, node.Maximum()), node.Minimum())
-                node.SetValue(value)
-            elif isinstance(node, ids_peak.EnumerationNode):
-                entries = [entry.SymbolicValue() for entry in node.Entries() if entry.IsAvailable()]
-                if value in entries:
-                    node.SetCurrentEntry(value)
-                else:
-                    raise ValueError(f"Value {value} not available for {name}")
-            elif isinstance(node, ids_peak.BooleanNode):
-                node.SetValue(bool(value))
-            else:
-                raise ValueError(f"Unsupported node type: {type(node)}")
-            return True
-        except Exception as e:
-            print(f"Error setting {name}: {str(e)}")
-            return False
+RANGE_PARAMETERS = [
+    "ExposureTime", "Gain", "AcquisitionFrameRate",
+    "Width", "Height", "Gamma", "BlackLevel"
+]
+CURRENT_PARAMETERS = [
+    "ExposureTime", "Gain", "AcquisitionFrameRate",
+    "Width", "Height", "PixelFormat", "BalanceWhiteAuto",
+    "Gamma", "BlackLevel", "ReverseX", "ReverseY"
+]
+# Everything the parameter panel shows, for getParameters
+SNAPSHOT_PARAMETERS = list(dict.fromkeys(CURRENT_PARAMETERS + RANGE_PARAMETERS))
 
 class WebSocketServer:
-    def __init__(self):
+    """
+    Configures and streams any number of cameras from one process.
+
+    Open cameras are kept by camera id (serial number) and each streams
+    through its own CameraStream, i.e. its own grab thread, encoders and
+    subscribers. Commands address a camera with "camera": <id>; with only
+    one camera open it may be left out. Frames of several cameras sent to
+    one websocket are told apart by the stream id in the frame envelope
+    (returned by connect and start_stream).
+
+    A camera stays open from connect (or its first start_stream) until
+    disconnect, or until every client that connected or streamed it has
+    gone: stopping its stream only stops acquisition, so parameters and
+    buffers carry over to the next start_stream.
+
+    Starting, stopping and restarting (reconfigure) a camera's stream run
+    one at a time under its `stream_lock`, so a restart cannot bring back
+    a stream that was stopped meanwhile.
+    """
+
+    def __init__(self, backend=CAMERA_BACKEND, camera_options=None, stream_options=None):
         self.clients = set()
-        self.streaming = False
-        self.current_camera = None
-        self.device_manager = ids_peak.DeviceManager.Instance()
-        self.frame_queue = Queue(maxsize=1)
-        ids_peak.Library.Initialize()
+        self.backend = backend
+        self.camera_options = camera_options or {}
+        self.stream_options = {"quality": JPEG_QUALITY, **(stream_options or {})}
+        self.cameras = {}          # Camera id -> open CameraBackend
+        self.streams = {}          # Camera id -> running CameraStream
+        self._device_indices = {}  # Camera id -> device index it was opened from
+        self._stream_ids = {}      # Camera id -> envelope stream id
+        self._camera_clients = {}  # Camera id -> websockets that connected or streamed it
+        self.watchers = {}         # Camera id -> ParameterWatcher with subscribers
+        self._stream_locks = {}    # Camera id -> lock around stream start, stop and restarts
+        self.notify_rate = PARAMETER_NOTIFY_RATE
+        self._next_stream_id = 0
+
+    @property
+    def streaming(self):
+        return bool(self.streams)
 
     async def handler(self, websocket):
         self.clients.add(websocket)
@@ -272,6 +76,20 @@ class WebSocketServer:
                 await self.handle_command(message, websocket)
         finally:
             self.clients.remove(websocket)
+            for camera_id, watcher in list(self.watchers.items()):
+                if watcher.is_subscribed(websocket):
+                    self.unwatch_parameters(camera_id, websocket)
+            for camera_id, stream in list(self.streams.items()):
+                if stream.is_subscribed(websocket):
+                    stream.unsubscribe(websocket)
+                    if stream.subscriber_count() == 0:
+                        await self.stop_camera_stream(camera_id)
+            for camera_id in list(self.cameras):
+                clients = self._camera_clients.get(camera_id, set())
+                clients.discard(websocket)
+                if not clients and camera_id not in self.streams:
+                    # Nobody left who uses it, release the device
+                    await self.close_camera(camera_id)
 
     async def handle_command(self, message, websocket):
         try:
@@ -280,160 +98,460 @@ class WebSocketServer:
 
             if command == "get_devices":
                 await self.send_devices_list(websocket)
+            elif command == "get_cameras":
+                await websocket.send(json.dumps({"cameras": self.camera_list()}))
             elif command == "connect":
                 await self.connect(data, websocket)
             elif command == "disconnect":
-                await self.disconnect(websocket)
+                await self.disconnect(data, websocket)
             elif command == "start_stream":
                 await self.start_stream(data, websocket)
             elif command == "stop_stream":
-                await self.stop_stream(websocket)
+                await self.stop_stream(data, websocket)
             elif command == "getMax":
-                await self.send_max_values(websocket)
+                await self.send_max_values(data, websocket)
             elif command == "getMin":
-                await self.send_min_values(websocket)
+                await self.send_min_values(data, websocket)
             elif command == "getCurrent":
-                await self.send_current_values(websocket)
+                await self.send_current_values(data, websocket)
+            elif command == "getParameters":
+                await self.send_parameters(data, websocket)
             elif command == "setValue":
                 await self.set_parameter_value(data, websocket)
+            elif command == "setValues":
+                await self.set_parameter_values(data, websocket)
+            elif command == "subscribe_parameters":
+                await self.subscribe_parameters(data, websocket)
+            elif command == "unsubscribe_parameters":
+                camera_id = self.camera_id(data)
+                self.unwatch_parameters(camera_id, websocket)
+                await websocket.send(json.dumps({"message": "Unsubscribed", "camera": camera_id}))
+            elif command == "set_roi":
+                await self.set_roi(data, websocket)
+            elif command == "set_trigger":
+                await self.set_trigger(data, websocket)
+            elif command == "trigger":
+                await self.trigger(data, websocket)
+            elif command == "arm_recorder":
+                await self.arm_recorder(data, websocket)
+            elif command == "save_event":
+                await self.save_event(data, websocket)
+            elif command == "disarm_recorder":
+                await self.disarm_recorder(data, websocket)
+            elif command == "get_stats":
+                await websocket.send(json.dumps(self.stats()))
             else:
                 await websocket.send(json.dumps({"error": "Unknown command"}))
         except Exception as e:
             await websocket.send(json.dumps({"error": str(e)}))
 
+    def camera_id(self, data):
+        """
+        Id of the open camera a command addresses. Raises ValueError when
+        there is none or the command is ambiguous.
+        """
+        camera_id = data.get("camera")
+        if camera_id is not None:
+            if camera_id not in self.cameras:
+                raise ValueError(f"Camera {camera_id} not connected")
+            return camera_id
+        if not self.cameras:
+            raise ValueError("No camera connected")
+        if len(self.cameras) > 1:
+            raise ValueError("Several cameras connected, select one with \"camera\"")
+        return next(iter(self.cameras))
+
+    def stream_lock(self, camera_id):
+        return self._stream_locks.setdefault(camera_id, asyncio.Lock())
+
+    def camera_list(self):
+        return [{
+            "camera": camera_id,
+            "model": camera.model,
+            "index": self._device_indices[camera_id],
+            "stream_id": self._stream_ids[camera_id],
+            "streaming": camera_id in self.streams,
+            "subscribers": self.streams[camera_id].subscriber_count() if camera_id in self.streams else 0,
+        } for camera_id, camera in self.cameras.items()]
+
     async def send_devices_list(self, websocket):
-        self.device_manager.Update()
-        devices = []
-        for idx, device in enumerate(self.device_manager.Devices()):
-            devices.append({
-                "index": idx,
-                "model": device.ModelName(),
-                "serial": device.SerialNumber(),
-                "interface": device.ParentInterface().DisplayName()
-            })
+        devices = [{
+            "index": device["index"],
+            "model": device["model"],
+            "serial": device["serial"],
+            "interface": device["type"],
+            "connected": device["serial"] in self.cameras,
+        } for device in create_camera(self.backend, **self.camera_options).list_devices()]
         await websocket.send(json.dumps({"devices": devices}))
 
+    def open_camera(self, data):
+        """
+        Opens the camera a command asks for by "camera" (serial) or "index",
+        unless it is already open. Returns its id.
+        """
+        camera_id = data.get("camera")
+        if camera_id in self.cameras:
+            return camera_id
+        camera = create_camera(self.backend, **self.camera_options)
+        index = data.get("index", 0)
+        if camera_id is not None:
+            serials = {device["serial"]: device["index"] for device in camera.list_devices()}
+            if camera_id not in serials:
+                raise ValueError(f"Camera {camera_id} not found")
+            index = serials[camera_id]
+        for open_id, open_index in self._device_indices.items():
+            if open_index == index:
+                return open_id
+        camera.open(index)
+        camera_id = camera.serial or f"{camera.name}{index}"
+        self.cameras[camera_id] = camera
+        self._device_indices[camera_id] = index
+        self._stream_ids[camera_id] = self._next_stream_id
+        self._next_stream_id += 1
+        return camera_id
+
     async def connect(self, data, websocket):
-        device_index = data.get("index", 0)
         try:
-            if self.streaming:
-                await self.stop_stream(websocket)
-            self.current_camera = Camera(self.device_manager, device_index)
+            camera_id = self.open_camera(data)
+            camera = self.cameras[camera_id]
+            self._camera_clients.setdefault(camera_id, set()).add(websocket)
             await websocket.send(json.dumps({
-                "message": f"Connected to {self.current_camera._device.ModelName()}"
+                "message": f"Connected to {camera.model}",
+                "camera": camera_id,
+                "stream_id": self._stream_ids[camera_id],
             }))
         except Exception as e:
             await websocket.send(json.dumps({"error": str(e)}))
 
-    async def disconnect(self, websocket):
-        if self.streaming:
-            await self.stop_stream(websocket)
-        if self.current_camera:
-            self.current_camera.close()
-            self.current_camera = None
-            await websocket.send(json.dumps({"message": "Disconnected from camera"}))
+    async def disconnect(self, data, websocket):
+        camera_id = self.camera_id(data)
+        if camera_id in self.streams:
+            await self.close_stream(camera_id)
         else:
-            await websocket.send(json.dumps({"error": "No camera connected"}))
+            await self.close_camera(camera_id)
+        await websocket.send(json.dumps({"message": "Disconnected from camera", "camera": camera_id}))
 
     async def start_stream(self, data, websocket):
-        if self.streaming:
-            await websocket.send(json.dumps({"error": "Stream already running"}))
-            return
-        device_index = data.get("index", 0)
-        target_size = (data.get("width"), data.get("height"))
-        try:
-            self.current_camera = Camera(self.device_manager, device_index)
-            if not self.current_camera.start_acquisition():
-                raise RuntimeError("Failed to start acquisition")
-            if all(target_size):
-                self.current_camera.target_size = (int(target_size[0]), int(target_size[1]))
-            self.streaming = True
-            Thread(target=self.frame_producer, daemon=True).start()
-            asyncio.create_task(self.frame_consumer(websocket))
-            await websocket.send(json.dumps({"message": "Stream started"}))
-        except Exception as e:
-            await websocket.send(json.dumps({"error": str(e)}))
-
-    async def stop_stream(self, websocket):
-        if self.streaming and self.current_camera:
-            self.streaming = False
-            self.current_camera.stop_acquisition()
-            await asyncio.sleep(0.1)
-            self.current_camera.close()
-            self.current_camera = None
-            with self.frame_queue.mutex:
-                self.frame_queue.queue.clear()
-            await websocket.send(json.dumps({"message": "Stream stopped"}))
-        else:
-            await websocket.send(json.dumps({"error": "No active stream"}))
-
-    def frame_producer(self):
-        while self.streaming:
+        # Refuse bad subscription options before anything is opened
+        envelope = negotiate_envelope(data.get("envelope"))
+        controller = controller_from_command(data)
+        camera_id = data.get("camera")
+        if camera_id not in self.streams:
+            target_size = (data.get("width"), data.get("height"))
+            target_size = (int(target_size[0]), int(target_size[1])) if all(target_size) else None
+            opened = False
             try:
-                jpeg_bytes = self.current_camera.get_jpeg_frame()
-                if jpeg_bytes:
-                    if self.frame_queue.full():
+                # Stream from the connected camera, or open the requested one
+                open_cameras = set(self.cameras)
+                camera_id = self.open_camera(data)
+                opened = camera_id not in open_cameras
+                async with self.stream_lock(camera_id):
+                    if camera_id not in self.streams:
+                        stream = CameraStream(
+                            self.cameras[camera_id], asyncio.get_running_loop(), target_size,
+                            timeout_ms=BUFFER_TIMEOUT, stream_id=self._stream_ids[camera_id],
+                            **self.stream_options)
                         try:
-                            self.frame_queue.get_nowait()
+                            stream.start()
                         except Exception:
-                            pass
-                    self.frame_queue.put(jpeg_bytes)
-            except Exception as e:
-                print(f"Frame producer error: {e}")
-                break
-
-    async def frame_consumer(self, websocket):
-        while self.streaming:
-            try:
-                jpeg_bytes = self.frame_queue.get()
-                await websocket.send(jpeg_bytes)
-                self.frame_queue.task_done()
+                            self.cameras[camera_id].stop()
+                            raise
+                        self.streams[camera_id] = stream
+                        # Locked parameters are read-only while acquiring
+                        self.parameters_changed(camera_id)
             except Exception as e:
-                print(f"Frame consumer error: {e}")
-                break
+                # Only undo what this call set up: a camera opened by connect
+                # or streaming to others stays as it was
+                if opened:
+                    await self.close_camera(camera_id)
+                await websocket.send(json.dumps({"error": str(e)}))
+                return
+        # Share a running stream instead of opening the camera again
+        await websocket.send(json.dumps({
+            "message": "Stream started", "camera": camera_id,
+            "stream_id": self._stream_ids[camera_id],
+            **self.subscribe(camera_id, websocket, envelope, controller)}))
+
+    def subscribe(self, camera_id, websocket, envelope, controller):
+        """
+        Subscribes the client, with frame headers and adaptive quality if it
+        asked for them. Returns the fields to add to the start_stream reply.
+        """
+        self.streams[camera_id].subscribe(websocket, envelope is not None, controller)
+        self._camera_clients.setdefault(camera_id, set()).add(websocket)
+        response = {"envelope": envelope} if envelope else {}
+        if controller is not None:
+            response["adaptive"] = True
+        return response
+
+    async def stop_stream(self, data, websocket):
+        camera_id = data.get("camera")
+        if camera_id is None:
+            # Every stream this client watches
+            subscribed = [camera_id for camera_id, stream in self.streams.items()
+                          if stream.is_subscribed(websocket)]
+        else:
+            subscribed = [camera_id] if camera_id in self.streams else []
+        if not subscribed:
+            await websocket.send(json.dumps({"error": "No active stream"}))
+            return
+        for camera_id in subscribed:
+            stream = self.streams[camera_id]
+            stream.unsubscribe(websocket)
+            # Keep the camera running while other viewers are subscribed
+            if stream.subscriber_count() == 0:
+                await self.stop_camera_stream(camera_id)
+        await websocket.send(json.dumps({"message": "Stream stopped"}))
+
+    async def set_roi(self, data, websocket):
+        """
+        Sets the sensor ROI from x, y, width and height, or back to the full
+        frame when width/height are missing. A running stream is restarted
+        on the new ROI with its viewers kept.
+        """
+        camera_id = self.camera_id(data)
+        roi = None
+        if data.get("width") and data.get("height"):
+            roi = (int(data.get("x", 0)), int(data.get("y", 0)),
+                   int(data["width"]), int(data["height"]))
+        async with self.stream_lock(camera_id):
+            if camera_id in self.streams:
+                applied = await asyncio.to_thread(self.streams[camera_id].set_roi, roi)
+            else:
+                applied = self.cameras[camera_id].set_roi(roi)
+        self.parameters_changed(camera_id)
+        await websocket.send(json.dumps({"roi": applied, "camera": camera_id}))
+
+    async def set_trigger(self, data, websocket):
+        """
+        Sets the trigger "mode" (off, software or hardware) with optional
+        "source" line and "activation" for hardware triggers
+        """
+        camera_id = self.camera_id(data)
+        args = (data.get("mode", "off"), data.get("source"), data.get("activation"))
+        async with self.stream_lock(camera_id):
+            if camera_id in self.streams:
+                applied = await asyncio.to_thread(self.streams[camera_id].set_trigger, *args)
+            else:
+                applied = self.cameras[camera_id].set_trigger(*args)
+        await websocket.send(json.dumps({"trigger": applied, "camera": camera_id}))
 
-    async def send_max_values(self, websocket):
-        if not self.current_camera:
-            await websocket.send(json.dumps({"error": "No camera connected"}))
+    async def trigger(self, data, websocket):
+        camera_id = self.camera_id(data)
+        if camera_id not in self.streams:
+            await websocket.send(json.dumps({"error": "No active stream"}))
+            return
+        self.cameras[camera_id].trigger()
+        await websocket.send(json.dumps({"message": "Triggered", "camera": camera_id}))
+
+    async def arm_recorder(self, data, websocket):
+        """
+        Starts keeping the last frames of the camera in a pre-trigger ring
+        of "budget_mb" MB
+        """
+        camera_id = self.camera_id(data)
+        budget = int(data["budget_mb"] * 1024 * 1024) if data.get("budget_mb") else PRE_TRIGGER_BUDGET
+        camera = self.cameras[camera_id]
+        # The ring holds frames of the sensor ROI, before any crop or resize
+        check_budget(budget, camera.get_parameter("Width"), camera.get_parameter("Height"),
+                     camera.get_parameter("PixelFormat"))
+        await self.close_recorder(camera_id)
+        camera.raw_recorder = PreTriggerRecorder(budget, name=camera_id)
+        await websocket.send(json.dumps({"recorder": camera.raw_recorder.stats(), "camera": camera_id}))
+
+    async def save_event(self, data, websocket):
+        """
+        Saves "pre" seconds before and "post" seconds after now to disk.
+        Replies right away and again with "event_saved" once the files are
+        written.
+        """
+        camera_id = self.camera_id(data)
+        recorder = self.cameras[camera_id].raw_recorder
+        if recorder is None:
+            await websocket.send(json.dumps({"error": "Recorder not armed"}))
             return
-        max_values = self.current_camera.get_all_max()
+        loop = asyncio.get_running_loop()
+
+        def on_saved(info):
+            asyncio.run_coroutine_threadsafe(
+                websocket.send(json.dumps({"event_saved": info, "camera": camera_id})), loop)
+
+        event = recorder.save_event(data.get("pre", PRE_TRIGGER_SECONDS),
+                                    data.get("post", POST_TRIGGER_SECONDS), on_saved)
+        await websocket.send(json.dumps({"event": event, "camera": camera_id}))
+
+    async def disarm_recorder(self, data, websocket):
+        camera_id = self.camera_id(data)
+        await self.close_recorder(camera_id)
+        await websocket.send(json.dumps({"message": "Recorder disarmed", "camera": camera_id}))
+
+    async def close_recorder(self, camera_id):
+        camera = self.cameras[camera_id]
+        recorder = camera.raw_recorder
+        if recorder is not None:
+            camera.raw_recorder = None
+            # Waits for the event being written, off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, recorder.close)
+
+    def stream_stats(self):
+        """
+        Returns {camera id: CameraStream.stats()} for every running stream
+        """
+        return {camera_id: stream.stats() for camera_id, stream in self.streams.items()}
+
+    def stats(self):
+        return {"streaming": self.streaming, "cameras": self.stream_stats(),
+                "parameter_watchers": {camera_id: watcher.stats()
+                                       for camera_id, watcher in self.watchers.items()}}
+
+    async def subscribe_parameters(self, data, websocket):
+        """
+        Subscribes to changes of "parameters" (default: the panel's) instead
+        of polling getCurrent. Replies with their current state; afterwards
+        {"parameters_changed": {name: {value, min, max, writable}}} carries
+        only what changed, at most `notify_rate` times per second.
+        """
+        camera_id = self.camera_id(data)
+        watcher = self.watchers.get(camera_id)
+        if watcher is None:
+            watcher = self.watchers[camera_id] = ParameterWatcher(
+                self.cameras[camera_id], camera_id, self.notify_rate)
+        state = watcher.subscribe(websocket, data.get("parameters") or SNAPSHOT_PARAMETERS)
+        await websocket.send(json.dumps(
+            {"parameters": state, "camera": camera_id, "rate": watcher.rate}))
+
+    def unwatch_parameters(self, camera_id, websocket):
+        watcher = self.watchers.get(camera_id)
+        if watcher is not None:
+            watcher.unsubscribe(websocket)
+            if not watcher.subscribers:
+                del self.watchers[camera_id]
+
+    def parameters_changed(self, camera_id):
+        """
+        Tells the camera's subscribers to expect changes after a write
+        """
+        watcher = self.watchers.get(camera_id)
+        if watcher is not None:
+            watcher.changed()
+
+    async def stop_camera_stream(self, camera_id):
+        """
+        Stops the stream once it has no subscribers left, but keeps the
+        camera open with its parameters and buffers, so the next
+        start_stream only restarts acquisition. disconnect closes it.
+        """
+        async with self.stream_lock(camera_id):
+            stream = self.streams.get(camera_id)
+            # A client may have subscribed while the lock was held
+            if stream is None or stream.subscriber_count() > 0:
+                return
+            del self.streams[camera_id]
+            # Joins the pipeline threads, off the event loop
+            await asyncio.to_thread(stream.stop)
+            self.parameters_changed(camera_id)
+
+    async def close_stream(self, camera_id):
+        async with self.stream_lock(camera_id):
+            stream = self.streams.pop(camera_id, None)
+            if stream is not None:
+                await asyncio.to_thread(stream.stop)
+        await asyncio.sleep(0.1)
+        await self.close_camera(camera_id)
+
+    async def close_camera(self, camera_id):
+        await self.close_recorder(camera_id)
+        watcher = self.watchers.pop(camera_id, None)
+        if watcher is not None:
+            watcher.close()
+        camera = self.cameras.pop(camera_id)
+        self._device_indices.pop(camera_id)
+        self._camera_clients.pop(camera_id, None)
+        self._stream_ids.pop(camera_id)
+        self._stream_locks.pop(camera_id, None)
+        camera.close()
+
+    async def send_max_values(self, data, websocket):
+        camera = self.cameras[self.camera_id(data)]
+        snapshot = camera.parameter_snapshot(RANGE_PARAMETERS)
+        max_values = {name: entry["max"] for name, entry in snapshot.items() if "max" in entry}
         await websocket.send(json.dumps({"max": max_values}))
 
-    async def send_min_values(self, websocket):
-        if not self.current_camera:
-            await websocket.send(json.dumps({"error": "No camera connected"}))
-            return
-        min_values = self.current_camera.get_all_min()
+    async def send_min_values(self, data, websocket):
+        camera = self.cameras[self.camera_id(data)]
+        snapshot = camera.parameter_snapshot(RANGE_PARAMETERS)
+        min_values = {name: entry["min"] for name, entry in snapshot.items() if "min" in entry}
         await websocket.send(json.dumps({"min": min_values}))
 
-    async def send_current_values(self, websocket):
-        if not self.current_camera:
-            await websocket.send(json.dumps({"error": "No camera connected"}))
-            return
-        current_values = self.current_camera.get_all_current()
+    async def send_parameters(self, data, websocket):
+        """
+        Replies with value, range, increment, unit, writability and enum
+        entries of every panel parameter (or "parameters") in one message
+        """
+        camera_id = self.camera_id(data)
+        names = data.get("parameters") or SNAPSHOT_PARAMETERS
+        snapshot = self.cameras[camera_id].parameter_snapshot(names)
+        await websocket.send(json.dumps({"parameters": snapshot, "camera": camera_id}))
+
+    async def send_current_values(self, data, websocket):
+        camera = self.cameras[self.camera_id(data)]
+        current_values = camera.get_parameters(CURRENT_PARAMETERS)
         await websocket.send(json.dumps({"current": current_values}))
 
     async def set_parameter_value(self, data, websocket):
-        if not self.current_camera:
-            await websocket.send(json.dumps({"error": "No camera connected"}))
-            return
+        camera_id = self.camera_id(data)
+        camera = self.cameras[camera_id]
         param = data.get("parameter")
         value = data.get("value")
         if not param or value is None:
             await websocket.send(json.dumps({"error": "Missing parameter or value"}))
             return
-        success = self.current_camera.set_parameter(param, value)
+        async with self.stream_lock(camera_id):
+            if camera_id in self.streams and param in LOCKED_PARAMETERS:
+                # Needs acquisition stopped, the stream restarts around it
+                results = await asyncio.to_thread(
+                    self.streams[camera_id].set_parameters, {param: value})
+                success = results[param]["ok"]
+            else:
+                success = camera.set_parameter(param, value)
+        self.parameters_changed(camera_id)
         if success:
             await websocket.send(json.dumps({"success": True}))
         else:
             await websocket.send(json.dumps({"error": "Failed to set parameter"}))
 
+    async def set_parameter_values(self, data, websocket):
+        """
+        Sets all of "values" ({name: value}) in one go, in dependency order.
+        On a streaming camera parameters that need acquisition stopped are
+        written together in a single restart and the rest live. Replies
+        with {name: {"ok", "value"[, "error"]}}, the values as the camera
+        took them after clamping and rounding.
+        """
+        camera_id = self.camera_id(data)
+        values = data.get("values")
+        if not values or not isinstance(values, dict):
+            await websocket.send(json.dumps({"error": "Missing values"}))
+            return
+        async with self.stream_lock(camera_id):
+            stream = self.streams.get(camera_id)
+            if stream is not None:
+                # The restart joins the pipeline threads, off the event loop
+                results = await asyncio.to_thread(stream.set_parameters, values)
+                restarted = any(name in LOCKED_PARAMETERS for name in values)
+            else:
+                results = self.cameras[camera_id].set_parameters(values)
+                restarted = False
+        self.parameters_changed(camera_id)
+        await websocket.send(json.dumps(
+            {"results": results, "restarted": restarted, "camera": camera_id}))
+
 async def main():
-    ids_peak.Library.Initialize()
     server = WebSocketServer()
+    await serve_metrics(server.stream_stats)
     async with websockets.serve(
-        server.handler, 
-        "localhost", 8765, 
+        server.handler,
+        "localhost", WEBSOCKET_PORT,
         compression=None,
     ):
         await asyncio.Future()
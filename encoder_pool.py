@@ -0,0 +1,177 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from camera_backend import GrabTimeout
+
+ENCODER_WORKERS = 3
+REPORT_INTERVAL = 5.0      # Seconds between throughput reports, 0 disables them
+
+
+class StageStats:
+    """
+    Frame count, busy (wall) time and CPU time of one pipeline stage
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.frames = 0
+        self.busy = 0.0
+        self.cpu = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, cpu_seconds=0.0):
+        with self._lock:
+            self.frames += 1
+            self.busy += seconds
+            self.cpu += cpu_seconds
+
+    def snapshot(self, elapsed):
+        with self._lock:
+            frames, busy, cpu = self.frames, self.busy, self.cpu
+        return {
+            "frames": frames,
+            "fps": frames / elapsed if elapsed > 0 else 0.0,
+            "ms_per_frame": busy * 1000 / frames if frames else 0.0,
+            "cpu_ms_per_frame": cpu * 1000 / frames if frames else 0.0,
+            "utilization": busy / (elapsed * self.workers) if elapsed > 0 else 0.0,
+        }
+
+
+class EncoderPool:
+    """
+    Pipelined frame producer. One thread only grabs frames (the datastream
+    buffer is requeued as soon as the frame is converted), a pool of encoder
+    threads encodes them in parallel, and encoded frames are published in
+    capture order.
+
+    cv2.imencode/cv2.resize and TurboJPEG release the GIL, so threads scale
+    across cores without copying frames into another process.
+
+    `grab` must return a frame that stays valid while it is being encoded;
+    at most `workers` frames are in flight, so a frame ring needs at least
+    `workers + 1` slots (see `ring_slots`).
+    """
+
+    def __init__(self, grab, encode, publish, workers=ENCODER_WORKERS,
+                 report_interval=REPORT_INTERVAL):
+        self._grab = grab
+        self._encode = encode
+        self._publish = publish
+        self.workers = workers
+        self._report_interval = report_interval
+        self._running = False
+        self._in_flight = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_seq = 0
+        self._executor = None
+        self._thread = None
+        self._started_at = None
+        self.acquire_stats = StageStats("acquire")
+        self.encode_stats = StageStats("encode", workers)
+        self.published = 0
+        self.encode_errors = 0
+
+    @staticmethod
+    def ring_slots(workers=ENCODER_WORKERS):
+        return workers + 2
+
+    def start(self):
+        self._running = True
+        self._started_at = time.perf_counter()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="jpeg-encoder")
+        self._thread = threading.Thread(target=self._acquire_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Asks the acquisition thread to exit. It may still be waiting for a
+        buffer; stop the camera acquisition and then call `join`.
+        """
+        self._running = False
+        self._in_flight.release()
+
+    def join(self, timeout=2.0):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _acquire_loop(self):
+        seq = 0
+        last_report = time.perf_counter()
+        while self._running:
+            self._in_flight.acquire()
+            if not self._running:
+                break
+            started = time.perf_counter()
+            cpu_started = time.thread_time()
+            try:
+                frame = self._grab()
+            except GrabTimeout:
+                # No frame yet (e.g. waiting for a trigger), keep waiting
+                self._in_flight.release()
+                continue
+            except Exception as e:
+                # Stopping the camera aborts a pending wait, that is no error
+                if self._running:
+                    print(f"Frame acquisition error: {str(e)}")
+                self._running = False
+                break
+            now = time.perf_counter()
+            self.acquire_stats.record(now - started, time.thread_time() - cpu_started)
+            self._executor.submit(self._encode_frame, seq, frame)
+            seq += 1
+
+            if self._report_interval and now - last_report >= self._report_interval:
+                last_report = now
+                self.print_report()
+
+    def _encode_frame(self, seq, frame):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            data = self._encode(frame)
+        except Exception as e:
+            print(f"Frame encoding error: {str(e)}")
+            self.encode_errors += 1
+            data = None
+        self.encode_stats.record(time.perf_counter() - started,
+                                 time.thread_time() - cpu_started)
+        self._deliver(seq, data)
+
+    def _deliver(self, seq, data):
+        # Frames can finish out of order; hold them back until every earlier
+        # frame has been published
+        with self._lock:
+            self._pending[seq] = data
+            while self._next_seq in self._pending:
+                data = self._pending.pop(self._next_seq)
+                self._next_seq += 1
+                self._in_flight.release()
+                if data is not None and self._running:
+                    self._publish(data)
+                    self.published += 1
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started_at if self._started_at else 0.0
+        return {
+            "workers": self.workers,
+            "elapsed": elapsed,
+            "acquire": self.acquire_stats.snapshot(elapsed),
+            "encode": self.encode_stats.snapshot(elapsed),
+            "published": self.published,
+            "published_fps": self.published / elapsed if elapsed > 0 else 0.0,
+            "encode_errors": self.encode_errors,
+        }
+
+    def print_report(self):
+        stats = self.stats()
+        acquire, encode = stats["acquire"], stats["encode"]
+        print(f"Pipeline: acquire {acquire['fps']:.1f} fps ({acquire['ms_per_frame']:.1f} ms/frame) | "
+              f"encode {encode['fps']:.1f} fps ({encode['ms_per_frame']:.1f} ms/frame, "
+              f"{self.workers} workers {encode['utilization'] * 100:.0f}% busy) | "
+              f"out {stats['published_fps']:.1f} fps")
@@ -0,0 +1,341 @@
+"""
+Pre-trigger recording of weld events.
+
+The camera's grab thread copies every raw (not yet debayered) frame into a
+PreTriggerRecorder, a ring of preallocated slots sized to a fixed memory
+budget. `save_event` writes the frames from `pre_seconds` before the event
+to `post_seconds` after it to disk on a background thread; frames are only
+converted to BGR there, so live streaming never waits for the recording.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+PRE_TRIGGER_BUDGET = int(os.environ.get("PRE_TRIGGER_BUDGET_MB", "256")) * 1024 * 1024
+PRE_TRIGGER_SECONDS = 2.0
+POST_TRIGGER_SECONDS = 3.0
+RECORDING_DIR = os.environ.get("RECORDING_DIR", "recordings")
+RECORDING_FOURCC = "MJPG"
+DEFAULT_RECORDING_FPS = 30.0
+MIN_SLOTS = 2               # Frames the budget has to hold at least
+
+# Raw pixel format -> (channels, cv2 conversion to BGR). GenICam BayerXY is
+# BayerYX in OpenCV's naming
+RAW_TO_BGR = {
+    "Mono8": (1, cv2.COLOR_GRAY2BGR),
+    "BayerRG8": (1, cv2.COLOR_BayerBG2BGR),
+    "BayerBG8": (1, cv2.COLOR_BayerRG2BGR),
+    "BayerGR8": (1, cv2.COLOR_BayerGB2BGR),
+    "BayerGB8": (1, cv2.COLOR_BayerGR2BGR),
+    "RGB8": (3, cv2.COLOR_RGB2BGR),
+    "BGR8": (3, None),
+}
+
+# Ring slot metadata. `captured_at` is the host perf_counter at the copy,
+# `host_timestamp` the matching time.time_ns()
+RawFrame = namedtuple(
+    "RawFrame",
+    "seq frame_id device_timestamp host_timestamp captured_at width height pixel_format")
+
+
+def frame_bytes(width, height, pixel_format):
+    """
+    Size of one raw frame in the ring. Formats the recorder cannot save
+    count as one byte per pixel, the smallest any of them takes.
+    """
+    channels = RAW_TO_BGR[pixel_format][0] if pixel_format in RAW_TO_BGR else 1
+    return width * height * channels
+
+
+def check_budget(budget, width, height, pixel_format):
+    """
+    Raises ValueError when `budget` bytes hold fewer than MIN_SLOTS frames
+    """
+    size = frame_bytes(width, height, pixel_format)
+    if budget // size < MIN_SLOTS:
+        raise ValueError(
+            f"Recording budget of {budget} bytes holds fewer than {MIN_SLOTS} "
+            f"frames of {width}x{height} {pixel_format}")
+
+
+class _Event:
+    def __init__(self, event_id, started_at, ends_at, path, on_saved):
+        self.id = event_id
+        self.started_at = started_at
+        self.ends_at = ends_at
+        self.path = path
+        self.on_saved = on_saved
+        self.frames = []
+        self.overruns = 0
+        self.error = None
+
+
+class PreTriggerRecorder:
+    """
+    Ring buffer of the most recent raw frames within `budget` bytes.
+
+    `push` is called by the grab thread for every frame while it still
+    holds the SDK buffer and costs one copy into a preallocated slot. The
+    slots are (re)allocated when the payload size changes, so how many
+    seconds the ring covers depends on resolution and frame rate.
+
+    `push` never raises into the grab thread: frames in a format it cannot
+    save, or too large for the budget, are only counted.
+
+    Events are saved one after the other by a single writer thread. A
+    trigger while an event is still collecting frames extends it. When the
+    writer falls more than the ring behind the camera, the frames it missed
+    are counted as overruns.
+    """
+
+    def __init__(self, budget=PRE_TRIGGER_BUDGET, directory=RECORDING_DIR, name="camera"):
+        self.budget = budget
+        self.directory = directory
+        self.name = name
+        self._cond = threading.Condition()
+        self._slots = None
+        self._meta = []
+        self._payload_size = 0
+        self._next_seq = 0
+        self._ring_start = 0        # First seq stored in the current allocation
+        self._events = []
+        self._current = None
+        self._event_count = 0
+        self._closed = False
+        self._thread = None
+        self.pushed = 0
+        self.unsupported = 0
+        self.too_large = 0
+        self.saved = []
+
+    @property
+    def capacity(self):
+        return len(self._meta)
+
+    def _allocate(self, payload_size):
+        slots = self.budget // payload_size
+        self._slots = np.empty((slots, payload_size), dtype=np.uint8)
+        self._meta = [None] * slots
+        self._payload_size = payload_size
+        # Sequence numbers before this are gone with the old slots
+        self._ring_start = self._next_seq
+
+    def push(self, raw, width, height, pixel_format, frame_info):
+        """
+        Copies one raw frame (a flat uint8 view of the SDK buffer) into the
+        ring, overwriting the oldest frame
+        """
+        if pixel_format not in RAW_TO_BGR:
+            self.unsupported += 1
+            return
+        size = frame_bytes(width, height, pixel_format)
+        if self.budget // size < MIN_SLOTS or raw.size < size:
+            self.too_large += 1
+            return
+        frame_id, device_timestamp = frame_info or (0, 0)
+        with self._cond:
+            if self._closed:
+                return
+            if self._slots is None or self._payload_size != size:
+                # A new ROI or pixel format, older frames cannot be mixed in
+                self._allocate(size)
+            seq = self._next_seq
+            index = seq % len(self._meta)
+            self._slots[index] = raw[:size]
+            self._meta[index] = RawFrame(
+                seq, frame_id, device_timestamp, time.time_ns(), time.perf_counter(),
+                width, height, pixel_format)
+            self._next_seq += 1
+            self.pushed += 1
+            self._cond.notify_all()
+
+    def _oldest_seq(self):
+        return max(self._next_seq - len(self._meta), self._ring_start)
+
+    def _frame_rate(self):
+        """
+        Frame rate over the frames in the ring, for the video container
+        """
+        frames = [meta for meta in self._meta if meta is not None]
+        if len(frames) < 2:
+            return DEFAULT_RECORDING_FPS
+        first = min(frames, key=lambda meta: meta.seq)
+        last = max(frames, key=lambda meta: meta.seq)
+        span = last.captured_at - first.captured_at
+        return (last.seq - first.seq) / span if span > 0 else DEFAULT_RECORDING_FPS
+
+    def save_event(self, pre_seconds=PRE_TRIGGER_SECONDS, post_seconds=POST_TRIGGER_SECONDS,
+                   on_saved=None):
+        """
+        Saves the frames from `pre_seconds` before now to `post_seconds`
+        after now. Returns at once with {"id", "path"}; `on_saved(info)` is
+        called from the writer thread when the files are complete. While
+        the previous event is still collecting frames it is extended to
+        cover this one instead.
+        """
+        now = time.perf_counter()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Recorder closed")
+            current = self._events[-1] if self._events else self._current
+            if current is not None and current.ends_at >= now - pre_seconds:
+                current.ends_at = max(current.ends_at, now + post_seconds)
+                return {"id": current.id, "path": current.path, "extended": True}
+            self._event_count += 1
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self.directory, f"{self.name}_{stamp}_{self._event_count}")
+            event = _Event(self._event_count, now - pre_seconds, now + post_seconds, path,
+                           on_saved)
+            self._events.append(event)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._write_events, name="event-recorder", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return {"id": event.id, "path": event.path}
+
+    def _write_events(self):
+        while True:
+            with self._cond:
+                if not self._events:
+                    self._thread = None
+                    return
+                event = self._current = self._events.pop(0)
+            try:
+                self._write_event(event)
+            except Exception as e:
+                event.error = str(e)
+                print(f"Event recording error: {str(e)}")
+            with self._cond:
+                self._current = None
+            info = self._event_info(event)
+            self.saved.append(info)
+            if event.on_saved is not None:
+                event.on_saved(info)
+
+    def _first_seq(self, started_at):
+        # Oldest frame captured at or after `started_at`
+        seq = self._next_seq
+        while seq > self._oldest_seq():
+            meta = self._meta[(seq - 1) % len(self._meta)]
+            if meta is None or meta.captured_at < started_at:
+                break
+            seq -= 1
+        return seq
+
+    def _next_frame(self, event, seq, scratch):
+        """
+        Copies frame `seq` out of the ring into `scratch`, waiting for it
+        while the event lasts. Returns (metadata, seq, scratch), metadata
+        None once the event is over.
+        """
+        with self._cond:
+            while seq >= self._next_seq:
+                remaining = event.ends_at - time.perf_counter()
+                if remaining <= 0 or self._closed:
+                    return None, seq, scratch
+                self._cond.wait(remaining)
+            if self._slots is None:
+                return None, seq, scratch
+            if seq < self._oldest_seq():
+                event.overruns += self._oldest_seq() - seq
+                seq = self._oldest_seq()
+            meta = self._meta[seq % len(self._meta)]
+            if meta.captured_at > event.ends_at:
+                return None, seq, scratch
+            if scratch is None or scratch.size < self._payload_size:
+                scratch = np.empty(self._payload_size, dtype=np.uint8)
+            scratch[:self._payload_size] = self._slots[seq % len(self._meta)]
+            return meta, seq, scratch
+
+    def _write_event(self, event):
+        os.makedirs(os.path.dirname(event.path) or ".", exist_ok=True)
+        with self._cond:
+            seq = self._first_seq(event.started_at)
+            fps = self._frame_rate()
+        scratch = None
+        bgr = None
+        writer = None
+        size = None
+        try:
+            while True:
+                meta, seq, scratch = self._next_frame(event, seq, scratch)
+                if meta is None:
+                    break
+                seq += 1
+                channels, conversion = RAW_TO_BGR[meta.pixel_format]
+                raw = scratch[:meta.width * meta.height * channels].reshape(
+                    meta.height, meta.width, channels)
+                if writer is None:
+                    writer = cv2.VideoWriter(
+                        event.path + ".avi", cv2.VideoWriter_fourcc(*RECORDING_FOURCC),
+                        fps, (meta.width, meta.height))
+                    size = (meta.width, meta.height)
+                if (meta.width, meta.height) != size:
+                    # The ROI changed mid-event, the video keeps its size
+                    event.overruns += 1
+                    continue
+                if conversion is None:
+                    frame = raw
+                else:
+                    if bgr is None or bgr.shape[:2] != (meta.height, meta.width):
+                        bgr = np.empty((meta.height, meta.width, 3), dtype=np.uint8)
+                    source = raw if channels == 3 else raw[..., 0]
+                    frame = cv2.cvtColor(source, conversion, dst=bgr)
+                writer.write(frame)
+                event.frames.append(meta)
+        finally:
+            if writer is not None:
+                writer.release()
+        with open(event.path + ".json", "w") as f:
+            json.dump({**self._event_info(event), "fps": fps, "frames": [
+                {"frame_id": meta.frame_id, "device_timestamp": meta.device_timestamp,
+                 "host_timestamp": meta.host_timestamp} for meta in event.frames]}, f)
+
+    def _event_info(self, event):
+        info = {"id": event.id, "path": event.path, "frames": len(event.frames),
+                "overruns": event.overruns}
+        if event.error is not None:
+            info["error"] = event.error
+        return info
+
+    def stats(self):
+        with self._cond:
+            frames = [meta for meta in self._meta if meta is not None]
+            seconds = 0.0
+            if len(frames) > 1:
+                seconds = (max(meta.captured_at for meta in frames)
+                           - min(meta.captured_at for meta in frames))
+            return {
+                "budget": self.budget,
+                "slots": len(self._meta),
+                "buffered_frames": len(frames),
+                "buffered_seconds": seconds,
+                "pushed": self.pushed,
+                "unsupported": self.unsupported,
+                "too_large": self.too_large,
+                "pending_events": len(self._events) + (self._current is not None),
+                "saved_events": len(self.saved),
+            }
+
+    def close(self, timeout=10.0):
+        """
+        Ends the event being written with the frames it has (waiting up to
+        `timeout` seconds for the files), drops queued events and frees the
+        ring
+        """
+        with self._cond:
+            self._closed = True
+            self._events.clear()
+            self._cond.notify_all()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._slots = None
+            self._meta = []
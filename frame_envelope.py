@@ -0,0 +1,68 @@
+"""
+Fixed-size binary header in front of each streamed frame.
+
+Layout (little endian, HEADER_SIZE bytes):
+
+    magic            2s   b"WF"
+    version          B    ENVELOPE_VERSION
+    format           B    FORMAT_JPEG
+    flags            H    FLAG_* bits
+    width, height    H H  size of the encoded image
+    stream id        H    camera of a multi-camera server, 0 otherwise
+    frame id         Q    camera frame counter
+    device timestamp Q    camera clock (ns on IDS, device ticks on MVS)
+    host timestamp   Q    time.time_ns() when the frame was grabbed
+
+Clients opt in with `"envelope": true` (or the version number) on
+start_stream; everyone else keeps getting bare JPEG bytes.
+"""
+import struct
+from collections import namedtuple
+
+ENVELOPE = struct.Struct("<2sBBHHHHQQQ")
+HEADER_SIZE = ENVELOPE.size
+MAGIC = b"WF"
+ENVELOPE_VERSION = 1
+
+FORMAT_JPEG = 1
+
+# Frames were lost between the previous frame and this one
+FLAG_DISCONTINUITY = 0x1
+# The image was resized on the host after acquisition
+FLAG_RESIZED = 0x2
+
+FrameHeader = namedtuple(
+    "FrameHeader",
+    "version format flags width height stream_id frame_id device_timestamp host_timestamp")
+
+
+def pack_header(buffer, frame_id, device_timestamp, host_timestamp, width, height,
+                flags=0, image_format=FORMAT_JPEG, stream_id=0):
+    """
+    Writes the header into the first HEADER_SIZE bytes of `buffer`
+    """
+    ENVELOPE.pack_into(buffer, 0, MAGIC, ENVELOPE_VERSION, image_format, flags,
+                       width, height, stream_id, frame_id, device_timestamp, host_timestamp)
+
+
+def unpack_header(message):
+    """
+    Reads the header of an enveloped message. Raises ValueError when the
+    message does not start with one.
+    """
+    if len(message) < HEADER_SIZE:
+        raise ValueError("Message shorter than the frame header")
+    magic, *fields = ENVELOPE.unpack_from(message)
+    if magic != MAGIC:
+        raise ValueError("Message does not start with a frame header")
+    return FrameHeader(*fields)
+
+
+def negotiate(requested):
+    """
+    Returns the envelope description to put in the start_stream reply, or
+    None when the client did not ask for (a supported) envelope
+    """
+    if requested is True or requested == ENVELOPE_VERSION:
+        return {"version": ENVELOPE_VERSION, "header_size": HEADER_SIZE}
+    return None
@@ -0,0 +1,172 @@
+import time
+
+import numpy as np
+
+from camera_backend import FrameInfo
+
+
+class FrameRing:
+    """
+    Fixed set of preallocated output arrays that frames are converted into.
+    Slots are handed out round-robin, so an array returned by `next_slot`
+    stays valid until the ring wraps around to it again.
+    """
+
+    def __init__(self, height, width, channels=3, slots=3, dtype=np.uint8):
+        self.shape = (height, width, channels)
+        self.dtype = np.dtype(dtype)
+        self._slots = [np.empty(self.shape, dtype=self.dtype) for _ in range(slots)]
+        self._index = 0
+        # Number of arrays this ring has ever allocated, lets callers verify
+        # that steady-state streaming does not allocate per frame
+        self.allocations = slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def matches(self, height, width, channels=3):
+        return self.shape == (height, width, channels)
+
+    def next_slot(self):
+        slot = self._slots[self._index]
+        self._index = (self._index + 1) % len(self._slots)
+        return slot
+
+
+class FrameGrabber:
+    """
+    Waits for finished datastream buffers and converts them straight into a
+    FrameRing using a pre-allocated ImageConverter, so no conversion buffer
+    or numpy copy is created per frame.
+
+    `buffer_to_image` turns a datastream buffer into an image the converter
+    accepts (`ids_peak_ipl_extension.BufferToImage` for real cameras).
+    With `timers` (a StageTimers) the buffer wait and the conversion are
+    timed as the "buffer_wait" and "conversion" stages. `frame_info` is the
+    FrameInfo of the last grabbed buffer. `raw_sink(image, frame_info)` is
+    called with the unconverted image while the buffer is still held.
+    """
+
+    def __init__(self, datastream, converter, buffer_to_image, pixel_format, slots=3,
+                 timers=None, raw_sink=None):
+        self._datastream = datastream
+        self._converter = converter
+        self._buffer_to_image = buffer_to_image
+        self._pixel_format = pixel_format
+        self._slots = slots
+        self._timers = timers
+        self._raw_sink = raw_sink
+        self.ring = None
+        self.frame_info = None
+
+    def prepare(self, input_pixel_format, width, height, channels=3):
+        """
+        Pre-allocates the conversion buffers and (re)creates the output ring
+        when the frame size changed. Call before acquisition starts.
+        """
+        self._converter.PreAllocateConversion(
+            input_pixel_format, self._pixel_format, width, height)
+        if self.ring is None or not self.ring.matches(height, width, channels):
+            self.ring = FrameRing(height, width, channels, self._slots)
+
+    def grab(self, timeout_ms):
+        """
+        Returns the next frame as an array owned by the ring. The buffer is
+        handed back to the datastream as soon as conversion is done.
+        """
+        started = time.perf_counter()
+        buffer = self._datastream.WaitForFinishedBuffer(timeout_ms)
+        received = time.perf_counter()
+        try:
+            self.frame_info = FrameInfo(buffer.FrameID(), buffer.Timestamp_ns())
+            image = self._buffer_to_image(buffer)
+            if self._raw_sink is not None:
+                self._raw_sink(image, self.frame_info)
+            out = self.ring.next_slot()
+            self._converter.Convert(image, self._pixel_format, out.ctypes.data, out.nbytes)
+        finally:
+            self._datastream.QueueBuffer(buffer)
+        if self._timers is not None:
+            self._timers.record("buffer_wait", received - started)
+            self._timers.record("conversion", time.perf_counter() - received)
+        return out
+
+
+# Position (row, column) of the red and blue pixel inside a 2x2 Bayer tile
+BAYER_OFFSETS = {
+    "BayerRG8": ((0, 0), (1, 1)),
+    "BayerBG8": ((1, 1), (0, 0)),
+    "BayerGR8": ((0, 1), (1, 0)),
+    "BayerGB8": ((1, 0), (0, 1)),
+}
+
+
+def reduction_factor(width, height, target_width, target_height):
+    """
+    Largest power of two a width x height frame can be shrunk by while still
+    covering the target size
+    """
+    factor = 1
+    while width // (factor * 2) >= target_width and height // (factor * 2) >= target_height:
+        factor *= 2
+    return factor
+
+
+class HalfResBayerGrabber:
+    """
+    Grabs 8 bit Bayer frames and turns every 2x2 tile into one BGR pixel
+    straight from the raw buffer, so a downscaled stream never pays for a
+    full resolution demosaic. Output goes into a FrameRing like FrameGrabber.
+    """
+
+    def __init__(self, datastream, buffer_to_image, bayer_format, slots=3, timers=None,
+                 raw_sink=None):
+        self._datastream = datastream
+        self._buffer_to_image = buffer_to_image
+        self._offsets = BAYER_OFFSETS[bayer_format]
+        self._slots = slots
+        self._timers = timers
+        self._raw_sink = raw_sink
+        self._green = None
+        self.ring = None
+        self.frame_info = None
+
+    @staticmethod
+    def supports(pixel_format_name):
+        return pixel_format_name in BAYER_OFFSETS
+
+    def prepare(self, width, height):
+        half_height, half_width = height // 2, width // 2
+        if self.ring is None or not self.ring.matches(half_height, half_width):
+            self.ring = FrameRing(half_height, half_width, 3, self._slots)
+            self._green = np.empty((half_height, half_width), dtype=np.uint16)
+
+    def grab(self, timeout_ms):
+        started = time.perf_counter()
+        buffer = self._datastream.WaitForFinishedBuffer(timeout_ms)
+        received = time.perf_counter()
+        try:
+            self.frame_info = FrameInfo(buffer.FrameID(), buffer.Timestamp_ns())
+            image = self._buffer_to_image(buffer)
+            if self._raw_sink is not None:
+                self._raw_sink(image, self.frame_info)
+            raw = image.get_numpy_2D()
+            out = self.ring.next_slot()
+            self._demosaic(raw, out)
+        finally:
+            self._datastream.QueueBuffer(buffer)
+        if self._timers is not None:
+            self._timers.record("buffer_wait", received - started)
+            self._timers.record("conversion", time.perf_counter() - received)
+        return out
+
+    def _demosaic(self, raw, out):
+        (red_y, red_x), (blue_y, blue_x) = self._offsets
+        height, width = out.shape[0] * 2, out.shape[1] * 2
+        raw = raw[:height, :width]
+        out[..., 2] = raw[red_y::2, red_x::2]
+        out[..., 0] = raw[blue_y::2, blue_x::2]
+        # The two greens sit on the other diagonal of the tile
+        np.add(raw[red_y::2, 1 - red_x::2], raw[1 - red_y::2, red_x::2],
+               out=self._green, dtype=np.uint16)
+        np.right_shift(self._green, 1, out=out[..., 1], casting="unsafe")
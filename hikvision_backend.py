@@ -0,0 +1,356 @@
+import time
+from ctypes import *
+
+import numpy as np
+from MvImport.MvCameraControl_class import *
+
+from camera_backend import CameraBackend, FrameInfo, GrabTimeout, ParameterDescriptor
+from frame_ring import FrameRing
+
+# MV_CC_GetImageBuffer returns this when no frame arrived in time
+MV_E_NODATA = 0x80000007
+
+# MV_XML_GetNodeAccessMode result -> ParameterDescriptor access
+NODE_ACCESS = {AM_RW: "rw", AM_RO: "ro", AM_WO: "wo"}
+
+# enPixelType -> GenICam name of the raw formats the event recorder keeps
+RAW_PIXEL_FORMATS = {
+    PixelType_Gvsp_Mono8: "Mono8",
+    PixelType_Gvsp_BayerRG8: "BayerRG8",
+    PixelType_Gvsp_BayerBG8: "BayerBG8",
+    PixelType_Gvsp_BayerGR8: "BayerGR8",
+    PixelType_Gvsp_BayerGB8: "BayerGB8",
+    PixelType_Gvsp_RGB8_Packed: "RGB8",
+    PixelType_Gvsp_BGR8_Packed: "BGR8",
+}
+
+
+class HikvisionCamera(CameraBackend):
+    """
+    Hikvision MVS camera. Frames are converted to BGR8 by the SDK straight
+    into a FrameRing; the conversion parameters are allocated once per
+    resolution and the SDK buffer is released right after conversion.
+
+    A sensor ROI is programmed through OffsetX/OffsetY/Width/Height while
+    grabbing is stopped; the SDK sizes its buffers for the new payload on
+    the next MV_CC_StartGrabbing.
+
+    Triggered acquisition uses the FrameBurstStart trigger; a software
+    trigger is the TriggerSoftware command.
+    """
+
+    name = "hikvision"
+
+    def __init__(self):
+        super().__init__()
+        self.cam = None
+        self._device_list = None
+        self._devices = []
+        self._ring = None
+        self._slots = 3
+        self._convert_param = None
+        self._convert_key = None
+        self._frame_out = MV_FRAME_OUT()
+        self._last_frame_num = None
+        self._grabbing = False
+
+    def list_devices(self):
+        self._devices = []
+        # The SDK keeps pointers into this list, hold on to it while devices
+        # may be opened
+        self._device_list = MV_CC_DEVICE_INFO_LIST()
+        tlayerType = MV_GIGE_DEVICE | MV_USB_DEVICE
+        ret = MvCamera.MV_CC_EnumDevices(tlayerType, self._device_list)
+        if ret != 0:
+            return []
+
+        for i in range(self._device_list.nDeviceNum):
+            device_ptr = self._device_list.pDeviceInfo[i]
+            mvcc_dev_info = cast(device_ptr, POINTER(MV_CC_DEVICE_INFO)).contents
+
+            device_info = {
+                "index": i,
+                "ptr": device_ptr,
+                "type": "GigE" if mvcc_dev_info.nTLayerType == MV_GIGE_DEVICE else "USB"
+            }
+
+            if mvcc_dev_info.nTLayerType == MV_GIGE_DEVICE:
+                gige_info = mvcc_dev_info.SpecialInfo.stGigEInfo
+                ip = gige_info.nCurrentIp
+                device_info.update({
+                    "model": "".join([chr(c) for c in gige_info.chModelName if c != 0]),
+                    "serial": "".join([chr(c) for c in gige_info.chSerialNumber if c != 0]),
+                    "ip": f"{(ip>>24)&0xFF}.{(ip>>16)&0xFF}.{(ip>>8)&0xFF}.{ip&0xFF}"
+                })
+            else:
+                usb_info = mvcc_dev_info.SpecialInfo.stUsb3VInfo
+                device_info.update({
+                    "model": "".join([chr(c) for c in usb_info.chModelName if c != 0]),
+                    "serial": "".join([chr(c) for c in usb_info.chSerialNumber if c != 0])
+                })
+
+            self._devices.append(device_info)
+
+        return [{k: v for k, v in d.items() if k != "ptr"} for d in self._devices]
+
+    def open(self, index=0):
+        if not self._devices:
+            self.list_devices()
+        if index < 0 or index >= len(self._devices):
+            raise ValueError("Invalid device index")
+
+        device_info = self._devices[index]
+        st_device_info = cast(device_info['ptr'], POINTER(MV_CC_DEVICE_INFO)).contents
+
+        self.cam = MvCamera()
+        ret = self.cam.MV_CC_CreateHandle(st_device_info)
+        if ret != 0:
+            self.cam = None
+            raise Exception(f"Create handle failed: {ret}")
+
+        ret = self.cam.MV_CC_OpenDevice(MV_ACCESS_Exclusive, 0)
+        if ret != 0:
+            self.cam.MV_CC_DestroyHandle()
+            self.cam = None
+            raise Exception(f"Open device failed: {ret}")
+
+        self.model = device_info["model"]
+        self.serial = device_info["serial"]
+        # Configure default settings
+        self.cam.MV_CC_SetEnumValue("TriggerMode", MV_TRIGGER_MODE_OFF)
+        self.trigger_mode = "off"
+        self.clear_parameter_cache()
+        self.cam.MV_CC_SetEnumValue("AcquisitionMode", MV_ACQ_MODE_CONTINUOUS)
+
+    def close(self):
+        if self.cam:
+            self.stop()
+            self.cam.MV_CC_CloseDevice()
+            self.cam.MV_CC_DestroyHandle()
+            self.cam = None
+            print("Camera closed")
+
+    @property
+    def is_open(self):
+        return self.cam is not None
+
+    @property
+    def is_running(self):
+        return self._grabbing
+
+    def start(self, target_size=None, slots=3):
+        if self.cam is None:
+            raise RuntimeError("Camera not open")
+        if self._grabbing:
+            return
+        self.target_size = target_size
+        self._slots = slots
+        self.width = self.get_parameter("Width")
+        self.height = self.get_parameter("Height")
+
+        ret = self.cam.MV_CC_StartGrabbing()
+        if ret != 0:
+            raise Exception(f"Start grabbing failed: {ret}")
+        self.acquisition_stats.reset()
+        self._last_frame_num = None
+        self._grabbing = True
+
+    def stop(self):
+        if self.cam is None or not self._grabbing:
+            return
+        self._grabbing = False
+        self.cam.MV_CC_StopGrabbing()
+
+    def _prepare_conversion(self, frame_info):
+        """
+        Allocates the conversion parameters and the output ring once per
+        resolution/pixel type, they are reused for every following frame
+        """
+        key = (frame_info.nWidth, frame_info.nHeight, frame_info.enPixelType)
+        if self._convert_key == key and len(self._ring) == self._slots:
+            return self._convert_param
+        print(f"Streaming {frame_info.nWidth}x{frame_info.nHeight}. Pixel Type: {frame_info.enPixelType}")
+        self._ring = FrameRing(frame_info.nHeight, frame_info.nWidth, 3, self._slots)
+
+        convert_param = MV_CC_PIXEL_CONVERT_PARAM()
+        convert_param.nWidth = frame_info.nWidth
+        convert_param.nHeight = frame_info.nHeight
+        convert_param.enSrcPixelType = frame_info.enPixelType
+        convert_param.enDstPixelType = PixelType_Gvsp_BGR8_Packed
+        convert_param.nDstBufferSize = self._ring.shape[0] * self._ring.shape[1] * 3
+        self._convert_param = convert_param
+        self._convert_key = key
+        self.width, self.height = frame_info.nWidth, frame_info.nHeight
+        return convert_param
+
+    def grab(self, timeout_ms=1000):
+        started = time.perf_counter()
+        ret = self.cam.MV_CC_GetImageBuffer(self._frame_out, timeout_ms)
+        received = time.perf_counter()
+        if ret == MV_E_NODATA:
+            self.acquisition_stats.record_timeout()
+            raise GrabTimeout(f"No frame within {timeout_ms} ms")
+        if ret != 0:
+            self.acquisition_stats.record_error()
+            raise Exception(f"Get image buffer failed: 0x{ret:x}")
+        try:
+            frame_info = self._frame_out.stFrameInfo
+            info = FrameInfo(
+                frame_info.nFrameNum,
+                (frame_info.nDevTimeStampHigh << 32) | frame_info.nDevTimeStampLow)
+            if self.raw_recorder is not None:
+                raw = np.ctypeslib.as_array(
+                    cast(self._frame_out.pBufAddr, POINTER(c_ubyte)), shape=(frame_info.nFrameLen,))
+                self._record_raw(raw, frame_info.nWidth, frame_info.nHeight,
+                                 RAW_PIXEL_FORMATS.get(frame_info.enPixelType),
+                                 info)
+            convert_param = self._prepare_conversion(frame_info)
+            out = self._ring.next_slot()
+            convert_param.pSrcData = cast(self._frame_out.pBufAddr, POINTER(c_ubyte))
+            convert_param.nSrcDataLen = frame_info.nFrameLen
+            convert_param.pDstBuffer = out.ctypes.data_as(POINTER(c_ubyte))
+            ret = self.cam.MV_CC_ConvertPixelType(convert_param)
+            if ret != 0:
+                self.acquisition_stats.record_error()
+                raise Exception(f"Pixel conversion failed: 0x{ret:x}")
+            self._count_lost_frames(frame_info.nFrameNum)
+            self.last_frame_info = info
+        finally:
+            self.cam.MV_CC_FreeImageBuffer(self._frame_out)
+        self.stage_timers.record("buffer_wait", received - started)
+        self.stage_timers.record("conversion", time.perf_counter() - received)
+        self.acquisition_stats.record_frame()
+        self._record_trigger_latency()
+        return self._crop(out)
+
+    def _set_aligned_int(self, name, value):
+        """
+        Sets an integer node clamped to its range and rounded down to its
+        increment. Returns the value set.
+        """
+        current = MVCC_INTVALUE()
+        ret = self.cam.MV_CC_GetIntValue(name, current)
+        if ret != 0:
+            raise ValueError(f"{name} not available: 0x{ret:x}")
+        value = max(min(int(value), current.nMax), current.nMin)
+        if current.nInc > 1:
+            value -= (value - current.nMin) % current.nInc
+        ret = self.cam.MV_CC_SetIntValue(name, value)
+        if ret != 0:
+            raise ValueError(f"Setting {name} failed: 0x{ret:x}")
+        return value
+
+    def _set_sensor_roi(self, x, y, width, height):
+        # Offsets first go to 0 so any size is in range, and are set last
+        # because their maximum depends on the size
+        self._set_aligned_int("OffsetX", 0)
+        self._set_aligned_int("OffsetY", 0)
+        width = self._set_aligned_int("Width", width)
+        height = self._set_aligned_int("Height", height)
+        x = self._set_aligned_int("OffsetX", x)
+        y = self._set_aligned_int("OffsetY", y)
+        return x, y, width, height
+
+    def _reset_sensor_roi(self):
+        try:
+            self._set_aligned_int("OffsetX", 0)
+            self._set_aligned_int("OffsetY", 0)
+            for name in ("Width", "Height"):
+                maximum = MVCC_INTVALUE()
+                self.cam.MV_CC_GetIntValue(name, maximum)
+                self._set_aligned_int(name, maximum.nMax)
+        except ValueError as e:
+            print(f"Exception (reset ROI): {str(e)}")
+
+    def _set_enum(self, name, value):
+        ret = self.cam.MV_CC_SetEnumValueByString(name, value)
+        if ret != 0:
+            raise ValueError(f"Setting {name} to {value} failed: 0x{ret:x}")
+
+    def _apply_trigger(self, mode, source, activation):
+        if mode == "off":
+            self._set_enum("TriggerMode", "Off")
+            return
+        self._set_enum("TriggerSelector", "FrameBurstStart")
+        self._set_enum("TriggerSource", source)
+        if activation is not None:
+            self._set_enum("TriggerActivation", activation)
+        self._set_enum("TriggerMode", "On")
+
+    def _send_software_trigger(self):
+        ret = self.cam.MV_CC_SetCommandValue("TriggerSoftware")
+        if ret != 0:
+            raise Exception(f"Software trigger failed: 0x{ret:x}")
+
+    def _count_lost_frames(self, frame_num):
+        # Frame numbers are consecutive, gaps are frames the SDK dropped
+        if self._last_frame_num is not None and frame_num > self._last_frame_num + 1:
+            self.acquisition_stats.dropped += frame_num - self._last_frame_num - 1
+        self._last_frame_num = frame_num
+
+    def get_parameter(self, name):
+        value = MVCC_FLOATVALUE()
+        if self.cam.MV_CC_GetFloatValue(name, value) == 0:
+            return value.fCurValue
+        value = MVCC_INTVALUE()
+        if self.cam.MV_CC_GetIntValue(name, value) == 0:
+            return value.nCurValue
+        value = MVCC_ENUMVALUE()
+        if self.cam.MV_CC_GetEnumValue(name, value) == 0:
+            return value.nCurValue
+        value = c_bool(False)
+        if self.cam.MV_CC_GetBoolValue(name, value) == 0:
+            return value.value
+        raise KeyError(name)
+
+    def get_parameter_range(self, name):
+        value = MVCC_FLOATVALUE()
+        if self.cam.MV_CC_GetFloatValue(name, value) == 0:
+            return value.fMin, value.fMax
+        value = MVCC_INTVALUE()
+        if self.cam.MV_CC_GetIntValue(name, value) == 0:
+            return value.nMin, value.nMax
+        raise KeyError(name)
+
+    def describe_parameter(self, name):
+        access_mode = MV_XML_AccessMode()
+        if self.cam.MV_XML_GetNodeAccessMode(name, access_mode) != 0:
+            raise KeyError(name)
+        access = NODE_ACCESS.get(access_mode.value, "na")
+        value = MVCC_FLOATVALUE()
+        if self.cam.MV_CC_GetFloatValue(name, value) == 0:
+            return ParameterDescriptor(name, "float", value.fMin, value.fMax, None, None, access, None)
+        value = MVCC_INTVALUE()
+        if self.cam.MV_CC_GetIntValue(name, value) == 0:
+            return ParameterDescriptor(name, "int", value.nMin, value.nMax, value.nInc, None,
+                                       access, None)
+        value = MVCC_ENUMVALUE()
+        if self.cam.MV_CC_GetEnumValue(name, value) == 0:
+            # MVS reports enum entries by value, like get_parameter
+            entries = tuple(value.nSupportValue[i] for i in range(value.nSupportedNum))
+            return ParameterDescriptor(name, "enum", None, None, None, None, access, entries)
+        value = c_bool(False)
+        if self.cam.MV_CC_GetBoolValue(name, value) == 0:
+            return ParameterDescriptor(name, "bool", None, None, None, None, access, None)
+        raise KeyError(name)
+
+    def _write_parameter(self, name, value):
+        current = MVCC_FLOATVALUE()
+        if self.cam.MV_CC_GetFloatValue(name, current) == 0:
+            value = max(min(float(value), current.fMax), current.fMin)
+            ret = self.cam.MV_CC_SetFloatValue(name, value)
+        else:
+            current = MVCC_INTVALUE()
+            if self.cam.MV_CC_GetIntValue(name, current) == 0:
+                value = max(min(int(value), current.nMax), current.nMin)
+                if current.nInc > 1:
+                    value -= (value - current.nMin) % current.nInc
+                ret = self.cam.MV_CC_SetIntValue(name, value)
+            elif isinstance(value, bool):
+                ret = self.cam.MV_CC_SetBoolValue(name, value)
+            elif isinstance(value, str):
+                ret = self.cam.MV_CC_SetEnumValueByString(name, value)
+            else:
+                ret = self.cam.MV_CC_SetEnumValue(name, int(value))
+        if ret != 0:
+            raise ValueError(f"SDK error 0x{ret:x}")
@@ -0,0 +1,455 @@
+from ids_peak import ids_peak
+from ids_peak_ipl import ids_peak_ipl
+from ids_peak import ids_peak_ipl_extension
+
+from camera_backend import CameraBackend, GrabTimeout, ParameterDescriptor
+from frame_ring import FrameGrabber, HalfResBayerGrabber, reduction_factor
+
+STREAM_PIXEL_FORMAT = ids_peak_ipl.PixelFormatName_BGR8
+ROI_NODES = ("OffsetX", "OffsetY", "Width", "Height")
+NODE_ACCESS = {
+    ids_peak.NodeAccessStatus_ReadWrite: "rw",
+    ids_peak.NodeAccessStatus_ReadOnly: "ro",
+    ids_peak.NodeAccessStatus_WriteOnly: "wo",
+}
+
+
+def _aligned(node, value):
+    """
+    Clamps `value` to the node's range and rounds it down to its increment
+    """
+    minimum, maximum = node.Minimum(), node.Maximum()
+    value = max(min(int(value), maximum), minimum)
+    increment = node.Inc() if node.Inc() > 0 else 1
+    return minimum + (value - minimum) // increment * increment
+
+
+class IdsCamera(CameraBackend):
+    """
+    IDS peak camera. Frames are converted straight into a FrameRing; for
+    downscaled streams the camera bins/decimates on the sensor and Bayer
+    frames may be demosaiced at half resolution (see `start`).
+
+    A sensor ROI takes the place of binning: it is programmed in full
+    resolution sensor pixels.
+
+    The device and its announced buffers stay up between `stop` and
+    `start`, which only toggle acquisition and requeue the buffers; the
+    pool is reallocated when PayloadSize has changed (ROI, binning, pixel
+    format) since it was announced.
+
+    Triggered acquisition uses the ExposureStart trigger; a software
+    trigger executes TriggerSoftware.
+    """
+
+    name = "ids"
+
+    def __init__(self, buffer_count_factor=5):
+        super().__init__()
+        ids_peak.Library.Initialize()
+        self.device_manager = ids_peak.DeviceManager.Instance()
+        self.buffer_count_factor = buffer_count_factor
+        self.max_fps = 0
+        self.frame_rate = None        # AcquisitionFrameRate the user set, None for the maximum
+        self.max_gain = 1
+        self.sensor_reduction = 1  # Binning/decimation factor applied on the camera
+        self._device = None
+        self._datastream = None
+        self._node_map = None
+        self._grabber = None
+        self._image_converter = None
+        self._acquisition_running = False
+        self._dropped_at_start = 0
+        self._lost_at_start = 0
+        self._raw_pixel_format = None
+        self._payload_size = 0        # Size of the announced buffers
+        self._nodes = {}              # Name -> node handle of the open device
+
+    def __del__(self):
+        self.close()
+
+    def list_devices(self):
+        self.device_manager.Update()
+        devices = []
+        for idx, device in enumerate(self.device_manager.Devices()):
+            devices.append({
+                "index": idx,
+                "type": device.ParentInterface().DisplayName(),
+                "model": device.ModelName(),
+                "serial": device.SerialNumber(),
+            })
+        return devices
+
+    def open(self, index=0):
+        self.device_manager.Update()
+        devices = self.device_manager.Devices()
+        if devices.empty():
+            raise RuntimeError("No devices found")
+        if index >= len(devices):
+            raise IndexError("Invalid device index")
+
+        self._device = devices[index].OpenDevice(ids_peak.DeviceAccessType_Control)
+        self._node_map = self._device.RemoteDevice().NodeMaps()[0]
+        self._nodes.clear()
+        self.model = self._device.ModelName()
+        self.serial = self._device.SerialNumber()
+        self.max_gain = self._node("Gain").Maximum()
+
+        self._node("UserSetSelector").SetCurrentEntry("Default")
+        self._node("UserSetLoad").Execute()
+        self._node("UserSetLoad").WaitUntilDone()
+        # The default user set is free-running
+        self.trigger_mode = "off"
+        self.clear_parameter_cache()
+
+        self._datastream = self._device.DataStreams()[0].OpenDataStream()
+        self._find_and_set_remote_device_enumeration("GainAuto", "Off")
+        self._find_and_set_remote_device_enumeration("ExposureAuto", "Off")
+        self.frame_rate = None
+        self._apply_frame_rate()
+        self._allocate_buffers()
+
+    def _apply_frame_rate(self):
+        # The achievable rate follows ROI, binning and size: run at the
+        # maximum, or at the rate the user set clamped to it
+        try:
+            node = self._node("AcquisitionFrameRate")
+            self.max_fps = node.Maximum()
+            node.SetValue(self.max_fps if self.frame_rate is None
+                          else min(self.frame_rate, self.max_fps))
+        except ids_peak.Exception:
+            print("Warning: Unable to limit fps, node AcquisitionFrameRate not supported")
+
+    def _allocate_buffers(self):
+        payload_size = self._node("PayloadSize").Value()
+        max_buffer = self._datastream.NumBuffersAnnouncedMinRequired() * self.buffer_count_factor
+        for idx in range(max_buffer):
+            self._datastream.AllocAndAnnounceBuffer(payload_size)
+        self._payload_size = payload_size
+
+    def _queue_buffers(self):
+        # Flush(DiscardAll) in stop leaves every buffer announced but not
+        # queued; they are only announced again for a new PayloadSize. A
+        # grab thread that finished after that flush may have queued its
+        # buffer again, so flush once more to queue each buffer exactly once
+        if self._node("PayloadSize").Value() != self._payload_size:
+            self._revoke_buffers()
+            self._allocate_buffers()
+        else:
+            self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
+        for buffer in self._datastream.AnnouncedBuffers():
+            self._datastream.QueueBuffer(buffer)
+
+    def _revoke_buffers(self):
+        self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
+        for buffer in self._datastream.AnnouncedBuffers():
+            self._datastream.RevokeBuffer(buffer)
+        self._payload_size = 0
+
+    def close(self):
+        self.stop()
+        if self._datastream is not None:
+            try:
+                self._revoke_buffers()
+            except Exception as e:
+                print(f"Exception (close): {str(e)}")
+            finally:
+                self._datastream = None
+        self._node_map = None
+        self._nodes.clear()
+        self._device = None
+
+    @property
+    def is_open(self):
+        return self._device is not None
+
+    @property
+    def is_running(self):
+        return self._acquisition_running
+
+    def _node(self, name):
+        """
+        Node `name` of the remote device, looked up in the node map once per
+        device; parameter reads and writes reuse the handle
+        """
+        node = self._nodes.get(name)
+        if node is None:
+            node = self._nodes[name] = self._node_map.FindNode(name)
+        return node
+
+    def _find_and_set_remote_device_enumeration(self, name: str, value: str):
+        all_entries = self._node(name).Entries()
+        available_entries = []
+        for entry in all_entries:
+            if (entry.AccessStatus() != ids_peak.NodeAccessStatus_NotAvailable
+                    and entry.AccessStatus() != ids_peak.NodeAccessStatus_NotImplemented):
+                available_entries.append(entry.SymbolicValue())
+        if value in available_entries:
+            self._node(name).SetCurrentEntry(value)
+
+    def start(self, target_size=None, slots=3):
+        if self._device is None:
+            raise RuntimeError("Camera not open")
+        if self._acquisition_running:
+            return
+
+        self.target_size = target_size
+
+        # Reduce resolution as early as possible for downscaled streams.
+        # Binning/decimation changes Width/Height, so it has to happen before
+        # the transport layer parameters are locked. An ROI already reduces
+        # the readout and is given in unbinned pixels, so it rules binning out
+        if self.sensor_reduction > 1:
+            # Left over from the previous start, the new target starts from
+            # the unbinned size
+            self._clear_sensor_reduction()
+        if target_size is not None and self.roi is None:
+            factor = reduction_factor(
+                self._node("Width").Value(),
+                self._node("Height").Value(),
+                *target_size)
+            self.sensor_reduction = self._apply_sensor_reduction(factor)
+        # Also picks up a size changed through setValues since the last start
+        self._apply_frame_rate()
+
+        try:
+            self._node("TLParamsLocked").SetValue(1)
+
+            self.width = self._node("Width").Value()
+            self.height = self._node("Height").Value()
+            pixel_format_entry = self._node("PixelFormat").CurrentEntry()
+            self._raw_pixel_format = pixel_format_entry.SymbolicValue()
+
+            if self._use_half_res_demosaic(pixel_format_entry.SymbolicValue()):
+                # Still at least twice the target size: demosaic at half
+                # resolution straight from the raw Bayer buffer
+                self._grabber = HalfResBayerGrabber(
+                    self._datastream, ids_peak_ipl_extension.BufferToImage,
+                    pixel_format_entry.SymbolicValue(), slots, self.stage_timers,
+                    self._record_raw_image)
+                self._grabber.prepare(self.width, self.height)
+                self.width, self.height = self.width // 2, self.height // 2
+            else:
+                input_pixel_format = ids_peak_ipl.PixelFormat(pixel_format_entry.Value())
+                self._image_converter = ids_peak_ipl.ImageConverter()
+                self._grabber = FrameGrabber(
+                    self._datastream, self._image_converter,
+                    ids_peak_ipl_extension.BufferToImage, STREAM_PIXEL_FORMAT, slots,
+                    self.stage_timers, self._record_raw_image)
+                self._grabber.prepare(input_pixel_format, self.width, self.height)
+
+            self._queue_buffers()
+            self._datastream.StartAcquisition()
+            self._node("AcquisitionStart").Execute()
+            self._node("AcquisitionStart").WaitUntilDone()
+        except Exception as e:
+            raise RuntimeError(f"Failed to start acquisition: {str(e)}") from e
+        self.acquisition_stats.reset()
+        self._dropped_at_start = self._stream_counter("StreamDroppedFrameCount")
+        self._lost_at_start = self._stream_counter("StreamLostFrameCount")
+        self._acquisition_running = True
+
+    def _apply_sensor_reduction(self, factor):
+        """
+        Bins, or failing that decimates, the sensor readout by up to `factor`
+        in both directions. Returns the factor that was actually applied.
+        """
+        if factor < 2:
+            return 1
+        for horizontal, vertical in (("BinningHorizontal", "BinningVertical"),
+                                     ("DecimationHorizontal", "DecimationVertical")):
+            try:
+                horizontal_node = self._node(horizontal)
+                vertical_node = self._node(vertical)
+                applied = factor
+                while applied > 1 and (applied > horizontal_node.Maximum()
+                                       or applied > vertical_node.Maximum()):
+                    applied //= 2
+                if applied < 2:
+                    continue
+                horizontal_node.SetValue(applied)
+                vertical_node.SetValue(applied)
+                print(f"Reducing resolution on the camera: {horizontal} x{applied}")
+                return applied
+            except ids_peak.Exception:
+                continue
+        return 1
+
+    def _use_half_res_demosaic(self, pixel_format_name):
+        if self.target_size is None or not HalfResBayerGrabber.supports(pixel_format_name):
+            return False
+        if self.software_roi is not None:
+            # The crop is given in full resolution pixels
+            return False
+        return reduction_factor(self.width, self.height, *self.target_size) >= 2
+
+    def stop(self):
+        if self._device is None or not self._acquisition_running:
+            return
+        try:
+            self._node("AcquisitionStop").Execute()
+            self._datastream.KillWait()
+            self._datastream.StopAcquisition(ids_peak.AcquisitionStopMode_Default)
+            self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
+            self._acquisition_running = False
+            self._node("TLParamsLocked").SetValue(0)
+        except Exception as e:
+            print(f"Exception (stop acquisition): {str(e)}")
+
+    def grab(self, timeout_ms=1000):
+        try:
+            frame = self._grabber.grab(timeout_ms)
+        except ids_peak.TimeoutException:
+            self.acquisition_stats.record_timeout()
+            raise GrabTimeout(f"No frame within {timeout_ms} ms") from None
+        except Exception:
+            self.acquisition_stats.record_error()
+            raise
+        self.acquisition_stats.record_frame()
+        self._record_trigger_latency()
+        self.last_frame_info = self._grabber.frame_info
+        return self._crop(frame)
+
+    def _apply_trigger(self, mode, source, activation):
+        try:
+            if mode == "off":
+                self._node("TriggerMode").SetCurrentEntry("Off")
+                return
+            self._node("TriggerSelector").SetCurrentEntry("ExposureStart")
+            self._node("TriggerSource").SetCurrentEntry(source)
+            if activation is not None:
+                self._node("TriggerActivation").SetCurrentEntry(activation)
+            self._node("TriggerMode").SetCurrentEntry("On")
+        except ids_peak.Exception as e:
+            raise ValueError(f"Trigger {mode} not available: {str(e)}") from e
+
+    def _send_software_trigger(self):
+        self._node("TriggerSoftware").Execute()
+        self._node("TriggerSoftware").WaitUntilDone()
+
+    def _record_raw_image(self, image, frame_info):
+        if self.raw_recorder is not None:
+            self._record_raw(image.get_numpy_1D(), image.Width(), image.Height(),
+                             self._raw_pixel_format, frame_info)
+
+    def _clear_sensor_reduction(self):
+        for name in ("BinningHorizontal", "BinningVertical",
+                     "DecimationHorizontal", "DecimationVertical"):
+            try:
+                self._node(name).SetValue(1)
+            except ids_peak.Exception:
+                continue
+        self.sensor_reduction = 1
+
+    def _set_sensor_roi(self, x, y, width, height):
+        # Runs with TLParamsLocked at 0 (acquisition stopped). Offsets go to
+        # their minimum first so any width/height is in range, and are set
+        # last because their maximum depends on the size.
+        self._clear_sensor_reduction()
+        nodes = {name: self._node(name) for name in ROI_NODES}
+        nodes["OffsetX"].SetValue(nodes["OffsetX"].Minimum())
+        nodes["OffsetY"].SetValue(nodes["OffsetY"].Minimum())
+        applied = {}
+        for name, value in (("Width", width), ("Height", height), ("OffsetX", x), ("OffsetY", y)):
+            applied[name] = _aligned(nodes[name], value)
+            nodes[name].SetValue(applied[name])
+        self._apply_frame_rate()
+        return applied["OffsetX"], applied["OffsetY"], applied["Width"], applied["Height"]
+
+    def _reset_sensor_roi(self):
+        try:
+            nodes = {name: self._node(name) for name in ROI_NODES}
+            nodes["OffsetX"].SetValue(nodes["OffsetX"].Minimum())
+            nodes["OffsetY"].SetValue(nodes["OffsetY"].Minimum())
+            nodes["Width"].SetValue(nodes["Width"].Maximum())
+            nodes["Height"].SetValue(nodes["Height"].Maximum())
+        except ids_peak.Exception as e:
+            print(f"Exception (reset ROI): {str(e)}")
+        self._apply_frame_rate()
+
+    def _stream_counter(self, name):
+        try:
+            return self._datastream.NodeMaps()[0].FindNode(name).Value()
+        except Exception:
+            return 0
+
+    def stats(self):
+        stream_dropped = stream_lost = 0
+        if self._acquisition_running:
+            # Read from the datastream on demand rather than per frame
+            stream_dropped = self._stream_counter("StreamDroppedFrameCount") - self._dropped_at_start
+            stream_lost = self._stream_counter("StreamLostFrameCount") - self._lost_at_start
+            self.acquisition_stats.dropped = stream_dropped + stream_lost
+        stats = super().stats()
+        stats.update(sensor_reduction=self.sensor_reduction, stream_dropped=stream_dropped,
+                     stream_lost=stream_lost)
+        return stats
+
+    def get_parameter(self, name):
+        node = self._node(name)
+        if isinstance(node, ids_peak.EnumerationNode):
+            return node.CurrentEntry().SymbolicValue()
+        if isinstance(node, ids_peak.BooleanNode):
+            return bool(node.Value())
+        if isinstance(node, (ids_peak.IntegerNode, ids_peak.FloatNode)):
+            return node.Value()
+        raise KeyError(name)
+
+    def get_parameter_range(self, name):
+        node = self._node(name)
+        if isinstance(node, (ids_peak.FloatNode, ids_peak.IntegerNode)):
+            return node.Minimum(), node.Maximum()
+        raise KeyError(name)
+
+    def describe_parameter(self, name):
+        try:
+            node = self._node(name)
+        except ids_peak.Exception:
+            raise KeyError(name) from None
+        access = NODE_ACCESS.get(node.AccessStatus(), "na")
+        if isinstance(node, ids_peak.FloatNode):
+            increment = node.Inc() if node.HasConstantIncrement() else None
+            return ParameterDescriptor(name, "float", node.Minimum(), node.Maximum(), increment,
+                                       node.Unit() or None, access, None)
+        if isinstance(node, ids_peak.IntegerNode):
+            return ParameterDescriptor(name, "int", node.Minimum(), node.Maximum(), node.Inc(),
+                                       node.Unit() or None, access, None)
+        if isinstance(node, ids_peak.EnumerationNode):
+            entries = tuple(entry.SymbolicValue() for entry in node.Entries() if entry.IsAvailable())
+            return ParameterDescriptor(name, "enum", None, None, None, None, access, entries)
+        if isinstance(node, ids_peak.BooleanNode):
+            return ParameterDescriptor(name, "bool", None, None, None, None, access, None)
+        if isinstance(node, ids_peak.CommandNode):
+            return ParameterDescriptor(name, "command", None, None, None, None, access, None)
+        raise KeyError(name)
+
+    def _write_parameter(self, name, value):
+        node = self._node(name)
+        if name == "AcquisitionFrameRate":
+            # Kept as requested, a later ROI or size change clamps it anew
+            self.frame_rate = float(value)
+        if isinstance(node, ids_peak.FloatNode):
+            value = float(value)
+            min_val = node.Minimum()
+            max_val = node.Maximum()
+            inc = node.Inc() if hasattr(node, 'Inc') and node.Inc() > 0 else None
+            if inc:
+                value = round(value / inc) * inc
+            value = max(min(value, max_val), min_val)
+            node.SetValue(value)
+        elif isinstance(node, ids_peak.IntegerNode):
+            value = int(value)
+            value = max(min(value, node.Maximum()), node.Minimum())
+            if node.Inc() > 1:
+                value -= (value - node.Minimum()) % node.Inc()
+            node.SetValue(value)
+        elif isinstance(node, ids_peak.EnumerationNode):
+            entries = [entry.SymbolicValue() for entry in node.Entries() if entry.IsAvailable()]
+            if value in entries:
+                node.SetCurrentEntry(value)
+            else:
+                raise ValueError(f"Value {value} not available for {name}")
+        elif isinstance(node, ids_peak.BooleanNode):
+            node.SetValue(bool(value))
+        else:
+            raise ValueError(f"Unsupported node type: {type(node)}")
@@ -0,0 +1,106 @@
+import os
+import threading
+
+import cv2
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+except ImportError:
+    TurboJPEG = TJPF_BGR = TJSAMP_420 = None
+
+# libturbojpeg location, None lets PyTurboJPEG search its default paths
+TURBOJPEG_LIB = os.environ.get("TURBOJPEG_LIB", r"C:\libjpeg-turbo-gcc64\bin\libturbojpeg.dll")
+JPEG_QUALITY = 75
+
+
+def load_turbojpeg(lib_path=TURBOJPEG_LIB):
+    """
+    Loads libturbojpeg, falling back to PyTurboJPEG's default search paths.
+    Returns None when the module or the library is not available.
+    """
+    if TurboJPEG is None:
+        return None
+    for path in (lib_path, None):
+        if path is not None and not os.path.exists(path):
+            continue
+        try:
+            return TurboJPEG(path)
+        except (OSError, RuntimeError):
+            pass
+    return None
+
+
+class JpegEncoder:
+    """
+    Encodes BGR frames to JPEG, once per camera instead of once per frame.
+
+    With TurboJPEG the JPEG is written into one of `buffers` preallocated
+    output buffers (sized for the worst case of the frame size) and returned
+    as a memoryview, so steady-state encoding allocates nothing. Buffers are
+    handed out round-robin; a returned view stays valid until the ring wraps
+    around to it, so `buffers` must cover every frame that can be queued
+    between encoder and websocket (see `ring_size`). websockets copies the
+    payload when `send` is called, so a frame only needs to live that long.
+
+    Without TurboJPEG it falls back to cv2.imencode and returns a view of
+    its output array, which skips the extra `tobytes` copy.
+    """
+
+    def __init__(self, quality=JPEG_QUALITY, buffers=8, lib_path=TURBOJPEG_LIB,
+                 use_turbojpeg=True):
+        self.quality = quality
+        self._turbojpeg = load_turbojpeg(lib_path) if use_turbojpeg else None
+        self._lock = threading.Lock()
+        self._buffers = [None] * buffers
+        self._index = 0
+        # Number of output buffers ever allocated, only grows when the frame
+        # size changes
+        self.allocations = 0
+
+    @property
+    def backend(self):
+        return "turbojpeg" if self._turbojpeg is not None else "opencv"
+
+    @staticmethod
+    def ring_size(workers, max_queue):
+        # Frames being encoded or waiting for their turn (at most `workers`),
+        # the broadcaster's latest-frame slot, the newest `max_queue` frames
+        # that subscriber queues may hold, and one popped frame whose send
+        # has not copied it yet
+        return workers + 1 + max_queue + 1
+
+    def encode(self, np_image, header_size=0):
+        """
+        Returns the JPEG as a memoryview. Safe to call from several threads.
+
+        With `header_size` the view starts with that many writable bytes
+        reserved for a frame header, followed by the JPEG.
+        """
+        if self._turbojpeg is None:
+            success, jpeg_buffer = cv2.imencode(
+                '.jpg', np_image, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+            if not success:
+                raise RuntimeError("Failed to encode JPEG")
+            jpeg = memoryview(jpeg_buffer).cast("B")
+            if not header_size:
+                return jpeg
+            out = bytearray(header_size + len(jpeg))
+            out[header_size:] = jpeg
+            return memoryview(out)
+
+        dst = self._next_buffer(header_size + self._turbojpeg.buffer_size(np_image, TJSAMP_420))
+        _, size = self._turbojpeg.encode(
+            np_image, quality=self.quality, pixel_format=TJPF_BGR,
+            jpeg_subsample=TJSAMP_420, dst=memoryview(dst)[header_size:])
+        return memoryview(dst)[:header_size + size]
+
+    def _next_buffer(self, size):
+        with self._lock:
+            index = self._index
+            self._index = (index + 1) % len(self._buffers)
+            buffer = self._buffers[index]
+            if buffer is None or len(buffer) < size:
+                buffer = bytearray(size)
+                self._buffers[index] = buffer
+                self.allocations += 1
+        return buffer
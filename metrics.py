@@ -0,0 +1,156 @@
+"""
+Prometheus text exposition of CameraStream statistics.
+
+`serve_metrics` answers `GET /metrics` on a local port from the server's
+event loop; every scrape samples the live counters, so there is no extra
+thread and nothing to keep in sync. Counters are cumulative since the
+stream started, stage latencies are the rolling histogram percentiles,
+exported as summary quantiles without _sum and _count.
+"""
+import asyncio
+import os
+
+# Local port for the metrics endpoint of the config server, 0 disables it.
+# The other servers pass their own default to metrics_port, so several of
+# them can run on one host.
+METRICS_PORT = 9108
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name -> (type, help)
+METRICS = {
+    "camera_frames_acquired_total": ("counter", "Frames grabbed from the camera"),
+    "camera_grab_timeouts_total": ("counter", "Grabs that timed out"),
+    "camera_grab_errors_total": ("counter", "Grabs that failed"),
+    "camera_sdk_dropped_frames_total": ("counter", "Frames the camera or transport layer dropped"),
+    "camera_sdk_stream_dropped_frames_total": ("counter", "Frames the datastream dropped for lack of buffers"),
+    "camera_sdk_stream_lost_frames_total": ("counter", "Frames lost on the transport layer"),
+    "camera_frames_encoded_total": ("counter", "Frames JPEG-encoded"),
+    "camera_encode_errors_total": ("counter", "Frames that failed to encode"),
+    "camera_frames_published_total": ("counter", "Encoded frames handed to the broadcaster"),
+    "camera_frames_sent_total": ("counter", "Frames sent to all clients"),
+    "camera_frames_dropped_total": ("counter", "Encoded frames dropped before reaching a client"),
+    "camera_encode_fps": ("gauge", "Average encode rate since the stream started"),
+    "camera_subscribers": ("gauge", "Clients subscribed to the stream"),
+    "camera_stage_latency_seconds": ("summary", "Rolling per-stage latency percentiles"),
+    "camera_client_frames_sent_total": ("counter", "Frames sent to the client"),
+    "camera_client_frames_dropped_total": ("counter", "Frames dropped from the client queue"),
+    "camera_client_bytes_sent_total": ("counter", "Payload bytes sent to the client"),
+    "camera_client_bytes_per_second": ("gauge", "Average payload rate since the client subscribed"),
+    "camera_client_queue_depth": ("gauge", "Frames waiting in the client queue"),
+    "camera_client_stage_latency_seconds": ("summary", "Rolling per-client latency percentiles"),
+}
+QUANTILES = (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _stage_samples(name, stages, labels):
+    for stage, snapshot in stages.items():
+        for quantile, key in QUANTILES:
+            yield name, {**labels, "stage": stage, "quantile": quantile}, snapshot[key] / 1000
+
+
+def _camera_samples(camera_id, stats):
+    labels = {"camera": camera_id}
+    camera = stats["camera"]
+    yield "camera_frames_acquired_total", labels, camera["frames"]
+    yield "camera_grab_timeouts_total", labels, camera["timeouts"]
+    yield "camera_grab_errors_total", labels, camera["errors"]
+    yield "camera_sdk_dropped_frames_total", labels, camera["dropped"]
+    if "stream_dropped" in camera:
+        yield "camera_sdk_stream_dropped_frames_total", labels, camera["stream_dropped"]
+        yield "camera_sdk_stream_lost_frames_total", labels, camera["stream_lost"]
+
+    pipeline = stats.get("pipeline")
+    if pipeline is not None:
+        yield "camera_frames_encoded_total", labels, pipeline["encode"]["frames"]
+        yield "camera_encode_errors_total", labels, pipeline["encode_errors"]
+        yield "camera_frames_published_total", labels, pipeline["published"]
+        yield "camera_encode_fps", labels, pipeline["encode"]["fps"]
+
+    stream = stats["stream"]
+    yield "camera_frames_sent_total", labels, stream["sent"]
+    yield "camera_frames_dropped_total", labels, stream["dropped"]
+    yield "camera_subscribers", labels, len(stream["subscribers"])
+    yield from _stage_samples("camera_stage_latency_seconds", stats["stages"], labels)
+
+    for subscriber in stream["subscribers"]:
+        client_labels = {**labels, "client": subscriber["client"]}
+        yield "camera_client_frames_sent_total", client_labels, subscriber["sent"]
+        yield "camera_client_frames_dropped_total", client_labels, subscriber["dropped"]
+        yield "camera_client_bytes_sent_total", client_labels, subscriber["bytes_sent"]
+        yield "camera_client_bytes_per_second", client_labels, subscriber["bytes_per_second"]
+        yield "camera_client_queue_depth", client_labels, subscriber["queue_depth"]
+        yield from _stage_samples("camera_client_stage_latency_seconds",
+                                  subscriber["stages"], client_labels)
+
+
+def metrics_port(default=METRICS_PORT):
+    """
+    Returns the METRICS_PORT environment variable, or `default` when unset
+    """
+    return int(os.environ.get("METRICS_PORT", default))
+
+
+def render_prometheus(cameras):
+    """
+    Renders {camera id: CameraStream.stats()} in the Prometheus text format
+    """
+    samples = {}
+    for camera_id, stats in cameras.items():
+        for name, labels, value in _camera_samples(camera_id, stats):
+            samples.setdefault(name, []).append(f"{name}{{{_labels(labels)}}} {value}")
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        if name not in samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(collect, host="localhost", port=None):
+    """
+    Serves `GET /metrics` with render_prometheus(collect()) on `port`, by
+    default metrics_port(). Returns the asyncio server, or None when `port`
+    is 0 or cannot be bound: the streaming server runs without metrics.
+    """
+    if port is None:
+        port = metrics_port()
+    if not port:
+        return None
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers, the request has no body
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type = "200 OK", CONTENT_TYPE
+                body = render_prometheus(collect()).encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            print(f"Metrics request error: {str(e)}")
+        finally:
+            writer.close()
+
+    try:
+        server = await asyncio.start_server(handle, host, port)
+    except OSError as e:
+        print(f"Metrics disabled, cannot listen on {host}:{port}: {str(e)}")
+        return None
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,139 @@
+"""
+Pushes parameter changes to subscribed websockets instead of having every
+console poll getCurrent.
+
+One ParameterWatcher per camera reads `parameter_snapshot` and sends each
+subscriber the entries that changed since the last read: values, min/max
+(the frame rate limit follows the exposure, the offsets the size, ...) and
+writability. The server calls `changed()` after every write it makes; the
+watcher also re-reads every `poll_interval` seconds for changes the camera
+makes on its own (auto exposure, auto gain). Reads are coalesced to at
+most `rate` per second, so a burst of writes is sent as one diff.
+"""
+import asyncio
+import json
+import os
+
+from camera_backend import COMMON_PARAMETERS
+
+PARAMETER_NOTIFY_RATE = float(os.environ.get("PARAMETER_NOTIFY_RATE", "5"))  # Diffs per second
+PARAMETER_POLL_INTERVAL = 1.0   # Seconds between reads without writes
+# Snapshot fields that are compared and pushed
+WATCHED_FIELDS = ("value", "min", "max", "writable")
+
+
+class ParameterWatcher:
+    """
+    Parameter change notifications of one camera. Each subscriber names
+    the parameters it wants; the camera is read once per refresh for all of
+    them.
+    """
+
+    def __init__(self, camera, camera_id, rate=PARAMETER_NOTIFY_RATE,
+                 poll_interval=PARAMETER_POLL_INTERVAL):
+        self.camera = camera
+        self.camera_id = camera_id
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self.subscribers = {}      # Websocket -> set of parameter names
+        self._state = {}           # Name -> {field: value} as last sent
+        self._changed = asyncio.Event()
+        self._task = None
+        self.refreshes = 0
+        self.notifications = 0
+
+    def _names(self):
+        names = {}
+        for subscribed in self.subscribers.values():
+            names.update(dict.fromkeys(subscribed))
+        return list(names)
+
+    def _read(self, names):
+        state = {}
+        for name, entry in self.camera.parameter_snapshot(names).items():
+            state[name] = {field: entry[field] for field in WATCHED_FIELDS if field in entry}
+        return state
+
+    def subscribe(self, websocket, names=COMMON_PARAMETERS):
+        """
+        Adds `websocket` and returns the current state of its parameters,
+        which later diffs apply to
+        """
+        self.subscribers[websocket] = set(names)
+        state = self._read(names)
+        # Keep the baseline of parameters already watched, so the others
+        # still get changes made since the last refresh
+        for name, entry in state.items():
+            self._state.setdefault(name, entry)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return state
+
+    def unsubscribe(self, websocket):
+        self.subscribers.pop(websocket, None)
+        if not self.subscribers:
+            self.close()
+
+    def is_subscribed(self, websocket):
+        return websocket in self.subscribers
+
+    def changed(self):
+        """
+        Schedules a refresh, call after writing to the camera
+        """
+        self._changed.set()
+
+    def close(self):
+        self.subscribers.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while self.subscribers:
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            # Writes arriving from here on land in the next diff
+            self._changed.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Parameter refresh error: {str(e)}")
+            await asyncio.sleep(1.0 / self.rate)
+
+    async def refresh(self):
+        """
+        Reads the watched parameters and sends every subscriber what changed
+        among its own
+        """
+        state = self._read(self._names())
+        self.refreshes += 1
+        diff = {}
+        for name, entry in state.items():
+            previous = self._state.get(name, {})
+            fields = {field: value for field, value in entry.items() if previous.get(field) != value}
+            if fields:
+                diff[name] = fields
+        self._state.update(state)
+        if not diff:
+            return
+        sends = []
+        for websocket, names in list(self.subscribers.items()):
+            changes = {name: fields for name, fields in diff.items() if name in names}
+            if changes:
+                sends.append(websocket.send(json.dumps(
+                    {"parameters_changed": changes, "camera": self.camera_id})))
+        self.notifications += len(sends)
+        # A client that went away is dropped by the server's handler
+        await asyncio.gather(*sends, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "parameters": len(self._names()),
+            "rate": self.rate,
+            "refreshes": self.refreshes,
+            "notifications": self.notifications,
+        }
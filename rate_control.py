@@ -0,0 +1,162 @@
+"""
+Per-client adaptation of JPEG quality and resolution.
+
+A stream encodes each frame once per level some client is watching at, so
+clients that keep up still get full quality while a client on a weak link
+steps down the ladder instead of freezing.
+"""
+import time
+
+# (JPEG quality, scale) per level, best first. None is the stream's own
+# quality; a level never encodes above it.
+RATE_LEVELS = (
+    (None, 1.0),
+    (60, 1.0),
+    (50, 0.75),
+    (40, 0.5),
+    (30, 0.5),
+    (30, 0.25),
+)
+ADAPT_INTERVAL = 1.0       # Seconds between controller decisions
+STEP_UP_AFTER = 3          # Healthy intervals before trying the next better level
+MAX_STEP_UP_AFTER = 30     # Back-off cap after failed step ups
+SEND_BUSY_LIMIT = 0.8      # Share of the interval spent in send that counts as saturated
+STEP_UP_HEADROOM = 0.6     # Step up only below this share of the bandwidth budget
+
+
+def level_quality(level, stream_quality):
+    quality = RATE_LEVELS[level][0]
+    return stream_quality if quality is None else min(quality, stream_quality)
+
+
+def level_size(level, width, height):
+    """
+    Frame size at `level`, rounded down to even numbers for 4:2:0 JPEG
+    """
+    scale = RATE_LEVELS[level][1]
+    if scale == 1.0:
+        return width, height
+    return max(2, int(width * scale) & ~1), max(2, int(height * scale) & ~1)
+
+
+class RateController:
+    """
+    Picks the level one client is streamed at.
+
+    Every ADAPT_INTERVAL it looks at what happened to that client's frames:
+    drops from its send queue, fewer frames sent than offered (or than
+    `target_fps`), more time spent in send than SEND_BUSY_LIMIT, or more
+    bytes than `max_bitrate` (bytes/s) all step down one level. After
+    STEP_UP_AFTER healthy intervals it tries the next better level; a step
+    up that fails right away doubles the wait, up to MAX_STEP_UP_AFTER.
+    """
+
+    def __init__(self, target_fps=None, max_bitrate=None, interval=ADAPT_INTERVAL):
+        self.target_fps = target_fps
+        self.max_bitrate = max_bitrate
+        self.interval = interval
+        self.level = 0
+        self.step_ups = 0
+        self.step_downs = 0
+        self._step_up_after = STEP_UP_AFTER
+        self._healthy = 0
+        self._just_stepped_up = False
+        self._reset(time.perf_counter())
+
+    def _reset(self, now):
+        self._started_at = now
+        self._offered = 0
+        self._dropped = 0
+        self._sent = 0
+        self._bytes = 0
+        self._send_time = 0.0
+
+    def record_offer(self, dropped):
+        self._offered += 1
+        if dropped:
+            self._dropped += 1
+
+    def record_send(self, size, seconds):
+        self._sent += 1
+        self._bytes += size
+        self._send_time += seconds
+
+    def _under_pressure(self, elapsed):
+        if self._dropped:
+            return True
+        expected = self._offered
+        if self.target_fps:
+            expected = min(expected, self.target_fps * elapsed)
+        if self._sent < expected * 0.9:
+            return True
+        if self._send_time > elapsed * SEND_BUSY_LIMIT:
+            return True
+        return self.max_bitrate is not None and self._bytes / elapsed > self.max_bitrate
+
+    def _has_headroom(self, elapsed):
+        return self.max_bitrate is None or self._bytes / elapsed < self.max_bitrate * STEP_UP_HEADROOM
+
+    def update(self, now=None):
+        """
+        Re-evaluates the level once per interval. Returns True when it
+        changed.
+        """
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self._started_at
+        if elapsed < self.interval:
+            return False
+        previous = self.level
+        if self._under_pressure(elapsed):
+            if self._just_stepped_up:
+                self._step_up_after = min(self._step_up_after * 2, MAX_STEP_UP_AFTER)
+            self._healthy = 0
+            self._just_stepped_up = False
+            if self.level < len(RATE_LEVELS) - 1:
+                self.level += 1
+                self.step_downs += 1
+        else:
+            self._healthy += 1
+            if self._just_stepped_up:
+                # The better level held, later step ups need not wait longer
+                self._step_up_after = STEP_UP_AFTER
+                self._just_stepped_up = False
+            if self.level > 0 and self._healthy >= self._step_up_after and self._has_headroom(elapsed):
+                self.level -= 1
+                self.step_ups += 1
+                self._healthy = 0
+                self._just_stepped_up = True
+        self._reset(now)
+        return self.level != previous
+
+    def stats(self):
+        return {
+            "level": self.level,
+            "step_ups": self.step_ups,
+            "step_downs": self.step_downs,
+        }
+
+
+def controller_from_command(data):
+    """
+    Builds the RateController a start_stream command asked for with
+    "adaptive": true and optional "target_fps" and "max_kbps", or None
+    """
+    if not data.get("adaptive"):
+        return None
+    target_fps = _positive_number(data, "target_fps")
+    max_kbps = _positive_number(data, "max_kbps")
+    return RateController(
+        target_fps=target_fps,
+        max_bitrate=max_kbps * 1000 / 8 if max_kbps else None)
+
+
+def _positive_number(data, key):
+    """
+    Optional positive number of a command, raises ValueError for anything else
+    """
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+        raise ValueError(f"{key} must be a positive number, got {value!r}")
+    return value
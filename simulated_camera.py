@@ -0,0 +1,556 @@
+import ctypes
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Pixel formats understood by the simulated converter
+PIXEL_FORMAT_MONO8 = "Mono8"
+PIXEL_FORMAT_BGR8 = "BGR8"
+PIXEL_FORMAT_BAYER_RG8 = "BayerRG8"
+
+CHANNELS = {
+    PIXEL_FORMAT_MONO8: 1,
+    PIXEL_FORMAT_BGR8: 3,
+    PIXEL_FORMAT_BAYER_RG8: 1,
+}
+
+# MVS enPixelType values of the same formats (PixelType_Gvsp_*)
+MVS_PIXEL_TYPES = {
+    PIXEL_FORMAT_MONO8: 0x01080001,
+    PIXEL_FORMAT_BAYER_RG8: 0x01080009,
+    PIXEL_FORMAT_BGR8: 0x02180015,
+}
+
+# MVS return codes
+MV_OK = 0
+MV_E_NODATA = 0x80000007
+MV_E_SUPPORT = 0x80000001
+MV_E_CALLORDER = 0x80000003
+
+
+class SimulatedTimeoutError(Exception):
+    pass
+
+
+class SimulatedSensor:
+    """
+    Frame clock and image source of a simulated camera.
+
+    Frame k is exposed at `start + k / fps` plus a random jitter of up to
+    `jitter_ms`, and is lost in transport with probability `drop_rate`.
+    Jitter and losses are drawn from a generator seeded with `seed`, so the
+    same settings always produce the same frame schedule. `fps=None` makes
+    the sensor free-running: a frame is ready whenever one is asked for.
+
+    With `triggered` set, frames are only exposed on `trigger()` and are
+    ready `trigger_delay_ms` (exposure plus readout) after it.
+    """
+
+    def __init__(self, width, height, pixel_format=PIXEL_FORMAT_MONO8, fps=None,
+                 jitter_ms=0.0, drop_rate=0.0, seed=0, triggered=False,
+                 trigger_delay_ms=0.0):
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.fps = fps
+        self.jitter_ms = jitter_ms
+        self.drop_rate = drop_rate
+        self.seed = seed
+        self.triggered = triggered
+        self.trigger_delay_ms = trigger_delay_ms
+        self._triggers = deque()
+        self._pattern = None
+        self.reset()
+
+    def payload_size(self):
+        return self.width * self.height * CHANNELS[self.pixel_format]
+
+    def configure(self, width, height, pixel_format, fps):
+        """
+        Applies settings changed while acquisition was stopped
+        """
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.fps = fps
+
+    def reset(self):
+        self._rng = np.random.default_rng(self.seed)
+        self._period_start = time.perf_counter()
+        self._period_index = 0
+        self.frame_index = 0
+        self._next = None
+        self._triggers.clear()
+
+    def trigger(self, at=None):
+        """
+        Starts an exposure at `at` (perf_counter, default now)
+        """
+        self._triggers.append(time.perf_counter() if at is None else at)
+
+    def set_fps(self, fps):
+        # Keep the schedule continuous when the rate changes mid-stream
+        if self.fps is None:
+            self._period_start = time.perf_counter()
+        else:
+            self._period_start += (self.frame_index - self._period_index) / self.fps
+        self._period_index = self.frame_index
+        self._next = None
+        self.fps = fps
+
+    def next_ready_at(self):
+        """
+        Time (perf_counter) at which the next frame finishes exposing, inf
+        while a triggered sensor waits for a trigger
+        """
+        if self.triggered:
+            if self._next is None:
+                if not self._triggers:
+                    return math.inf
+                ready_at = self._triggers[0] + self.trigger_delay_ms / 1000
+                if self.jitter_ms:
+                    ready_at += self._rng.uniform(0, self.jitter_ms) / 1000
+                lost = self.drop_rate > 0 and self._rng.random() < self.drop_rate
+                self._next = (ready_at, lost)
+            return self._next[0]
+        if self.fps is None:
+            return time.perf_counter()
+        if self._next is None:
+            ready_at = self._period_start + (self.frame_index - self._period_index) / self.fps
+            if self.jitter_ms:
+                ready_at += self._rng.uniform(0, self.jitter_ms) / 1000
+            lost = self.drop_rate > 0 and self._rng.random() < self.drop_rate
+            self._next = (ready_at, lost)
+        return self._next[0]
+
+    def advance(self):
+        """
+        Consumes the next frame. Returns (frame_id, ready_at, lost).
+        """
+        ready_at = self.next_ready_at()
+        lost = self._next[1] if self._next is not None else (
+            self.drop_rate > 0 and self._rng.random() < self.drop_rate)
+        self._next = None
+        if self.triggered:
+            self._triggers.popleft()
+        self.frame_index += 1
+        return self.frame_index, ready_at, lost
+
+    def fill(self, data, frame_id):
+        """
+        Writes frame `frame_id` into `data`: seeded noise over a gradient,
+        shifted by the frame id so consecutive frames differ
+        """
+        size = self.payload_size()
+        if self._pattern is None or self._pattern.size != size:
+            rng = np.random.default_rng(self.seed)
+            gradient = np.linspace(0, 191, size, dtype=np.float32).astype(np.uint8)
+            self._pattern = gradient + rng.integers(0, 64, size, dtype=np.uint8)
+        np.add(self._pattern, np.uint8(frame_id & 0xFF), out=data[:size])
+
+
+class SimulatedBuffer:
+    """
+    Stand-in for an announced ids_peak buffer, owns one payload-sized array
+    """
+
+    def __init__(self, payload_size):
+        self.data = np.zeros(payload_size, dtype=np.uint8)
+        self.frame_id = 0
+        self.timestamp_ns = 0
+        self.width = 0
+        self.height = 0
+        self.pixel_format = None
+
+    def FrameID(self):
+        return self.frame_id
+
+    def Timestamp_ns(self):
+        return self.timestamp_ns
+
+    def Width(self):
+        return self.width
+
+    def Height(self):
+        return self.height
+
+
+class SimulatedImage:
+    """
+    Stand-in for the ids_peak_ipl image that wraps a buffer without copying
+    """
+
+    def __init__(self, data, width, height, pixel_format):
+        self._data = data
+        self._width = width
+        self._height = height
+        self._pixel_format = pixel_format
+
+    def Width(self):
+        return self._width
+
+    def Height(self):
+        return self._height
+
+    def PixelFormat(self):
+        return self._pixel_format
+
+    def get_numpy_1D(self):
+        return self._data[:self._width * self._height * CHANNELS[self._pixel_format]]
+
+    def get_numpy_2D(self):
+        return self._data[:self._width * self._height].reshape(self._height, self._width)
+
+    def get_numpy_3D(self):
+        channels = CHANNELS[self._pixel_format]
+        return self._data[:self._width * self._height * channels].reshape(
+            self._height, self._width, channels)
+
+
+class SimulatedNode:
+    def __init__(self, read):
+        self._read = read
+
+    def Value(self):
+        return self._read()
+
+
+class SimulatedNodeMap:
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+    def FindNode(self, name):
+        if name not in self._nodes:
+            raise KeyError(f"Node {name} not found")
+        return SimulatedNode(self._nodes[name])
+
+
+class SimulatedDataStream:
+    """
+    In-memory datastream following the ids_peak contract
+    (AllocAndAnnounceBuffer, QueueBuffer, WaitForFinishedBuffer, ...).
+
+    Frames come from a SimulatedSensor. Like a real transport layer, each
+    frame is written into the oldest queued buffer when it finishes; if
+    the application holds every buffer the frame is dropped and counted in
+    StreamDroppedFrameCount, frames lost by the sensor are counted in
+    StreamLostFrameCount.
+
+    Frames are only produced between StartAcquisition and StopAcquisition.
+    Flush discards every queued buffer, which stays announced but has to be
+    queued again, so WaitForFinishedBuffer times out on a stream restarted
+    without requeueing.
+    """
+
+    def __init__(self, width, height, pixel_format=PIXEL_FORMAT_MONO8, fps=None,
+                 jitter_ms=0.0, drop_rate=0.0, seed=0, sensor=None):
+        self.sensor = sensor or SimulatedSensor(
+            width, height, pixel_format, fps, jitter_ms, drop_rate, seed)
+        self._announced = []
+        self._queued = []
+        self._finished = []
+        self._lock = threading.Lock()
+        self._killed = threading.Event()
+        self._acquiring = False
+        # Set by KillWait, trigger and QueueBuffer to wake a waiting
+        # WaitForFinishedBuffer
+        self._wake = threading.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.lost = 0
+        self._node_map = SimulatedNodeMap({
+            "StreamDeliveredFrameCount": lambda: self.delivered,
+            "StreamDroppedFrameCount": lambda: self.dropped,
+            "StreamLostFrameCount": lambda: self.lost,
+            "StreamAnnouncedBufferCount": lambda: len(self._announced),
+        })
+
+    @property
+    def width(self):
+        return self.sensor.width
+
+    @property
+    def height(self):
+        return self.sensor.height
+
+    @property
+    def pixel_format(self):
+        return self.sensor.pixel_format
+
+    def payload_size(self):
+        return self.sensor.payload_size()
+
+    def NodeMaps(self):
+        return [self._node_map]
+
+    def NumBuffersAnnouncedMinRequired(self):
+        return 1
+
+    def AllocAndAnnounceBuffer(self, payload_size):
+        buffer = SimulatedBuffer(payload_size)
+        self._announced.append(buffer)
+        return buffer
+
+    def AnnouncedBuffers(self):
+        return list(self._announced)
+
+    def RevokeBuffer(self, buffer):
+        with self._lock:
+            if buffer in self._queued or buffer in self._finished:
+                raise RuntimeError("Buffer still queued, flush first")
+            self._announced.remove(buffer)
+
+    def QueueBuffer(self, buffer):
+        with self._lock:
+            if buffer not in self._announced:
+                raise RuntimeError("Buffer not announced")
+            if buffer in self._queued or buffer in self._finished:
+                raise RuntimeError("Buffer already queued")
+            self._queued.append(buffer)
+        self._wake.set()
+
+    def StartAcquisition(self):
+        self._killed.clear()
+        with self._lock:
+            self.sensor.reset()
+            self._acquiring = True
+
+    def StopAcquisition(self, mode=None):
+        with self._lock:
+            self._acquiring = False
+
+    def KillWait(self):
+        self._killed.set()
+        self._wake.set()
+
+    def trigger(self, at=None):
+        """
+        Trigger pulse (software command or I/O line) for a triggered sensor
+        """
+        with self._lock:
+            self.sensor.trigger(at)
+        self._wake.set()
+
+    def Flush(self, mode=None):
+        # Like DataStreamFlushMode_DiscardAll: every buffer has to be queued
+        # again before it is used
+        with self._lock:
+            self._queued.clear()
+            self._finished.clear()
+
+    def _expose_until(self, now):
+        # Runs every frame the sensor finished by `now` through the
+        # transport layer, oldest first
+        sensor = self.sensor
+        free_running = sensor.fps is None and not sensor.triggered
+        if free_running and (self._finished or not self._queued):
+            # Free-running: expose one frame on demand, when a buffer is free
+            return
+        while free_running or sensor.next_ready_at() <= now:
+            frame_id, ready_at, lost = sensor.advance()
+            if lost:
+                self.lost += 1
+            elif not self._queued:
+                self.dropped += 1
+            else:
+                buffer = self._queued.pop(0)
+                buffer.frame_id = frame_id
+                buffer.timestamp_ns = int(ready_at * 1e9)
+                buffer.width = sensor.width
+                buffer.height = sensor.height
+                buffer.pixel_format = sensor.pixel_format
+                sensor.fill(buffer.data, frame_id)
+                self._finished.append(buffer)
+            if free_running:
+                return
+
+    def WaitForFinishedBuffer(self, timeout_ms):
+        deadline = time.perf_counter() + timeout_ms / 1000
+        while True:
+            with self._lock:
+                if self._killed.is_set():
+                    raise SimulatedTimeoutError("Wait for finished buffer aborted")
+                if self._acquiring:
+                    self._expose_until(time.perf_counter())
+                if self._finished:
+                    self.delivered += 1
+                    return self._finished.pop(0)
+                if not self._acquiring or not self._queued:
+                    # Nothing can finish: stopped, or every buffer is held
+                    # by the caller or was flushed without being requeued
+                    ready_at = deadline
+                else:
+                    ready_at = self.sensor.next_ready_at()
+                self._wake.clear()
+            now = time.perf_counter()
+            if now >= deadline:
+                raise SimulatedTimeoutError("Wait for finished buffer timed out")
+            wait = min(ready_at, deadline) - now
+            if wait > 0:
+                # A trigger or KillWait ends the wait early
+                self._wake.wait(wait)
+
+
+def buffer_to_image(buffer):
+    """
+    Counterpart of ids_peak_ipl_extension.BufferToImage
+    """
+    return SimulatedImage(buffer.data, buffer.width, buffer.height, buffer.pixel_format)
+
+
+class SimulatedImageConverter:
+    """
+    Mimics ids_peak_ipl.ImageConverter. Converting into a caller supplied
+    buffer does not allocate; converting without one allocates a fresh
+    output array, like `ConvertTo` does. `allocations` counts the latter.
+    """
+
+    def __init__(self):
+        self.allocations = 0
+        self._preallocated = None
+
+    def PreAllocateConversion(self, input_pixel_format, output_pixel_format, width, height):
+        self._preallocated = (input_pixel_format, output_pixel_format, width, height)
+
+    def Convert(self, image, output_pixel_format, output_address=None, output_size=None):
+        src = image.get_numpy_3D()
+        shape = (image.Height(), image.Width(), CHANNELS[output_pixel_format])
+        if output_address is None:
+            self.allocations += 1
+            out = np.empty(shape, dtype=np.uint8)
+        else:
+            if output_size < shape[0] * shape[1] * shape[2]:
+                raise ValueError("Output buffer too small")
+            c_buffer = (ctypes.c_uint8 * output_size).from_address(output_address)
+            out = np.frombuffer(c_buffer, dtype=np.uint8)[:shape[0] * shape[1] * shape[2]]
+            out = out.reshape(shape)
+        np.copyto(out, src if src.shape == shape else np.broadcast_to(src, shape))
+        return out
+
+
+class SimulatedFrameInfo:
+    """
+    Fields of MV_FRAME_OUT_INFO_EX that the streaming code reads
+    """
+
+    def __init__(self):
+        self.nWidth = 0
+        self.nHeight = 0
+        self.enPixelType = 0
+        self.nFrameLen = 0
+        self.nFrameNum = 0
+        self.nDevTimeStampHigh = 0
+        self.nDevTimeStampLow = 0
+        self.nHostTimeStamp = 0
+        self.nLostPacket = 0
+
+
+class SimulatedFrameOut:
+    """
+    Stand-in for MV_FRAME_OUT. `pBufAddr` is the address of the frame data,
+    `buffer` the SimulatedBuffer that holds it until MV_CC_FreeImageBuffer.
+    """
+
+    def __init__(self):
+        self.stFrameInfo = SimulatedFrameInfo()
+        self.pBufAddr = None
+        self.buffer = None
+
+
+class SimulatedMvCamera:
+    """
+    Hikvision MvCamera stand-in following the MV_CC_GetImageBuffer /
+    MV_CC_FreeImageBuffer contract: a grabbed frame keeps its SDK buffer
+    until it is freed, and with every buffer held new frames are dropped.
+    Built on the same SimulatedSensor and transport model as
+    SimulatedDataStream.
+    """
+
+    def __init__(self, width, height, pixel_format=PIXEL_FORMAT_MONO8, fps=None,
+                 jitter_ms=0.0, drop_rate=0.0, seed=0, buffer_count=5):
+        self._stream = SimulatedDataStream(
+            width, height, pixel_format, fps, jitter_ms, drop_rate, seed)
+        for _ in range(buffer_count):
+            self._stream.AllocAndAnnounceBuffer(self._stream.payload_size())
+        self._grabbing = False
+
+    @property
+    def sensor(self):
+        return self._stream.sensor
+
+    def stream_counters(self):
+        return {
+            "delivered": self._stream.delivered,
+            "dropped": self._stream.dropped,
+            "lost": self._stream.lost,
+        }
+
+    def MV_CC_StartGrabbing(self):
+        if self._grabbing:
+            return MV_E_CALLORDER
+        # The SDK sizes its buffers on StartGrabbing
+        payload_size = self._stream.payload_size()
+        for buffer in self._stream.AnnouncedBuffers():
+            if buffer.data.size != payload_size:
+                self._stream.RevokeBuffer(buffer)
+                self._stream.AllocAndAnnounceBuffer(payload_size)
+        for buffer in self._stream.AnnouncedBuffers():
+            self._stream.QueueBuffer(buffer)
+        self._stream.StartAcquisition()
+        self._grabbing = True
+        return MV_OK
+
+    def MV_CC_StopGrabbing(self):
+        if not self._grabbing:
+            return MV_E_CALLORDER
+        self._grabbing = False
+        self._stream.KillWait()
+        self._stream.StopAcquisition()
+        self._stream.Flush()
+        return MV_OK
+
+    def trigger(self):
+        """
+        Pulse on the trigger input line
+        """
+        self._stream.trigger()
+
+    def MV_CC_SetCommandValue(self, name):
+        if name != "TriggerSoftware":
+            return MV_E_SUPPORT
+        if not self._grabbing:
+            return MV_E_CALLORDER
+        self._stream.trigger()
+        return MV_OK
+
+    def MV_CC_GetImageBuffer(self, frame_out, timeout_ms):
+        if not self._grabbing:
+            return MV_E_CALLORDER
+        try:
+            buffer = self._stream.WaitForFinishedBuffer(timeout_ms)
+        except SimulatedTimeoutError:
+            return MV_E_NODATA
+        info = frame_out.stFrameInfo
+        info.nWidth = buffer.width
+        info.nHeight = buffer.height
+        info.enPixelType = MVS_PIXEL_TYPES[buffer.pixel_format]
+        info.nFrameLen = buffer.width * buffer.height * CHANNELS[buffer.pixel_format]
+        info.nFrameNum = buffer.frame_id
+        info.nDevTimeStampHigh = buffer.timestamp_ns >> 32
+        info.nDevTimeStampLow = buffer.timestamp_ns & 0xFFFFFFFF
+        info.nHostTimeStamp = time.time_ns() // 1000000
+        frame_out.pBufAddr = buffer.data.ctypes.data
+        frame_out.buffer = buffer
+        return MV_OK
+
+    def MV_CC_FreeImageBuffer(self, frame_out):
+        if frame_out.buffer is None:
+            return MV_E_CALLORDER
+        if self._grabbing:
+            self._stream.QueueBuffer(frame_out.buffer)
+        frame_out.buffer = None
+        frame_out.pBufAddr = None
+        return MV_OK
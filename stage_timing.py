@@ -0,0 +1,121 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+HISTOGRAM_WINDOW = 60.0    # Seconds of samples a histogram reports
+HISTOGRAM_SLICES = 6       # The window is dropped one slice at a time
+# Bucket upper bounds in ms, sqrt(2) apart from 50 us to ~9 s. Samples
+# above the last bound land in an overflow bucket.
+BUCKET_BOUNDS_MS = tuple(0.05 * 2 ** (i / 2) for i in range(36))
+
+
+class _Slice:
+    __slots__ = ("started_at", "counts", "total", "max")
+
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+
+class LatencyHistogram:
+    """
+    Rolling histogram of durations over the last `window` seconds.
+
+    Recording is a bucket lookup and a few additions under a lock, cheap
+    enough to time every frame. Percentiles are reported as the upper bound
+    of the bucket they fall in (at most ~41% above the true value).
+    """
+
+    def __init__(self, window=HISTOGRAM_WINDOW, slices=HISTOGRAM_SLICES):
+        self._slice_seconds = window / slices
+        self._slices = deque(maxlen=slices)
+        self._lock = threading.Lock()
+
+    def _current_slice(self, now):
+        if not self._slices or now - self._slices[-1].started_at >= self._slice_seconds:
+            self._slices.append(_Slice(now))
+        return self._slices[-1]
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        bucket = bisect_left(BUCKET_BOUNDS_MS, ms)
+        with self._lock:
+            current = self._current_slice(time.monotonic())
+            current.counts[bucket] += 1
+            current.total += ms
+            if ms > current.max:
+                current.max = ms
+
+    def merged(self):
+        """
+        Returns (bucket counts, sum in ms, max in ms) over the window
+        """
+        counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        total = maximum = 0.0
+        oldest = time.monotonic() - self._slice_seconds * self._slices.maxlen
+        with self._lock:
+            for window_slice in self._slices:
+                if window_slice.started_at < oldest:
+                    continue
+                for bucket, count in enumerate(window_slice.counts):
+                    counts[bucket] += count
+                total += window_slice.total
+                maximum = max(maximum, window_slice.max)
+        return counts, total, maximum
+
+    def snapshot(self):
+        counts, total, maximum = self.merged()
+        samples = sum(counts)
+        return {
+            "count": samples,
+            "mean_ms": total / samples if samples else 0.0,
+            "p50_ms": _percentile(counts, samples, maximum, 0.50),
+            "p95_ms": _percentile(counts, samples, maximum, 0.95),
+            "p99_ms": _percentile(counts, samples, maximum, 0.99),
+            "max_ms": maximum,
+        }
+
+
+def _percentile(counts, samples, maximum, fraction):
+    if not samples:
+        return 0.0
+    rank = samples * fraction
+    seen = 0
+    for bucket, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count:
+            if bucket == len(BUCKET_BOUNDS_MS):
+                return maximum
+            return min(BUCKET_BOUNDS_MS[bucket], maximum)
+    return maximum
+
+
+class StageTimers:
+    """
+    One LatencyHistogram per named pipeline stage, created on first use.
+    Safe to record from any thread.
+    """
+
+    def __init__(self, window=HISTOGRAM_WINDOW, slices=HISTOGRAM_SLICES):
+        self._window = window
+        self._slices = slices
+        self._histograms = {}
+
+    def histogram(self, stage):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms.setdefault(
+                stage, LatencyHistogram(self._window, self._slices))
+        return histogram
+
+    def record(self, stage, seconds):
+        self.histogram(stage).record(seconds)
+
+    def items(self):
+        return list(self._histograms.items())
+
+    def snapshot(self):
+        return {stage: histogram.snapshot() for stage, histogram in self.items()}
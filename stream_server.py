@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+from camera_backend import create_camera
+from camera_stream import CameraStream
+from frame_envelope import negotiate as negotiate_envelope
+from rate_control import controller_from_command
+
+# Camera SDK to stream from: ids, hikvision or synthetic
+CAMERA_BACKEND = os.environ.get("CAMERA_BACKEND", "ids")
+BUFFER_TIMEOUT = 5000      # Wait time (in ms) for a finished buffer
+
+
+class StreamServer:
+    """
+    Websocket server streaming one camera to any number of clients, the
+    server of ids.py, ids_websocket.py and ids_socket_resize.py.
+
+    The camera is opened for the first start_stream and closed again once
+    its last viewer has stopped or disconnected. Opening and closing run
+    one at a time under `stream_lock`, the blocking stop and close off the
+    event loop. Entry points override `target_size` and `stream_info` for
+    what they do differently.
+    """
+
+    def __init__(self, backend=CAMERA_BACKEND, camera_options=None, stream_options=None):
+        self.clients = set()
+        self.streaming = False
+        self.backend = backend
+        self.camera_options = camera_options or {}
+        self.stream_options = stream_options or {}
+        self.current_camera = None
+        self.stream = None
+        self.stream_lock = asyncio.Lock()
+
+    async def handler(self, websocket):
+        self.clients.add(websocket)
+        try:
+            async for message in websocket:
+                await self.handle_command(message, websocket)
+        finally:
+            self.clients.remove(websocket)
+            if self.streaming and self.stream.is_subscribed(websocket):
+                self.stream.unsubscribe(websocket)
+                if self.stream.subscriber_count() == 0:
+                    await self.close_stream()
+
+    async def handle_command(self, message, websocket):
+        try:
+            command_data = json.loads(message)
+            command = command_data.get("command")
+
+            if command == "get_devices":
+                await self.send_devices_list(websocket)
+            elif command == "start_stream":
+                await self.start_stream(command_data, websocket)
+            elif command == "stop_stream":
+                await self.stop_stream(websocket)
+            elif command == "get_stats":
+                await websocket.send(json.dumps(self.stats()))
+        except Exception as e:
+            error_msg = {"error": str(e)}
+            await websocket.send(json.dumps(error_msg))
+
+    async def send_devices_list(self, websocket):
+        devices = create_camera(self.backend, **self.camera_options).list_devices()
+        response = {
+            "message": f"Found {len(devices)} devices",
+            "devices": devices
+        }
+        await websocket.send(json.dumps(response))
+
+    def target_size(self, command_data):
+        """
+        Size the stream is resized to for the start_stream command opening
+        the camera, None for the camera's own
+        """
+        return None
+
+    def stream_info(self):
+        """
+        Fields added to every start_stream reply
+        """
+        return {}
+
+    async def start_stream(self, command_data, websocket):
+        async with self.stream_lock:
+            # Share a running stream instead of opening the camera again
+            if not self.streaming:
+                await self.open_stream(command_data)
+            response = {"message": "Stream started", **self.stream_info(),
+                        **self.subscribe(websocket, command_data)}
+        await websocket.send(json.dumps(response))
+
+    async def open_stream(self, command_data):
+        device_index = command_data.get("index", 0)
+        target_size = self.target_size(command_data)
+        self.current_camera = create_camera(self.backend, **self.camera_options)
+        try:
+            self.current_camera.open(device_index)
+            # Frames are grabbed on one thread, encoded on a pool of workers
+            # and fanned out to every subscribed client
+            self.stream = CameraStream(
+                self.current_camera, asyncio.get_running_loop(), target_size,
+                timeout_ms=BUFFER_TIMEOUT, **self.stream_options)
+            self.stream.start()
+        except Exception:
+            await self.release_camera()
+            raise
+        self.streaming = True
+
+    def subscribe(self, websocket, command_data):
+        """
+        Subscribes the client, with frame headers and adaptive quality if it
+        asked for them. Returns the fields to add to the start_stream reply.
+        """
+        envelope = negotiate_envelope(command_data.get("envelope"))
+        controller = controller_from_command(command_data)
+        self.stream.subscribe(websocket, envelope is not None, controller)
+        response = {"envelope": envelope} if envelope else {}
+        if controller is not None:
+            response["adaptive"] = True
+        return response
+
+    async def stop_stream(self, websocket):
+        if self.streaming and self.current_camera:
+            self.stream.unsubscribe(websocket)
+            # Keep the camera running while other viewers are subscribed
+            if self.stream.subscriber_count() == 0:
+                await self.close_stream()
+            await websocket.send(json.dumps({"message": "Stream stopped"}))
+        else:
+            await websocket.send(json.dumps({"error": "No active stream"}))
+
+    def stream_stats(self):
+        """
+        Returns {camera id: CameraStream.stats()} for the running stream
+        """
+        if not self.streaming:
+            return {}
+        camera_id = self.current_camera.serial or self.current_camera.name
+        return {camera_id: self.stream.stats()}
+
+    def stats(self):
+        return {"streaming": self.streaming, "cameras": self.stream_stats()}
+
+    async def close_stream(self):
+        """
+        Stops the stream and closes the camera, unless a client subscribed
+        again while the lock was held
+        """
+        async with self.stream_lock:
+            if self.streaming and self.stream.subscriber_count() == 0:
+                await self.release_camera()
+
+    async def release_camera(self):
+        self.streaming = False
+        stream, self.stream = self.stream, None
+        camera, self.current_camera = self.current_camera, None
+        # Both join SDK threads, off the event loop
+        if stream is not None:
+            await asyncio.to_thread(stream.stop)
+        await asyncio.to_thread(camera.close)
@@ -0,0 +1,290 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from stage_timing import StageTimers
+
+SUBSCRIBER_QUEUE = 2      # Frames a slow client may fall behind before drops
+
+
+class LatestFrameSlot:
+    """
+    Hands frames from a producer thread to a coroutine without ever blocking
+    either side. The slot holds at most one frame: publishing while the
+    previous frame has not been picked up replaces it (drop-oldest), so the
+    consumer always gets the newest frame and memory stays bounded.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._event = asyncio.Event()
+        self._frame = None
+        self._wakeup_pending = False
+        self._closed = False
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, frame):
+        """
+        Stores `frame` and wakes the consumer. Safe to call from any thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.published += 1
+            # One pending wakeup is enough no matter how many frames arrive
+            # before the loop gets to it
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        self._loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        with self._lock:
+            self._wakeup_pending = False
+        self._event.set()
+
+    async def get(self):
+        """
+        Waits for the next frame. Returns None once the slot is closed.
+        """
+        while True:
+            with self._lock:
+                frame = self._frame
+                self._frame = None
+                closed = self._closed
+            if frame is not None:
+                return frame
+            if closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+
+    def close(self):
+        """
+        Drops any pending frame and releases a waiting consumer. Safe to call
+        from any thread.
+        """
+        with self._lock:
+            self._closed = True
+            self._frame = None
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        self._loop.call_soon_threadsafe(self._wakeup)
+
+
+class _Subscriber:
+    """
+    Per-client send queue. Holds at most `max_queue` frames; when full, the
+    oldest frame is dropped so a slow client only ever falls behind itself.
+
+    Times each frame spent between publish and send ("queue_dwell") and in
+    websocket.send ("send"). The first `skip` bytes of every frame (a header
+    this client did not ask for) are not sent.
+
+    With a RateController the client is sent the variant of each frame for
+    the controller's level, and `on_level_change` is called when it moves.
+    """
+
+    def __init__(self, websocket, max_queue, on_error, skip=0, controller=None,
+                 on_level_change=None):
+        self.websocket = websocket
+        self.skip = skip
+        self.controller = controller
+        self._on_level_change = on_level_change
+        self._frames = deque(maxlen=max_queue)
+        self._event = asyncio.Event()
+        self._on_error = on_error
+        self._closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.subscribed_at = time.perf_counter()
+        self.stage_timers = StageTimers()
+        self._task = asyncio.create_task(self._send_loop())
+
+    @property
+    def level(self):
+        return self.controller.level if self.controller is not None else 0
+
+    def offer(self, variants, published_at):
+        dropped = len(self._frames) == self._frames.maxlen
+        if dropped:
+            self.dropped += 1
+        level = self.level
+        frame = variants.get(level)
+        if frame is None:
+            # The level changed after this frame was encoded
+            frame = variants[min(variants, key=lambda available: abs(available - level))]
+        self._frames.append((frame, published_at))
+        self._event.set()
+        if self.controller is not None:
+            self.controller.record_offer(dropped)
+            self._update_level()
+
+    def _update_level(self):
+        if self.controller.update() and self._on_level_change is not None:
+            self._on_level_change()
+
+    def queue_depth(self):
+        return len(self._frames)
+
+    @property
+    def client(self):
+        address = getattr(self.websocket, "remote_address", None)
+        return f"{address[0]}:{address[1]}" if address else str(id(self.websocket))
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.subscribed_at
+        return {
+            "client": self.client,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "bytes_sent": self.bytes_sent,
+            "bytes_per_second": self.bytes_sent / elapsed if elapsed > 0 else 0.0,
+            "queue_depth": self.queue_depth(),
+            "stages": self.stage_timers.snapshot(),
+            **({"rate": self.controller.stats()} if self.controller is not None else {}),
+        }
+
+    async def _send_loop(self):
+        while not self._closed:
+            if not self._frames:
+                self._event.clear()
+                await self._event.wait()
+                continue
+            frame, published_at = self._frames.popleft()
+            started = time.perf_counter()
+            self.stage_timers.record("queue_dwell", started - published_at)
+            if self.skip:
+                frame = frame[self.skip:]
+            try:
+                await self.websocket.send(frame)
+                self.sent += 1
+                self.bytes_sent += len(frame)
+                send_time = time.perf_counter() - started
+                self.stage_timers.record("send", send_time)
+                if self.controller is not None:
+                    self.controller.record_send(len(frame), send_time)
+                    self._update_level()
+            except Exception as e:
+                print(f"Frame send error: {str(e)}")
+                self._on_error(self.websocket)
+                return
+
+    def close(self):
+        self._closed = True
+        self._frames.clear()
+        self._event.set()
+
+
+class FrameBroadcaster:
+    """
+    Shares one stream of encoded frames between any number of websockets.
+    The producer thread publishes each frame once; the event loop fans it out
+    to every subscriber's bounded queue, so acquisition and encoding happen
+    once per frame regardless of the number of viewers.
+
+    A frame is published as {level: payload} with one variant per level in
+    `levels` (level 0 is the full-quality stream, see rate_control), and
+    each subscriber gets the variant for its level. Payloads may start with
+    a `header_size` byte header; only subscribers that asked for it receive
+    it.
+    """
+
+    def __init__(self, loop, max_queue=SUBSCRIBER_QUEUE, header_size=0):
+        self._max_queue = max_queue
+        self._header_size = header_size
+        self._subscribers = {}
+        # Frames sent to and dropped for clients that have unsubscribed, so
+        # the totals in stats() never go down
+        self._departed_sent = 0
+        self._departed_dropped = 0
+        # Levels some subscriber is at, read by the encoder threads
+        self.levels = frozenset((0,))
+        self._slot = LatestFrameSlot(loop)
+        self._task = loop.create_task(self._fan_out())
+
+    def publish(self, variants):
+        """
+        Publishes the encoded variants of a frame. Safe to call from the
+        producer thread.
+        """
+        self._slot.publish((variants, time.perf_counter()))
+
+    def subscribe(self, websocket, with_header=False, controller=None):
+        """
+        Subscribes a websocket, or updates its options if already subscribed.
+        `controller` (a RateController) adapts what this client is sent.
+        """
+        skip = 0 if with_header else self._header_size
+        subscriber = self._subscribers.get(websocket)
+        if subscriber is not None:
+            subscriber.skip = skip
+            subscriber.controller = controller
+        else:
+            self._subscribers[websocket] = _Subscriber(
+                websocket, self._max_queue, self.unsubscribe, skip, controller,
+                self._update_levels)
+        self._update_levels()
+
+    def unsubscribe(self, websocket):
+        subscriber = self._subscribers.pop(websocket, None)
+        if subscriber is not None:
+            subscriber.close()
+            self._departed_sent += subscriber.sent
+            self._departed_dropped += subscriber.dropped
+            self._update_levels()
+
+    def _update_levels(self):
+        self.levels = frozenset(s.level for s in self._subscribers.values()) or frozenset((0,))
+
+    def is_subscribed(self, websocket):
+        return websocket in self._subscribers
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def totals(self):
+        """
+        Returns (sent, dropped), the frames sent to and dropped for every
+        client since the broadcaster was created
+        """
+        subscribers = list(self._subscribers.values())
+        sent = self._departed_sent + sum(s.sent for s in subscribers)
+        dropped = self._slot.dropped + self._departed_dropped + sum(s.dropped for s in subscribers)
+        return sent, dropped
+
+    def stats(self):
+        """
+        `sent` and `dropped` are the totals(), `subscribers` only the
+        current clients
+        """
+        subscribers = list(self._subscribers.values())
+        sent, dropped = self.totals()
+        return {
+            "published": self._slot.published,
+            "dropped": dropped,
+            "sent": sent,
+            "subscribers": [s.stats() for s in subscribers],
+        }
+
+    async def _fan_out(self):
+        while True:
+            published = await self._slot.get()
+            if published is None:
+                break
+            variants, published_at = published
+            for subscriber in list(self._subscribers.values()):
+                subscriber.offer(variants, published_at)
+
+    def close(self):
+        self._slot.close()
+        for websocket in list(self._subscribers):
+            self.unsubscribe(websocket)
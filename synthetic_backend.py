@@ -0,0 +1,393 @@
+import time
+
+import cv2
+
+from camera_backend import (
+    LOCKED_PARAMETERS, CameraBackend, FrameInfo, GrabTimeout, ParameterDescriptor)
+from frame_ring import FrameGrabber, FrameRing, HalfResBayerGrabber, reduction_factor
+from simulated_camera import (
+    CHANNELS, MV_E_NODATA, MV_OK, PIXEL_FORMAT_BGR8, PIXEL_FORMAT_BAYER_RG8,
+    PIXEL_FORMAT_MONO8, SimulatedDataStream, SimulatedFrameOut,
+    SimulatedImageConverter, SimulatedMvCamera, SimulatedTimeoutError,
+    buffer_to_image)
+
+# Numeric parameters: name -> (default, minimum, maximum). The ROI maximums
+# follow the sensor size, see get_parameter_range
+DEFAULT_PARAMETERS = {
+    "ExposureTime": (10000.0, 10.0, 1000000.0),
+    "Gain": (1.0, 1.0, 16.0),
+    "AcquisitionFrameRate": (30.0, 1.0, 1000.0),
+    "Gamma": (1.0, 0.3, 3.0),
+    "BlackLevel": (0.0, 0.0, 255.0),
+    "Width": (1920, 16, None),
+    "Height": (1080, 16, None),
+    "OffsetX": (0, 0, None),
+    "OffsetY": (0, 0, None),
+}
+UNITS = {"ExposureTime": "us", "AcquisitionFrameRate": "Hz", "Width": "px", "Height": "px",
+         "OffsetX": "px", "OffsetY": "px"}
+# Sensor ROI increments, like a typical GenICam camera
+ROI_INCREMENTS = {"OffsetX": 2, "OffsetY": 2, "Width": 8, "Height": 2}
+ROI_MIN_SIZE = 16
+
+# OpenCV conversion of raw MVS frames to BGR (GenICam BayerRG is BayerBG in
+# OpenCV's naming)
+MVS_TO_BGR = {
+    PIXEL_FORMAT_MONO8: cv2.COLOR_GRAY2BGR,
+    PIXEL_FORMAT_BAYER_RG8: cv2.COLOR_BayerBG2BGR,
+}
+
+
+class SyntheticCamera(CameraBackend):
+    """
+    In-memory camera, so the streaming pipeline can be benchmarked and
+    tested without hardware.
+
+    `sdk="ids"` runs on the simulated ids_peak datastream (converter and
+    half-resolution Bayer grabbers like IdsCamera), `sdk="mvs"` on the
+    simulated MVS MV_CC_GetImageBuffer/FreeImageBuffer contract. Frames are
+    produced at AcquisitionFrameRate (or as fast as they are grabbed when
+    `free_running`), with optional jitter and induced drops drawn from
+    `seed`, so benchmark runs are reproducible.
+
+    The sensor ROI is aligned to ROI_INCREMENTS; with `sensor_roi=False`
+    the camera has none and set_roi falls back to cropping in software.
+
+    In trigger mode a frame is ready ExposureTime after each trigger;
+    `pulse_line` stands in for the hardware trigger input.
+
+    Like IdsCamera, the simulated device and its announced buffers live
+    from `open` to `close`: `start` reconfigures the sensor, reallocates
+    the buffers only for a new payload size and requeues them after the
+    flush in `stop`.
+    """
+
+    name = "synthetic"
+
+    def __init__(self, device_count=1, width=1920, height=1080,
+                 pixel_format=PIXEL_FORMAT_BAYER_RG8, fps=30.0, jitter_ms=0.0,
+                 drop_rate=0.0, seed=0, sdk="ids", free_running=False, buffer_count=5,
+                 sensor_roi=True):
+        super().__init__()
+        if sdk not in ("ids", "mvs"):
+            raise ValueError(f"Unknown simulated SDK: {sdk}")
+        self.device_count = device_count
+        self.sdk = sdk
+        self.free_running = free_running
+        self.jitter_ms = jitter_ms
+        self.drop_rate = drop_rate
+        self.seed = seed
+        self.buffer_count = buffer_count
+        self.sensor_roi = sensor_roi
+        self.sensor_width = width
+        self.sensor_height = height
+        self._values = {name: default for name, (default, _, _) in DEFAULT_PARAMETERS.items()}
+        self._values.update(Width=width, Height=height, PixelFormat=pixel_format,
+                            AcquisitionFrameRate=float(fps))
+        self._index = 0
+        self._datastream = None
+        self._payload_size = 0
+        self._counters_at_start = {}
+        self._mv_camera = None
+        self._frame_out = SimulatedFrameOut()
+        self._ring = None
+        self._converter = None
+        self._grabber = None
+        self._running = False
+        self._opened = False
+
+    def list_devices(self):
+        return [{
+            "index": index,
+            "type": "Synthetic",
+            "model": "Synthetic Camera",
+            "serial": f"SIM{index:05d}",
+        } for index in range(self.device_count)]
+
+    def open(self, index=0):
+        if index < 0 or index >= self.device_count:
+            raise IndexError("Invalid device index")
+        self._index = index
+        self.model = "Synthetic Camera"
+        self.serial = f"SIM{index:05d}"
+        self._create_device()
+        self._opened = True
+        self.clear_parameter_cache()
+
+    def _frame_rate(self):
+        return None if self.free_running else self._values["AcquisitionFrameRate"]
+
+    def _create_device(self):
+        # Each device gets its own deterministic stream
+        width, height = self._values["Width"], self._values["Height"]
+        pixel_format = self._values["PixelFormat"]
+        seed = self.seed + self._index
+        if self.sdk == "mvs":
+            self._mv_camera = SimulatedMvCamera(
+                width, height, pixel_format, self._frame_rate(), self.jitter_ms,
+                self.drop_rate, seed, self.buffer_count)
+            return
+        self._datastream = SimulatedDataStream(
+            width, height, pixel_format, self._frame_rate(), self.jitter_ms, self.drop_rate,
+            seed)
+        self._allocate_buffers()
+
+    def _allocate_buffers(self):
+        payload_size = self._datastream.payload_size()
+        for _ in range(self.buffer_count):
+            self._datastream.AllocAndAnnounceBuffer(payload_size)
+        self._payload_size = payload_size
+
+    def _queue_buffers(self):
+        # Same as IdsCamera: announced again only for a new payload size,
+        # and flushed first in case the grab thread queued its last buffer
+        # after the flush in stop
+        self._datastream.Flush()
+        if self._datastream.payload_size() != self._payload_size:
+            for buffer in self._datastream.AnnouncedBuffers():
+                self._datastream.RevokeBuffer(buffer)
+            self._allocate_buffers()
+        for buffer in self._datastream.AnnouncedBuffers():
+            self._datastream.QueueBuffer(buffer)
+
+    def _configure_device(self):
+        # Settings written while stopped take effect on the next start
+        self.sensor.configure(self._values["Width"], self._values["Height"],
+                              self._values["PixelFormat"], self._frame_rate())
+        self.sensor.triggered = self.trigger_mode != "off"
+        self.sensor.trigger_delay_ms = self._values["ExposureTime"] / 1000
+
+    def close(self):
+        self.stop()
+        self._datastream = None
+        self._mv_camera = None
+        self._payload_size = 0
+        self._counters_at_start = {}
+        self._opened = False
+
+    @property
+    def is_open(self):
+        return self._opened
+
+    @property
+    def is_running(self):
+        return self._running
+
+    @property
+    def sensor(self):
+        device = self._mv_camera if self.sdk == "mvs" else self._datastream
+        return device.sensor if device is not None else None
+
+    def start(self, target_size=None, slots=3):
+        if not self._opened:
+            raise RuntimeError("Camera not open")
+        if self._running:
+            return
+        self.target_size = target_size
+        self._configure_device()
+
+        self.width, self.height = self._values["Width"], self._values["Height"]
+        pixel_format = self._values["PixelFormat"]
+        if self.sdk == "mvs":
+            self._ring = FrameRing(self.height, self.width, 3, slots)
+            self._mv_camera.MV_CC_StartGrabbing()
+        else:
+            if (target_size is not None and HalfResBayerGrabber.supports(pixel_format)
+                    and self.software_roi is None and reduction_factor(self.width, self.height, *target_size) >= 2):
+                self._grabber = HalfResBayerGrabber(
+                    self._datastream, buffer_to_image, pixel_format, slots, self.stage_timers,
+                    self._record_raw_image)
+                self._grabber.prepare(self.width, self.height)
+                self.width, self.height = self.width // 2, self.height // 2
+            else:
+                self._converter = SimulatedImageConverter()
+                self._grabber = FrameGrabber(
+                    self._datastream, self._converter, buffer_to_image, PIXEL_FORMAT_BGR8, slots,
+                    self.stage_timers, self._record_raw_image)
+                self._grabber.prepare(pixel_format, self.width, self.height)
+            self._queue_buffers()
+            self._datastream.StartAcquisition()
+        self.acquisition_stats.reset()
+        self._counters_at_start = {}
+        self._counters_at_start = self._stream_counters()
+        self._running = True
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        if self.sdk == "mvs":
+            self._mv_camera.MV_CC_StopGrabbing()
+        else:
+            self._datastream.KillWait()
+            self._datastream.StopAcquisition()
+            self._datastream.Flush()
+
+    def grab(self, timeout_ms=1000):
+        if not self._running:
+            raise GrabTimeout("Acquisition stopped")
+        try:
+            if self.sdk == "mvs":
+                frame = self._grab_mvs(timeout_ms)
+            else:
+                frame = self._grabber.grab(timeout_ms)
+                self.last_frame_info = self._grabber.frame_info
+        except SimulatedTimeoutError:
+            self.acquisition_stats.record_timeout()
+            raise GrabTimeout(f"No frame within {timeout_ms} ms") from None
+        self.acquisition_stats.record_frame()
+        self._record_trigger_latency()
+        return self._crop(frame)
+
+    def _grab_mvs(self, timeout_ms):
+        frame_out = self._frame_out
+        started = time.perf_counter()
+        ret = self._mv_camera.MV_CC_GetImageBuffer(frame_out, timeout_ms)
+        received = time.perf_counter()
+        if ret == MV_E_NODATA:
+            raise SimulatedTimeoutError("No frame")
+        if ret != MV_OK:
+            raise RuntimeError(f"Get image buffer failed: 0x{ret:x}")
+        try:
+            info = frame_out.stFrameInfo
+            self.last_frame_info = FrameInfo(
+                info.nFrameNum, (info.nDevTimeStampHigh << 32) | info.nDevTimeStampLow)
+            buffer = frame_out.buffer
+            self._record_raw(buffer.data, buffer.width, buffer.height, buffer.pixel_format,
+                             self.last_frame_info)
+            out = self._ring.next_slot()
+            if buffer.pixel_format == PIXEL_FORMAT_BGR8:
+                out.reshape(-1)[:] = buffer.data[:out.size]
+            else:
+                raw = buffer_to_image(buffer).get_numpy_2D()
+                cv2.cvtColor(raw, MVS_TO_BGR[buffer.pixel_format], dst=out)
+        finally:
+            self._mv_camera.MV_CC_FreeImageBuffer(frame_out)
+        self.stage_timers.record("buffer_wait", received - started)
+        self.stage_timers.record("conversion", time.perf_counter() - received)
+        return out
+
+    def _record_raw_image(self, image, frame_info):
+        if self.raw_recorder is not None:
+            self._record_raw(image.get_numpy_1D(), image.Width(), image.Height(),
+                             image.PixelFormat(), frame_info)
+
+    def _apply_trigger(self, mode, source, activation):
+        # Takes effect when the device is configured on the next start
+        pass
+
+    def _send_software_trigger(self):
+        if self.sdk == "mvs":
+            ret = self._mv_camera.MV_CC_SetCommandValue("TriggerSoftware")
+            if ret != MV_OK:
+                raise RuntimeError(f"Software trigger failed: 0x{ret:x}")
+        else:
+            self._datastream.trigger()
+
+    def pulse_line(self):
+        """
+        Simulates a pulse on the hardware trigger line
+        """
+        if self.trigger_mode != "hardware":
+            raise RuntimeError("Camera is not in hardware trigger mode")
+        if not self._running:
+            raise RuntimeError("Acquisition not running")
+        device = self._mv_camera if self.sdk == "mvs" else self._datastream
+        device.trigger()
+
+    def _set_sensor_roi(self, x, y, width, height):
+        if not self.sensor_roi:
+            raise NotImplementedError("Camera has no sensor ROI")
+
+        def aligned(name, value, maximum):
+            value = max(min(int(value), maximum), 0)
+            return value - value % ROI_INCREMENTS[name]
+
+        width = max(aligned("Width", width, self.sensor_width), ROI_MIN_SIZE)
+        height = max(aligned("Height", height, self.sensor_height), ROI_MIN_SIZE)
+        x = aligned("OffsetX", x, self.sensor_width - width)
+        y = aligned("OffsetY", y, self.sensor_height - height)
+        self._values.update(Width=width, Height=height, OffsetX=x, OffsetY=y)
+        return x, y, width, height
+
+    def _reset_sensor_roi(self):
+        self._values.update(Width=self.sensor_width, Height=self.sensor_height,
+                            OffsetX=0, OffsetY=0)
+
+    def _stream_counters(self):
+        # Since the last start, the device counters run from open to close
+        if self._mv_camera is not None:
+            counters = self._mv_camera.stream_counters()
+        elif self._datastream is not None:
+            counters = {"dropped": self._datastream.dropped, "lost": self._datastream.lost}
+        else:
+            return {"dropped": 0, "lost": 0}
+        return {name: counters[name] - self._counters_at_start.get(name, 0)
+                for name in ("dropped", "lost")}
+
+    def stats(self):
+        counters = self._stream_counters()
+        self.acquisition_stats.dropped = counters["dropped"] + counters["lost"]
+        stats = super().stats()
+        stats.update(sdk=self.sdk, stream_dropped=counters["dropped"],
+                     stream_lost=counters["lost"])
+        return stats
+
+    def get_parameter(self, name):
+        if name not in self._values:
+            raise KeyError(name)
+        return self._values[name]
+
+    def get_parameter_range(self, name):
+        if name not in DEFAULT_PARAMETERS:
+            raise KeyError(name)
+        _, minimum, maximum = DEFAULT_PARAMETERS[name]
+        # Size and offset share the sensor, each limits the other
+        if name == "Width":
+            maximum = self.sensor_width - self._values["OffsetX"]
+        elif name == "OffsetX":
+            maximum = self.sensor_width - self._values["Width"]
+        elif name == "Height":
+            maximum = self.sensor_height - self._values["OffsetY"]
+        elif name == "OffsetY":
+            maximum = self.sensor_height - self._values["Height"]
+        if name == "AcquisitionFrameRate":
+            # A frame cannot be shorter than its exposure
+            maximum = min(maximum, 1e6 / self._values["ExposureTime"])
+        return minimum, maximum
+
+    def describe_parameter(self, name):
+        if name == "PixelFormat":
+            return ParameterDescriptor(name, "enum", None, None, None, None, "rw", tuple(CHANNELS))
+        if name not in DEFAULT_PARAMETERS:
+            raise KeyError(name)
+        default = DEFAULT_PARAMETERS[name][0]
+        minimum, maximum = self.get_parameter_range(name)
+        return ParameterDescriptor(
+            name, "float" if isinstance(default, float) else "int", minimum, maximum,
+            ROI_INCREMENTS.get(name, None if isinstance(default, float) else 1),
+            UNITS.get(name), "rw", None)
+
+    def _write_parameter(self, name, value):
+        if name not in self._values:
+            raise KeyError(f"Unknown parameter {name}")
+        if name in LOCKED_PARAMETERS and self._running:
+            raise ValueError(f"{name} cannot be changed while acquiring")
+        if name == "PixelFormat":
+            if value not in CHANNELS:
+                raise ValueError(f"Value {value} not available for {name}")
+            self._values[name] = value
+            return
+        default = DEFAULT_PARAMETERS[name][0]
+        minimum, maximum = self.get_parameter_range(name)
+        value = max(min(type(default)(value), maximum), minimum)
+        if name in ROI_INCREMENTS:
+            value -= (value - minimum) % ROI_INCREMENTS[name]
+        self._values[name] = value
+        if name == "ExposureTime":
+            # Like a real camera, a longer exposure pulls the frame rate down
+            self._values["AcquisitionFrameRate"] = min(
+                self._values["AcquisitionFrameRate"],
+                self.get_parameter_range("AcquisitionFrameRate")[1])
+        if name in ("AcquisitionFrameRate", "ExposureTime") and self._running and not self.free_running:
+            self.sensor.set_fps(self._values["AcquisitionFrameRate"])
@@ -0,0 +1,67 @@
+"""
+Command round-trip time through the config server while frames stream from
+the synthetic camera
+"""
+import asyncio
+import json
+import statistics
+import time
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+from config_websocket import WebSocketServer
+
+COMMANDS = 50
+COMMAND_INTERVAL = 0.02
+# Generous for a loaded CI machine, a blocked event loop takes seconds
+ROUND_TRIP_BOUND = 0.25
+
+
+async def _measure():
+    server = WebSocketServer(
+        "synthetic", camera_options={"width": 640, "height": 480, "fps": 30.0})
+    async with websockets.serve(server.handler, "localhost", 0, compression=None) as ws_server:
+        port = ws_server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://localhost:{port}", compression=None,
+                                      max_size=None) as client:
+            replies = asyncio.Queue()
+            frames = 0
+
+            async def receive():
+                nonlocal frames
+                async for message in client:
+                    if isinstance(message, bytes):
+                        frames += 1
+                    else:
+                        replies.put_nowait(json.loads(message))
+
+            receiver = asyncio.create_task(receive())
+            await client.send(json.dumps({"command": "start_stream"}))
+            assert "error" not in await replies.get()
+            while frames < 5:
+                await asyncio.sleep(0.01)
+
+            frames_before = frames
+            round_trips = []
+            for _ in range(COMMANDS):
+                started = time.perf_counter()
+                await client.send(json.dumps({"command": "get_cameras"}))
+                reply = await asyncio.wait_for(replies.get(), 5)
+                round_trips.append(time.perf_counter() - started)
+                assert "cameras" in reply
+                await asyncio.sleep(COMMAND_INTERVAL)
+            streamed = frames - frames_before
+
+            await client.send(json.dumps({"command": "stop_stream"}))
+            await replies.get()
+            receiver.cancel()
+    return round_trips, streamed
+
+
+def test_command_round_trip_while_streaming():
+    round_trips, streamed = asyncio.run(_measure())
+    assert streamed > 0, "no frames arrived while commands were sent"
+    p95 = statistics.quantiles(round_trips, n=20)[-1]
+    assert p95 < ROUND_TRIP_BOUND, f"p95 round trip {p95 * 1000:.1f} ms"
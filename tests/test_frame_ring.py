@@ -0,0 +1,52 @@
+"""
+Steady-state streaming converts into preallocated arrays, without an
+allocation per frame
+"""
+import pytest
+
+from simulated_camera import PIXEL_FORMAT_BAYER_RG8, PIXEL_FORMAT_MONO8
+from synthetic_backend import SyntheticCamera
+
+WARM_UP = 5
+FRAMES = 50
+
+
+@pytest.mark.parametrize("pixel_format", [PIXEL_FORMAT_MONO8, PIXEL_FORMAT_BAYER_RG8])
+def test_converter_and_ring_do_not_allocate_per_frame(pixel_format):
+    camera = SyntheticCamera(width=320, height=240, pixel_format=pixel_format,
+                             free_running=True)
+    camera.open(0)
+    camera.start(slots=3)
+    try:
+        for _ in range(WARM_UP):
+            camera.grab()
+        ring = camera._grabber.ring
+        ring_allocations = ring.allocations
+        converter_allocations = camera._converter.allocations
+        slots = set()
+        for _ in range(FRAMES):
+            slots.add(id(camera.grab()))
+        assert camera._grabber.ring is ring
+        assert ring.allocations == ring_allocations == len(ring)
+        assert camera._converter.allocations == converter_allocations == 0
+        # Frames are the ring's arrays, handed out round-robin
+        assert len(slots) == len(ring)
+    finally:
+        camera.close()
+
+
+def test_mvs_ring_does_not_allocate_per_frame():
+    camera = SyntheticCamera(width=320, height=240, sdk="mvs", free_running=True)
+    camera.open(0)
+    camera.start(slots=3)
+    try:
+        for _ in range(WARM_UP):
+            camera.grab()
+        ring = camera._ring
+        allocations = ring.allocations
+        for _ in range(FRAMES):
+            camera.grab()
+        assert camera._ring is ring
+        assert ring.allocations == allocations == len(ring)
+    finally:
+        camera.close()
@@ -1,188 +1,151 @@
 import asyncio
 import json
 import logging
+import os
 import cv2
-import numpy as np
 import av
 import aiohttp_cors
 from aiohttp import web
 from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from ids_peak import ids_peak
-from ids_peak_ipl import ids_peak_ipl
-from ids_peak import ids_peak_ipl_extension
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from camera_backend import create_camera
 
 logging.basicConfig(level=logging.INFO)
 
-# Constants
-TARGET_PIXEL_FORMAT = ids_peak_ipl.PixelFormatName_BGRa8
+# Camera SDK to stream from: ids, hikvision or synthetic
+CAMERA_BACKEND = os.environ.get("CAMERA_BACKEND", "ids")
+BUFFER_TIMEOUT = 1000      # Wait time (in ms) for a finished buffer
+GRAB_RETRIES = 3           # Failed grabs in a row before the track ends
 
-class Camera:
-    def __init__(self, device_manager, device_index=0):
-        self.device_manager = device_manager
-        self.device_index = device_index
-        self._device = None
-        self._datastream = None
-        self._acquisition_running = False
-        self.target_fps = 20000
-        self.max_fps = 0
-        self.target_gain = 1
-        self.max_gain = 1
-        self._node_map = None
-        self.image_width = None
-        self.image_height = None
-        self.target_size = None
-        self.killed = False
-        self._get_device()
-        if self._device:
-            self._setup_device_and_datastream()
-
-    def __del__(self):
-        self.close()
-
-    def _get_device(self):
-        self.device_manager.Update()
-        if self.device_manager.Devices().empty():
-            raise RuntimeError("No devices found")
-        if self.device_index >= len(self.device_manager.Devices()):
-            raise IndexError("Invalid device index")
-        self._device = self.device_manager.Devices()[self.device_index].OpenDevice(ids_peak.DeviceAccessType_Control)
-        self._node_map = self._device.RemoteDevice().NodeMaps()[0]
-        self.max_gain = self._node_map.FindNode("Gain").Maximum()
-        self._node_map.FindNode("UserSetSelector").SetCurrentEntry("Default")
-        self._node_map.FindNode("UserSetLoad").Execute()
-        self._node_map.FindNode("UserSetLoad").WaitUntilDone()
-
-    def _setup_device_and_datastream(self):
-        self._datastream = self._device.DataStreams()[0].OpenDataStream()
-        self._find_and_set_remote_device_enumeration("GainAuto", "Off")
-        self._find_and_set_remote_device_enumeration("ExposureAuto", "Off")
-        payload_size = self._node_map.FindNode("PayloadSize").Value()
-        max_buffer = self._datastream.NumBuffersAnnouncedMinRequired() * 5
-        for idx in range(max_buffer):
-            buffer = self._datastream.AllocAndAnnounceBuffer(payload_size)
-            self._datastream.QueueBuffer(buffer)
-
-    def close(self):
-        self.stop_acquisition()
-        if self._datastream:
-            try:
-                self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
-                for buffer in self._datastream.AnnouncedBuffers():
-                    self._datastream.RevokeBuffer(buffer)
-            except Exception as e:
-                logging.error("Exception (close): %s", e)
-            finally:
-                self._datastream = None
-
-    def _find_and_set_remote_device_enumeration(self, name: str, value: str):
-        entries = self._node_map.FindNode(name).Entries()
-        available_entries = [entry.SymbolicValue() for entry in entries if entry.IsAvailable()]
-        if value in available_entries:
-            self._node_map.FindNode(name).SetCurrentEntry(value)
-
-    def start_acquisition(self):
-        if self._device is None or self._acquisition_running:
-            return False
-        try:
-            self.max_fps = self._node_map.FindNode("AcquisitionFrameRate").Maximum()
-            self.target_fps = self.max_fps
-            self._node_map.FindNode("AcquisitionFrameRate").SetValue(self.target_fps)
-        except ids_peak.Exception:
-            pass
-        try:
-            self._node_map.FindNode("TLParamsLocked").SetValue(1)
-            self.image_width = self._node_map.FindNode("Width").Value()
-            self.image_height = self._node_map.FindNode("Height").Value()
-            input_pixel_format = ids_peak_ipl.PixelFormat(
-                self._node_map.FindNode("PixelFormat").CurrentEntry().Value())
-            self._image_converter = ids_peak_ipl.ImageConverter()
-            self._image_converter.PreAllocateConversion(
-                input_pixel_format, TARGET_PIXEL_FORMAT,
-                self.image_width, self.image_height)
-            self._datastream.StartAcquisition()
-            self._node_map.FindNode("AcquisitionStart").Execute()
-            self._node_map.FindNode("AcquisitionStart").WaitUntilDone()
-            self._acquisition_running = True
-            return True
-        except Exception as e:
-            logging.error("Exception (start acquisition): %s", e)
-            return False
-
-    def stop_acquisition(self):
-        if not self._acquisition_running:
-            return
-        try:
-            self._node_map.FindNode("AcquisitionStop").Execute()
-            self._datastream.KillWait()
-            self._datastream.StopAcquisition(ids_peak.AcquisitionStopMode_Default)
-            self._datastream.Flush(ids_peak.DataStreamFlushMode_DiscardAll)
-            self._acquisition_running = False
-            self._node_map.FindNode("TLParamsLocked").SetValue(0)
-        except Exception as e:
-            logging.error("Exception (stop acquisition): %s", e)
-
-    def get_jpeg_frame(self):
-        buffer = None
-        try:
-            buffer = self._datastream.WaitForFinishedBuffer(1000)
-            image = ids_peak_ipl_extension.BufferToImage(buffer)
-            converted_image = image.ConvertTo(ids_peak_ipl.PixelFormatName_BGR8)
-            np_image = converted_image.get_numpy_3D()
-            if self.target_size:
-                np_image = cv2.resize(np_image, self.target_size)
-            success, jpeg_buffer = cv2.imencode('.jpg', np_image, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-            return jpeg_buffer.tobytes() if success else None
-        except Exception as e:
-            logging.error("Error capturing frame: %s", e)
-            raise
-        finally:
-            if buffer:
-                self._datastream.QueueBuffer(buffer)
-
-# Video track that reads frames from the camera and converts them to AV frames.
+# Video track that reads raw frames from the camera and feeds them to the encoder as I420.
 class CameraVideoStreamTrack(VideoStreamTrack):
-    def __init__(self, camera: Camera):
+    def __init__(self, camera):
         super().__init__()
         self.camera = camera
+        # Reused I420 destination, so converting a frame does not allocate
+        self._i420 = None
+
+    def get_i420_frame(self, out=None):
+        """
+        Captures a single frame as planar I420 (YUV 4:2:0), the layout the
+        WebRTC video encoders consume. Pass the previous result as `out` to
+        convert into it instead of allocating a new array.
+        """
+        np_image = self.camera.grab(BUFFER_TIMEOUT)
+        return cv2.cvtColor(np_image, cv2.COLOR_BGR2YUV_I420, dst=out)
 
     async def recv(self):
         pts, time_base = await self.next_timestamp()
-        try:
-            jpeg_bytes = self.camera.get_jpeg_frame()
-        except Exception as e:
-            logging.error("Error in video track: %s", e)
-            await asyncio.sleep(0.01)
-            return None
-        if jpeg_bytes is None:
-            await asyncio.sleep(0.01)
-            return None
-        nparr = np.frombuffer(jpeg_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img is None:
-            await asyncio.sleep(0.01)
-            return None
-        frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+        for attempt in range(1, GRAB_RETRIES + 1):
+            try:
+                # WaitForFinishedBuffer blocks, so capture off the event loop
+                self._i420 = await asyncio.to_thread(self.get_i420_frame, self._i420)
+                break
+            except Exception as e:
+                logging.error("Error in video track (attempt %d/%d): %s", attempt, GRAB_RETRIES, e)
+                if attempt == GRAB_RETRIES:
+                    # Ends the track cleanly, the encoder cannot take None
+                    self.stop()
+                    raise MediaStreamError from e
+                await asyncio.sleep(0.01)
+        frame = av.VideoFrame.from_ndarray(self._i420, format="yuv420p")
         frame.pts = pts
         frame.time_base = time_base
         return frame
 
+class SharedCameraSource:
+    """
+    Reference-counted camera shared by all peer connections. The camera is
+    opened and started for the first subscriber, every peer gets its own
+    relayed copy of a single CameraVideoStreamTrack, and the camera is
+    stopped and closed again once the last subscriber has left. A track
+    that ended on grab errors releases the camera too, and the next
+    subscriber opens it again.
+    """
+    def __init__(self, device_index=0, backend=CAMERA_BACKEND):
+        self.device_index = device_index
+        self.backend = backend
+        self._camera = None
+        self._track = None
+        self._relay = None
+        self._subscribers = 0
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self):
+        async with self._lock:
+            if self._track is None:
+                camera = create_camera(self.backend)
+                try:
+                    camera.open(self.device_index)
+                    camera.start()
+                except Exception:
+                    camera.close()
+                    raise
+                track = CameraVideoStreamTrack(camera)
+
+                @track.on("ended")
+                async def on_ended():
+                    await self._track_ended(track)
+
+                self._camera = camera
+                self._track = track
+                self._relay = MediaRelay()
+                logging.info("Camera source started")
+            self._subscribers += 1
+            return self._relay.subscribe(self._track)
+
+    async def unsubscribe(self):
+        async with self._lock:
+            if self._subscribers == 0:
+                return
+            self._subscribers -= 1
+            if self._subscribers == 0 and self._track is not None:
+                await self._release()
+
+    async def _track_ended(self, track):
+        async with self._lock:
+            # Otherwise already released, or replaced by a new track
+            if track is self._track:
+                await self._release()
+
+    async def _release(self):
+        track, camera = self._track, self._camera
+        self._camera = None
+        self._track = None
+        self._relay = None
+        track.stop()
+        # A grab may still be waiting for a buffer, close off the event loop
+        await asyncio.to_thread(camera.close)
+        logging.info("Camera source stopped")
+
 pcs = set()
+camera_source = SharedCameraSource(device_index=0)
+
+async def close_peer(pc):
+    # Only release the camera once per peer, whichever event comes first
+    if pc not in pcs:
+        return
+    pcs.discard(pc)
+    await pc.close()
+    await camera_source.unsubscribe()
 
 async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+    try:
+        track = await camera_source.subscribe()
+    except Exception as e:
+        logging.error("Failed to open camera: %s", e)
+        return web.Response(status=500, text="Failed to start camera acquisition")
+
     pc = RTCPeerConnection()
     pcs.add(pc)
     logging.info("Created PeerConnection: %s", pc)
 
-    # Create a Camera instance (using device index 0)
-    device_manager = ids_peak.DeviceManager.Instance()
-    camera = Camera(device_manager, device_index=0)
-    if not camera.start_acquisition():
-        return web.Response(status=500, text="Failed to start camera acquisition")
-
     # Add the video track using addTrack and then set the corresponding transceiver's direction
-    sender = pc.addTrack(CameraVideoStreamTrack(camera))
+    sender = pc.addTrack(track)
     for transceiver in pc.getTransceivers():
         if transceiver.sender == sender:
             transceiver.direction = "sendonly"
@@ -192,12 +155,20 @@ async def offer(request):
     async def on_iceconnectionstatechange():
         logging.info("ICE connection state is %s", pc.iceConnectionState)
         if pc.iceConnectionState == "failed":
-            await pc.close()
-            pcs.discard(pc)
+            await close_peer(pc)
+
+    @pc.on("connectionstatechange")
+    async def on_connectionstatechange():
+        if pc.connectionState in ("failed", "closed"):
+            await close_peer(pc)
 
-    await pc.setRemoteDescription(offer)
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
+    try:
+        await pc.setRemoteDescription(offer)
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+    except Exception:
+        await close_peer(pc)
+        raise
 
     return web.Response(
         content_type="application/json",
@@ -208,12 +179,10 @@ async def offer(request):
     )
 
 async def on_shutdown(app):
-    coros = [pc.close() for pc in pcs]
+    coros = [close_peer(pc) for pc in list(pcs)]
     await asyncio.gather(*coros)
-    pcs.clear()
 
 if __name__ == "__main__":
-    ids_peak.Library.Initialize()
     app = web.Application()
     app.router.add_post("/offer", offer)
     